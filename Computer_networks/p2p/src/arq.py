@@ -0,0 +1,267 @@
+#  This file is part of network emulation test model.
+#
+#  Copyright (C) 2010, 2011  Vladimir Rutsky <altsysrq@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
+__license__ = "GPL"
+
+__all__ = ["ArqStrategy", "StopAndWait", "GoBackN", "SelectiveRepeat",
+    "arq_strategies", "get_arq_strategy"]
+
+"""Automatic repeat request strategies used by FrameTransmitter.
+"""
+
+class ArqStrategy(object):
+    """Defines sizes of send and receive windows and frames retransmitted on
+    timeout.
+    """
+
+    name = None
+
+    def send_window_size(self, window_size):
+        """Returns send window size for configured `window_size'."""
+        return window_size
+
+    def receive_window_size(self, window_size):
+        """Returns receive window size for configured `window_size'.
+        Frames outside receive window are dropped.
+        """
+        return window_size
+
+    def frames_to_retransmit(self, send_window, timeout_items):
+        """Returns send window items which should be retransmitted, when
+        timers of `timeout_items' expired.
+        """
+        raise NotImplementedError()
+
+class StopAndWait(ArqStrategy):
+    """Next frame is sent only after acknowledge of previous one."""
+
+    name = 'stop_and_wait'
+
+    def send_window_size(self, window_size):
+        return 1
+
+    def receive_window_size(self, window_size):
+        return 1
+
+    def frames_to_retransmit(self, send_window, timeout_items):
+        return timeout_items
+
+class GoBackN(ArqStrategy):
+    """Receiver accepts frames only in order, so on timeout all not
+    acknowledged frames are retransmitted.
+    """
+
+    name = 'go_back_n'
+
+    def receive_window_size(self, window_size):
+        return 1
+
+    def frames_to_retransmit(self, send_window, timeout_items):
+        if not timeout_items:
+            return []
+        return [item for item in send_window.items()
+            if not item.ack_received]
+
+class SelectiveRepeat(ArqStrategy):
+    """Receiver buffers out of order frames, only frames with expired timers
+    are retransmitted.
+    """
+
+    name = 'selective_repeat'
+
+    def frames_to_retransmit(self, send_window, timeout_items):
+        return timeout_items
+
+# { strategy name: strategy class }
+arq_strategies = dict((strategy.name, strategy)
+    for strategy in (StopAndWait, GoBackN, SelectiveRepeat))
+
+def get_arq_strategy(arq):
+    """Returns strategy object for strategy name or object `arq'."""
+    if isinstance(arq, ArqStrategy):
+        return arq
+    return arq_strategies[arq]()
+# --- cut here in report ---
+
+def _test():
+    # TODO: Use in separate file to test importing functionality.
+
+    import csv
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    from testing import unittest, do_tests
+
+    from duplex_link import FullDuplexLink
+    from frame import SimpleFrameTransmitter, SlipEncoder
+    from sliding_window import FrameTransmitter, experiment
+
+    class ManualWorker(object):
+        # Transmitters are updated by test.
+        def add_frame_transmitter(self, frame_transmitter):
+            return self
+
+        def remove_frame_transmitter(self, frame_transmitter):
+            pass
+
+        def wakeup(self):
+            pass
+
+    class Tests(object):
+        class TestArqStrategies(unittest.TestCase):
+            def make_transmitters(self, arq):
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a)
+                bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                # Frames are retransmitted only on timeout.
+                aft = FrameTransmitter(simple_frame_transmitter=at,
+                    worker=w, max_frame_data=1, window_size=5, arq=arq,
+                    ack_timeout=0.05, adaptive_ack_timeout=False,
+                    fast_retransmit=False)
+                bft = FrameTransmitter(simple_frame_transmitter=bt,
+                    worker=w, max_frame_data=1, window_size=5, arq=arq,
+                    ack_delay=0, fast_retransmit=False)
+                return at, bt, aft, bft
+
+            def transmit_with_lost_frame(self, arq):
+                """Sends 5 frames, loses the second one and returns number
+                of retransmitted frames.
+                """
+                at, bt, aft, bft = self.make_transmitters(arq)
+                encoder = SlipEncoder()
+
+                aft.send("abcde")
+                aft.update()
+                # Pass frames through except the second one.
+                for i, frame in enumerate(bt.read_frames()):
+                    if i != 1:
+                        at.node.write(encoder.encode(frame))
+                bft.update()
+                aft.update()
+
+                time.sleep(0.06)
+                aft.update()
+                for frame in bt.read_frames():
+                    at.node.write(encoder.encode(frame))
+                bft.update()
+                self.assertEqual(bft.receive(False), "abcde")
+
+                return aft.retransmissions_count
+
+            def test_strategies(self):
+                self.assertTrue(isinstance(get_arq_strategy('go_back_n'),
+                    GoBackN))
+                strategy = StopAndWait()
+                self.assertTrue(get_arq_strategy(strategy) is strategy)
+
+            def test_stop_and_wait(self):
+                at, bt, aft, bft = self.make_transmitters('stop_and_wait')
+                aft.send("abc")
+                aft.update()
+                self.assertEqual(at.write_frames_count, 1)
+
+            def test_go_back_n(self):
+                # All frames starting from lost one are retransmitted.
+                self.assertEqual(self.transmit_with_lost_frame('go_back_n'),
+                    4)
+
+            def test_selective_repeat(self):
+                self.assertEqual(
+                    self.transmit_with_lost_frame('selective_repeat'), 1)
+
+            def test_experiment(self):
+                for arq in arq_strategies:
+                    time_, sent = experiment(10, 100, ["x" * 1000],
+                        loss_prob=0.001, seed=1, arq=arq)
+                    self.assertGreaterEqual(sent, 11)
+
+            def test_go_back_n_losses(self):
+                # Acknowledges of retransmitted frames drop timeout backoff,
+                # otherwise timeout stays at maximum, because all frames are
+                # retransmitted and aren't sampled.
+                time_, sent = experiment(50, 100, ["x" * 10000],
+                    loss_prob=0.002, seed=0, arq='go_back_n')
+                self.assertLess(time_, 10)
+
+            def test_benchmark(self):
+                temp_dir = tempfile.mkdtemp()
+                try:
+                    file_name = os.path.join(temp_dir, "data_arq.csv")
+                    _benchmark(loss_probs=(0, 1e-3), max_frames=(100,),
+                        tries=1, datagrams_count=2, file_name=file_name)
+
+                    with open(file_name) as f:
+                        rows = list(csv.reader(f))
+                    self.assertEqual(rows[0][:3],
+                        ["arq", "loss_prob", "max_frame"])
+                    self.assertEqual(len(rows), 1 + len(arq_strategies) * 2)
+                    for row in rows[1:]:
+                        self.assertGreater(float(row[4]), 0)
+                finally:
+                    shutil.rmtree(temp_dir)
+
+    do_tests(Tests)
+
+def _benchmark(loss_probs=(0, 1e-4, 1e-3), max_frames=(50, 100, 400),
+        window_size=100, tries=3, datagrams_count=32,
+        file_name="data_arq.csv"):
+    """Runs `experiment()' for each strategy, loss probability and maximum
+    frame size. Reports throughput and frame overhead (ratio of sent frames
+    count to data frames count).
+    `datagrams_count' datagrams of 2 KB are sent, so that results are
+    dominated by steady state rather than by the initial timeout.
+    Losses are independent for each character, so with greater
+    probabilities most of large frames are corrupted and transfer time is
+    dominated by timeout backoff.
+    """
+
+    import csv
+
+    from sliding_window import average_experiment
+
+    datagram = "".join(map(chr, xrange(256))) * 8
+    data_list = [datagram] * datagrams_count
+    data_size = len(datagram) * datagrams_count
+
+    with open(file_name, "w") as f:
+        csv_writer = csv.writer(f, lineterminator='\n')
+        csv_writer.writerow(("arq", "loss_prob", "max_frame", "time",
+            "throughput", "frames_count", "overhead"))
+        for arq in sorted(arq_strategies):
+            for loss_prob in loss_probs:
+                for max_frame in max_frames:
+                    time_, frames_count = average_experiment(
+                        window_size, max_frame, data_list,
+                        loss_prob=loss_prob, tries=tries, seed=0, arq=arq)
+                    data_frames_count = datagrams_count * \
+                        ((len(datagram) + max_frame - 1) // max_frame)
+                    throughput = data_size / time_
+                    overhead = frames_count / float(data_frames_count)
+                    print ("{0:16} loss={1:<6} max_frame={2:<4} "
+                        "throughput={3:10.0f} B/s overhead={4:.2f}").format(
+                            arq, loss_prob, max_frame, throughput, overhead)
+                    csv_writer.writerow((arq, loss_prob, max_frame, time_,
+                        throughput, frames_count, overhead))
+
+if __name__ == "__main__":
+    _test()
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,387 @@
+#  This file is part of network emulation test model.
+#
+#  Copyright (C) 2010, 2011  Vladimir Rutsky <altsysrq@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
+__license__ = "GPL"
+
+__all__ = ["BondedSimpleFrameTransmitter", "BondedLink"]
+
+"""Transmit raw frames striped over several links between two hosts.
+"""
+
+import threading
+import select
+import logging
+from collections import deque
+
+import config
+from duplex_link import FullDuplexLink
+from frame import SimpleFrameTransmitter
+
+# Errors of member link which mean its failure (e.g. closed descriptor).
+member_errors = (EnvironmentError, select.error)
+
+class BondedSimpleFrameTransmitter(object):
+    """Aggregates several SimpleFrameTransmitter's into one.
+    Written frames are distributed between enabled member links in
+    round-robin order, frames are read from all member links.
+    Member link is disabled automatically when writing into it or reading
+    from it fails: its channel (memory or descriptor one) is closed when link
+    goes down. Member link which silently loses frames is not detected.
+    Frames may be reordered or lost (when member link goes down), so
+    FrameTransmitter on top of bonded transmitter reorders and retransmits
+    them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._members = list(kwargs.pop('members'))
+        super(BondedSimpleFrameTransmitter, self).__init__(*args, **kwargs)
+        assert self._members
+
+        self._logger = logging.getLogger("BondedSimpleFrameTransmitter")
+
+        self._members_enabled = [True] * len(self._members)
+        self._lock = threading.RLock()
+
+        self._next_write_member = 0
+        self._next_read_member = 0
+
+        # Set when data is written into one of member links (or member link
+        # is enabled), so that blocked reader rechecks member links.
+        self._data_arrived = threading.Event()
+        for member in self._members:
+            member.add_read_listener(self._data_arrived.set)
+
+    @property
+    def members(self):
+        return tuple(self._members)
+
+    @property
+    def read_frames_count(self):
+        return sum(m.read_frames_count for m in self._members)
+
+    @property
+    def write_frames_count(self):
+        return sum(m.write_frames_count for m in self._members)
+
+    def set_max_frame_size(self, size):
+        for member in self._members:
+            member.set_max_frame_size(size)
+
+    def add_read_listener(self, listener):
+        for member in self._members:
+            member.add_read_listener(listener)
+
+    def remove_read_listener(self, listener):
+        for member in self._members:
+            member.remove_read_listener(listener)
+
+    def read_fds(self):
+        # Disabled member links are not read, so their descriptors would
+        # remain readable.
+        with self._lock:
+            return [fd for index, member in enumerate(self._members)
+                if self._members_enabled[index] for fd in member.read_fds()]
+
+    @property
+    def is_polled(self):
+        return any(member.is_polled for member in self._members)
+
+    def is_member_enabled(self, index):
+        return self._members_enabled[index]
+
+    def set_member_enabled(self, index, enabled):
+        """Enables or disables (on member link failure) member link."""
+        with self._lock:
+            self._members_enabled[index] = bool(enabled)
+        self._data_arrived.set()
+
+    def _member_failed(self, index, ex):
+        self._logger.warning("Member link {0} failed, disabling it: "
+            "{1}".format(index, ex))
+        self.set_member_enabled(index, False)
+
+    def write_frame(self, frame):
+        """Writes frame into next enabled member link. If writing fails,
+        member link is disabled and frame is written into next one.
+        """
+        for i in xrange(len(self._members)):
+            with self._lock:
+                for j in xrange(len(self._members)):
+                    index = (self._next_write_member + j) % len(self._members)
+                    if self._members_enabled[index]:
+                        break
+                else:
+                    # All member links are down, frame is lost.
+                    return
+
+                self._next_write_member = (index + 1) % len(self._members)
+
+            try:
+                self._members[index].write_frame(frame)
+                return
+            except member_errors as ex:
+                self._member_failed(index, ex)
+
+    def _read_frame(self):
+        with self._lock:
+            for i in xrange(len(self._members)):
+                index = (self._next_read_member + i) % len(self._members)
+                if not self._members_enabled[index]:
+                    continue
+
+                try:
+                    frame = self._members[index].read_frame(block=False)
+                except member_errors as ex:
+                    self._member_failed(index, ex)
+                    continue
+                if frame is not None:
+                    # Next time start from next member link, so that all
+                    # links are served fairly.
+                    self._next_read_member = (index + 1) % len(self._members)
+                    return frame
+            return None
+
+    def _read_frames(self):
+        with self._lock:
+            # Frames read from each member link starting from the next
+            # member link for reading.
+            batches = []
+            for i in xrange(len(self._members)):
+                index = (self._next_read_member + i) % len(self._members)
+                if self._members_enabled[index]:
+                    try:
+                        batches.append(
+                            (index, deque(self._members[index].read_frames())))
+                    except member_errors as ex:
+                        self._member_failed(index, ex)
+
+            # Frames are written in round-robin order, so taking them in the
+            # same order restores order of frames sent through lossless
+            # member links.
+            frames = []
+            while any(batch for index, batch in batches):
+                for index, batch in batches:
+                    if batch:
+                        frames.append(batch.popleft())
+                        self._next_read_member = \
+                            (index + 1) % len(self._members)
+        return frames
+
+    def _wait_for_data(self):
+        """Waits until data is written into one of enabled member links."""
+        with self._lock:
+            enabled = [member for index, member in enumerate(self._members)
+                if self._members_enabled[index]]
+        if not enabled:
+            # Wait until member link is enabled.
+            self._data_arrived.wait()
+            return
+
+        fds = [fd for member in enabled for fd in member.read_fds()]
+        # Data written by other process is noticed only on next check.
+        timeout = (config.frame_transmitter_thread_sleep_time
+            if any(member.is_polled for member in enabled) else None)
+        if len(fds) == len(enabled):
+            # Descriptors of all member links can be waited, including
+            # data written from other processes.
+            try:
+                select.select(fds, [], [], timeout)
+            except (select.error, ValueError):
+                # Descriptor of some member link is closed, it will be
+                # disabled on read.
+                pass
+        else:
+            self._data_arrived.wait(timeout)
+
+    def read_frame(self, block=True):
+        """Read single frame from any enabled member link.
+        Assumed that this is the only reader from member links.
+        """
+        while True:
+            # Clear event before reading, so that data written after
+            # reading is not missed.
+            self._data_arrived.clear()
+            frame = self._read_frame()
+            if frame is not None or not block:
+                return frame
+            self._wait_for_data()
+
+    def read_frames(self, block=False):
+        """Read all complete frames from enabled member links.
+        If `block' is True waits for at least one frame.
+        """
+        while True:
+            self._data_arrived.clear()
+            frames = self._read_frames()
+            if frames or not block:
+                return frames
+            self._wait_for_data()
+
+def BondedLink(links_count, framing='slip', **kwargs):
+    """Creates `links_count' links with FullDuplexLink(**kwargs) and returns
+    pair of bonded transmitters for their ends.
+    """
+    a_members, b_members = [], []
+    for i in xrange(links_count):
+        a, b = FullDuplexLink(**kwargs)
+        a_members.append(SimpleFrameTransmitter(node=a, framing=framing))
+        b_members.append(SimpleFrameTransmitter(node=b, framing=framing))
+    return (BondedSimpleFrameTransmitter(members=a_members),
+        BondedSimpleFrameTransmitter(members=b_members))
+# --- cut here in report ---
+
+def _test():
+    # TODO: Use in separate file to test importing functionality.
+
+    import time
+
+    from testing import unittest, do_tests
+
+    from duplex_link import LossFunc
+    from sliding_window import FrameTransmitter
+
+    class Tests(object):
+        class TestBondedSimpleFrameTransmitter(unittest.TestCase):
+            def test_striping(self):
+                at, bt = BondedLink(3)
+
+                for i in xrange(6):
+                    at.write_frame(str(i))
+                self.assertEqual([m.write_frames_count for m in at.members],
+                    [2, 2, 2])
+                self.assertEqual(
+                    sorted(bt.read_frame() for i in xrange(6)),
+                    map(str, xrange(6)))
+                self.assertEqual(bt.read_frame(block=False), None)
+                self.assertEqual(bt.read_frames_count, 6)
+
+                for i in xrange(6):
+                    at.write_frame(str(i))
+                self.assertEqual(sorted(bt.read_frames()),
+                    map(str, xrange(6)))
+                self.assertEqual(bt.read_frames(), [])
+
+            def test_read_order(self):
+                at, bt = BondedLink(3)
+
+                at.write_frame("0")
+                self.assertEqual(bt.read_frames(), ["0"])
+                # Frames written in round-robin order are read in the same
+                # order.
+                for i in xrange(1, 8):
+                    at.write_frame(str(i))
+                self.assertEqual(bt.read_frames(), map(str, xrange(1, 8)))
+
+            def test_failover(self):
+                at, bt = BondedLink(2)
+
+                at.set_member_enabled(0, False)
+                self.assertFalse(at.is_member_enabled(0))
+                at.write_frame("1")
+                at.write_frame("2")
+                self.assertEqual(at.members[0].write_frames_count, 0)
+                self.assertEqual(bt.read_frame(), "1")
+                self.assertEqual(bt.read_frame(), "2")
+
+                at.set_member_enabled(1, False)
+                at.write_frame("lost")
+                self.assertEqual(bt.read_frame(block=False), None)
+
+            def test_member_failure(self):
+                for backend in ['memory', 'pipe']:
+                    at, bt = BondedLink(2, backend=backend)
+
+                    # Channel of the first member link is closed.
+                    at.members[0].node.send_channel.close()
+                    at.write_frame("1")
+                    at.write_frame("2")
+                    self.assertFalse(at.is_member_enabled(0))
+                    self.assertEqual(at.members[1].write_frames_count, 2)
+
+                    self.assertEqual(bt.read_frame(), "1")
+                    self.assertEqual(bt.read_frames(), ["2"])
+                    self.assertFalse(bt.is_member_enabled(0))
+                    self.assertTrue(bt.is_member_enabled(1))
+
+            def test_blocking_read(self):
+                saved_sleep_time = config.frame_transmitter_thread_sleep_time
+                # Reader shouldn't poll member links.
+                config.frame_transmitter_thread_sleep_time = 10
+                try:
+                    for backend in ['memory', 'pipe']:
+                        at, bt = BondedLink(2, backend=backend)
+
+                        def write():
+                            time.sleep(0.05)
+                            at.write_frame("1")
+                            time.sleep(0.05)
+                            at.write_frame("2")
+                        thread = threading.Thread(target=write)
+                        start = time.time()
+                        thread.start()
+                        self.assertEqual(bt.read_frame(), "1")
+                        self.assertEqual(bt.read_frames(block=True), ["2"])
+                        self.assertLess(time.time() - start, 1)
+                        thread.join()
+                finally:
+                    config.frame_transmitter_thread_sleep_time = \
+                        saved_sleep_time
+
+        class TestBondedFrameTransmitter(unittest.TestCase):
+            def test_transmit(self):
+                at, bt = BondedLink(3,
+                    loss_func=LossFunc(0.001, 0.001, 0.001))
+                aft = FrameTransmitter(simple_frame_transmitter=at)
+                bft = FrameTransmitter(simple_frame_transmitter=bt)
+
+                text = "".join(map(chr, xrange(256))) * 4
+                aft.send(text)
+                self.assertEqual(bft.receive(), text)
+
+                # One member link goes down.
+                at.set_member_enabled(1, False)
+                bt.set_member_enabled(1, False)
+                aft.send(text)
+                self.assertEqual(bft.receive(), text)
+                bft.send(text)
+                self.assertEqual(aft.receive(), text)
+
+                aft.terminate()
+                bft.terminate()
+
+            def test_no_spurious_retransmissions(self):
+                # Lossless bonded link doesn't reorder frames enough to be
+                # reported missing.
+                at, bt = BondedLink(3)
+                aft = FrameTransmitter(simple_frame_transmitter=at)
+                bft = FrameTransmitter(simple_frame_transmitter=bt)
+
+                text = "".join(map(chr, xrange(256))) * 40
+                aft.send(text)
+                self.assertEqual(bft.receive(), text)
+                self.assertEqual(aft.fast_retransmissions_count, 0)
+
+                aft.terminate()
+                bft.terminate()
+
+    do_tests(Tests)
+
+if __name__ == "__main__":
+    _test()
+
+# vim: set ts=4 sw=4 et:
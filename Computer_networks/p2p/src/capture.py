@@ -0,0 +1,592 @@
+#  This file is part of network emulation test model.
+#
+#  Copyright (C) 2010, 2011  Vladimir Rutsky <altsysrq@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
+__license__ = "GPL"
+
+__all__ = ["CaptureLayer", "CaptureDirection", "CaptureTap", "CaptureReader",
+    "decode_records"]
+
+"""Capture of transmitted bytes and frames into pcap file.
+"""
+
+import os
+import mmap
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+from sliding_window import Frame, FrameType, InvalidFrameException, \
+    FrameTransmitter
+from datagram import Datagram, InvalidDatagramException
+from service_manager import datagram_to_packet, InvalidPacketException
+
+class CaptureLayer(object):
+    # Raw bytes written into link. Direction is index of writing link end.
+    link  = 0
+    # Frames written and read by SimpleFrameTransmitter. Direction is index
+    # of link end which wrote frame, so when both link ends share one tap,
+    # each frame is recorded when it's written and when it's read.
+    frame = 1
+
+class CaptureDirection(object):
+    # Directions of frames for transmitter at link end 0.
+    sent     = 0
+    received = 1
+
+# Global pcap file header:
+#      4       2       2        4         4         4          4      - size
+# *-------*-------*-------*----------*---------*---------*----------*
+# | magic | major | minor | thiszone | sigfigs | snaplen | linktype |
+# *-------*-------*-------*----------*---------*---------*----------*
+#
+# `sigfigs' is unused by pcap readers and here holds offset of the oldest
+# record in ring file (zero in exported plain pcap file).
+pcap_header_format = '<IHHiIII'
+pcap_header_size = struct.calcsize(pcap_header_format)
+pcap_magic = 0xa1b2c3d4
+# LINKTYPE_USER0.
+pcap_linktype = 147
+
+# Record header:
+#      4         4          4          4         1        1       - size
+# *--------*---------*----------*----------*-------*-----------*--  --*
+# | ts_sec | ts_usec | incl_len | orig_len | layer | direction | data |
+# *--------*---------*----------*----------*-------*-----------*--  --*
+#
+# `layer' and `direction' are pseudo-header included into captured data.
+record_header_format = '<IIIIBB'
+record_header_size = struct.calcsize(record_header_format)
+pseudo_header_size = struct.calcsize('<BB')
+# Zero record header marks end of records.
+end_marker = "\0" * record_header_size
+
+Record = namedtuple('Record', 'time layer direction data orig_len')
+
+class CaptureTap(object):
+    """Writes captured data into preallocated memory-mapped ring file in
+    pcap format. When file is full, the oldest records are overwritten.
+    Ring file is not a valid pcap file for Wireshark or tcpdump: it is
+    zero-padded, records are terminated with end marker in the middle of
+    file after wrap around and offset of the oldest record is stored in
+    `sigfigs' field. Use `CaptureReader.export()' to get plain pcap file.
+    """
+
+    def __init__(self, file_name, size=4 * 2**20, snaplen=65535):
+        super(CaptureTap, self).__init__()
+        assert size >= pcap_header_size + 2 * record_header_size
+
+        self._size = size
+        self._snaplen = snaplen
+
+        with open(file_name, "w+b") as f:
+            f.truncate(size)
+            self._mmap = mmap.mmap(f.fileno(), size)
+
+        self._lock = threading.Lock()
+        # Offset for next record.
+        self._offset = pcap_header_size
+        # Offsets of records in file, from the oldest to the newest.
+        self._records = deque()
+
+        struct.pack_into(pcap_header_format, self._mmap, 0,
+            pcap_magic, 2, 4, 0, pcap_header_size, snaplen, pcap_linktype)
+        self._mmap[self._offset:self._offset + record_header_size] = \
+            end_marker
+
+    def close(self):
+        with self._lock:
+            self._mmap.close()
+
+    def record(self, layer, direction, data):
+        """Stores captured `data'."""
+        curtime = time.time()
+        orig_len = len(data) + pseudo_header_size
+        incl_len = min(orig_len, self._snaplen)
+        data = data[:incl_len - pseudo_header_size]
+        record_size = record_header_size + len(data)
+        # Reserve space for end marker.
+        required_size = record_size + record_header_size
+        if pcap_header_size + required_size > self._size:
+            # Too big record.
+            return
+
+        with self._lock:
+            if self._offset + required_size > self._size:
+                # Wrap around. Records before current offset are preserved
+                # and terminated with current end marker. Records of
+                # previous lap after it are forgotten, so that file contains
+                # only two contiguous segments of records.
+                while self._records and self._records[0] >= self._offset:
+                    self._records.popleft()
+                self._offset = pcap_header_size
+
+            # Forget overwritten records.
+            end = self._offset + required_size
+            while (self._records and
+                    self._offset <= self._records[0] < end):
+                self._records.popleft()
+
+            offset = self._offset
+            struct.pack_into(record_header_format, self._mmap, offset,
+                int(curtime), int((curtime % 1) * 1e6), incl_len, orig_len,
+                layer, direction)
+            self._mmap[offset + record_header_size:offset + record_size] = \
+                str(data)
+            self._mmap[offset + record_size:end] = end_marker
+            self._records.append(offset)
+            self._offset = offset + record_size
+
+            # Store offset of the oldest record in `sigfigs' field.
+            struct.pack_into('<I', self._mmap, 12, self._records[0])
+
+class CaptureReader(object):
+    """Reads records from file written by CaptureTap."""
+
+    def __init__(self, file_name):
+        super(CaptureReader, self).__init__()
+        with open(file_name, "rb") as f:
+            self._data = f.read()
+
+        magic, major, minor, thiszone, self._oldest, snaplen, linktype = \
+            struct.unpack_from(pcap_header_format, self._data, 0)
+        if magic != pcap_magic or linktype != pcap_linktype:
+            raise ValueError("Not a capture file: '{0}'".format(file_name))
+        if self._oldest == 0:
+            # Plain pcap file.
+            self._oldest = pcap_header_size
+
+    def _read_from(self, offset):
+        while offset + record_header_size <= len(self._data):
+            ts_sec, ts_usec, incl_len, orig_len, layer, direction = \
+                struct.unpack_from(record_header_format, self._data, offset)
+            if incl_len == 0:
+                # End marker.
+                break
+
+            data_start = offset + record_header_size
+            data_end = data_start + incl_len - pseudo_header_size
+            yield Record(ts_sec + ts_usec * 1e-6, layer, direction,
+                self._data[data_start:data_end], orig_len - pseudo_header_size)
+            offset = data_end
+
+    def __iter__(self):
+        """Yields records from the oldest to the newest."""
+        for record in self._read_from(self._oldest):
+            yield record
+        if self._oldest != pcap_header_size:
+            # File wrapped around, read newer records from file start.
+            for record in self._read_from(pcap_header_size):
+                yield record
+
+    def export(self, file_name):
+        """Writes records from the oldest to the newest into plain (not
+        ring) pcap file.
+        """
+        with open(file_name, "wb") as f:
+            magic, major, minor, thiszone, oldest, snaplen, linktype = \
+                struct.unpack_from(pcap_header_format, self._data, 0)
+            f.write(struct.pack(pcap_header_format, magic, major, minor,
+                thiszone, 0, snaplen, linktype))
+            for record in self:
+                ts_sec = int(record.time)
+                f.write(struct.pack(record_header_format,
+                    ts_sec, int(round((record.time - ts_sec) * 1e6)),
+                    len(record.data) + pseudo_header_size,
+                    record.orig_len + pseudo_header_size,
+                    record.layer, record.direction))
+                f.write(record.data)
+
+def _message_frame_ids(received, frame):
+    """Returns ids of frames of message containing data `frame' if all its
+    frames are in `received' ({ frame id: frame }), otherwise None. Frames
+    of other streams are interleaved with message frames.
+    """
+
+    period = FrameTransmitter._frame_id_period
+
+    # Search for the first frame of message.
+    ids = deque()
+    frame_id = frame.id
+    while True:
+        f = received.get(frame_id)
+        if f is None:
+            return None
+        if f.stream == frame.stream:
+            if f.is_last and f is not frame:
+                return None
+            ids.appendleft(frame_id)
+            if f.datagram_size is not None or f.is_chunked:
+                break
+        frame_id = (frame_id - 1) % period
+
+    # Search for the last frame of message.
+    frame_id = frame.id
+    is_last = frame.is_last
+    while not is_last:
+        frame_id = (frame_id + 1) % period
+        f = received.get(frame_id)
+        if f is None:
+            return None
+        if f.stream == frame.stream:
+            if f.datagram_size is not None or f.is_chunked:
+                return None
+            ids.append(frame_id)
+            is_last = f.is_last
+    return ids
+
+def _decode_message(data, is_chunked):
+    """Returns Datagram, tuple (protocol, Packet) or string data of chunked
+    message decoded from message `data', or exception.
+    """
+
+    if is_chunked:
+        return data
+
+    try:
+        datagram = Datagram.deserialize(data)
+    except InvalidDatagramException as ex:
+        return ex
+
+    try:
+        return datagram_to_packet(datagram, None)
+    except InvalidPacketException:
+        return datagram
+
+def decode_records(records):
+    """Decodes frame records. Yields tuples (record, decoded object), where
+    decoded object is Frame or, when the whole message is received,
+    Datagram, tuple (protocol, Packet) or string data of chunked message.
+    Messages are reassembled separately for each direction and stream in
+    order of frame ids, retransmitted frames are skipped.
+    """
+
+    # Number of recent frame ids remembered for detecting retransmissions.
+    seen_ids_limit = FrameTransmitter._frame_id_period // 2
+
+    # { direction: { frame id: frame } } of recently received frames.
+    # Frames of reassembled messages are kept, so that messages interleaved
+    # with them could be reassembled.
+    received = {}
+    # { direction: deque of recently received frame ids }
+    received_ids = {}
+    # { direction: set of ids of frames of incomplete messages }
+    incomplete_ids = {}
+
+    for record in records:
+        if record.layer != CaptureLayer.frame:
+            continue
+
+        try:
+            frame = Frame.deserialize(record.data)
+        except InvalidFrameException as ex:
+            yield record, ex
+            continue
+
+        yield record, frame
+
+        if frame.type != FrameType.data:
+            continue
+
+        frames = received.setdefault(record.direction, {})
+        ids_order = received_ids.setdefault(record.direction, deque())
+        incomplete = incomplete_ids.setdefault(record.direction, set())
+
+        # Skip retransmitted frames.
+        if frame.id in frames:
+            continue
+        ids_order.append(frame.id)
+        if len(ids_order) > seen_ids_limit:
+            # Frame id may be reused, forget the oldest frame.
+            old_id = ids_order.popleft()
+            del frames[old_id]
+            incomplete.discard(old_id)
+        frames[frame.id] = frame
+
+        # Received frame may complete its own message or message of other
+        # stream interleaved with it.
+        incomplete.add(frame.id)
+        for frame_id in sorted(incomplete):
+            if frame_id not in incomplete:
+                # Already reassembled.
+                continue
+            message_ids = _message_frame_ids(frames, frames[frame_id])
+            if message_ids is None:
+                continue
+            incomplete.difference_update(message_ids)
+            data = "".join(str(frames[i].data) for i in message_ids)
+            yield record, _decode_message(data,
+                frames[message_ids[0]].is_chunked)
+# --- cut here in report ---
+
+def _dump(file_name):
+    directions = {0: "a->b", 1: "b->a"}
+
+    records = list(CaptureReader(file_name))
+    for record in records:
+        if record.layer == CaptureLayer.link:
+            print "{0:.6f} link {1}: {2} bytes".format(
+                record.time, directions[record.direction], record.orig_len)
+    for record, obj in decode_records(records):
+        if isinstance(obj, tuple):
+            obj = "protocol={0}, {1}".format(obj[0], obj[1])
+        print "{0:.6f} frame {1}: {2}".format(
+            record.time, directions[record.direction], obj)
+
+def _test():
+    # TODO: Use in separate file to test importing functionality.
+
+    import random
+    import tempfile
+
+    from testing import unittest, do_tests
+
+    from duplex_link import FullDuplexLink
+    from frame import SimpleFrameTransmitter
+    from service_manager import Packet, packet_to_datagram
+
+    class Tests(object):
+        class TestCaptureTap(unittest.TestCase):
+            def setUp(self):
+                fd, self.file_name = tempfile.mkstemp(suffix=".pcap")
+                os.close(fd)
+
+            def tearDown(self):
+                os.remove(self.file_name)
+
+            def test_link(self):
+                tap = CaptureTap(self.file_name)
+                a, b = FullDuplexLink(capture=tap)
+                a.write("test")
+                b.write("12345")
+                self.assertEqual(b.read(), "test")
+                tap.close()
+
+                records = list(CaptureReader(self.file_name))
+                self.assertEqual(len(records), 2)
+                self.assertEqual(records[0].layer, CaptureLayer.link)
+                self.assertEqual(records[0].direction, 0)
+                self.assertEqual(records[0].data, "test")
+                self.assertEqual(records[1].direction, 1)
+                self.assertEqual(records[1].data, "12345")
+                self.assertLessEqual(records[0].time, records[1].time)
+
+            def test_ring(self):
+                size = pcap_header_size + 10 * (record_header_size + 10)
+                tap = CaptureTap(self.file_name, size=size)
+                for i in xrange(25):
+                    tap.record(CaptureLayer.link, 0, "{0:10}".format(i))
+                tap.close()
+
+                data = [int(r.data) for r in CaptureReader(self.file_name)]
+                self.assertGreater(len(data), 5)
+                self.assertEqual(data, range(25 - len(data), 25))
+
+            def test_ring_variable_size(self):
+                size = pcap_header_size + 600
+                for seed in xrange(50):
+                    rand = random.Random(seed)
+                    tap = CaptureTap(self.file_name, size=size)
+                    for i in xrange(200):
+                        tap.record(CaptureLayer.link, 0, "{0}:{1}".format(
+                            i, "x" * rand.randint(0, 60)))
+                    tap.close()
+
+                    ids = [int(r.data.split(":")[0])
+                        for r in CaptureReader(self.file_name)]
+                    self.assertGreater(len(ids), 3)
+                    self.assertEqual(ids, range(200 - len(ids), 200))
+
+            def test_snaplen(self):
+                tap = CaptureTap(self.file_name, snaplen=10)
+                tap.record(CaptureLayer.link, 0, "0123456789")
+                tap.close()
+
+                record, = CaptureReader(self.file_name)
+                self.assertEqual(record.data, "01234567")
+                self.assertEqual(record.orig_len, 10)
+
+            def test_export(self):
+                tap = CaptureTap(self.file_name)
+                tap.record(CaptureLayer.link, 1, "test")
+                tap.close()
+
+                fd, export_name = tempfile.mkstemp(suffix=".pcap")
+                os.close(fd)
+                CaptureReader(self.file_name).export(export_name)
+                self.assertEqual(os.path.getsize(export_name),
+                    pcap_header_size + record_header_size + 4)
+                self.assertEqual(list(CaptureReader(export_name)),
+                    list(CaptureReader(self.file_name)))
+                os.remove(export_name)
+
+            def test_export_plain_pcap(self):
+                def read_pcap(file_name):
+                    # Plain pcap reader: records follow each other up to
+                    # the end of file.
+                    with open(file_name, "rb") as f:
+                        data = f.read()
+                    header = struct.unpack_from(pcap_header_format, data, 0)
+                    self.assertEqual(header[0], pcap_magic)
+                    self.assertEqual(header[4], 0)
+                    snaplen = header[5]
+                    packets = []
+                    offset = pcap_header_size
+                    while offset < len(data):
+                        ts_sec, ts_usec, incl_len, orig_len = \
+                            struct.unpack_from('<IIII', data, offset)
+                        self.assertLessEqual(incl_len, snaplen)
+                        self.assertLessEqual(incl_len, orig_len)
+                        offset += struct.calcsize('<IIII')
+                        packets.append(data[offset:offset + incl_len])
+                        offset += incl_len
+                    self.assertEqual(offset, len(data))
+                    return packets
+
+                size = pcap_header_size + 10 * (record_header_size + 10)
+                tap = CaptureTap(self.file_name, size=size)
+                for i in xrange(25):
+                    tap.record(CaptureLayer.link, 0, "{0:10}".format(i))
+                tap.close()
+
+                fd, export_name = tempfile.mkstemp(suffix=".pcap")
+                os.close(fd)
+                CaptureReader(self.file_name).export(export_name)
+                packets = read_pcap(export_name)
+                os.remove(export_name)
+
+                # Packets start from the oldest record after wrap around.
+                data = [int(packet[pseudo_header_size:])
+                    for packet in packets]
+                self.assertGreater(len(data), 5)
+                self.assertEqual(data, range(25 - len(data), 25))
+
+            def test_decode(self):
+                tap = CaptureTap(self.file_name)
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a, capture=tap)
+                bt = SimpleFrameTransmitter(node=b)
+
+                packet = Packet(1, 2, "test", 1)
+                data = packet_to_datagram(packet, 3).serialize()
+                at.write_frame(Frame(type=FrameType.data, id=0,
+                    is_last=False, data=data[:10],
+                    datagram_size=len(data)).serialize())
+                at.write_frame(Frame(type=FrameType.data, id=1,
+                    is_last=True, data=data[10:]).serialize())
+                bt.write_frame(Frame(type=FrameType.ack, id=0).serialize())
+                at.read_frame()
+                tap.close()
+
+                decoded = [obj for record, obj in
+                    decode_records(CaptureReader(self.file_name))]
+                self.assertEqual(len(decoded), 4)
+                self.assertEqual(decoded[0].id, 0)
+                self.assertEqual(decoded[1].id, 1)
+                protocol, decoded_packet = decoded[2]
+                self.assertEqual(protocol, 3)
+                self.assertEqual(decoded_packet.data, "test")
+                self.assertEqual(decoded[3].type, FrameType.ack)
+
+            def test_shared_tap(self):
+                tap = CaptureTap(self.file_name)
+                a, b = FullDuplexLink(capture=tap)
+                at = SimpleFrameTransmitter(node=a, capture=tap,
+                    capture_end=0)
+                bt = SimpleFrameTransmitter(node=b, capture=tap,
+                    capture_end=1)
+
+                # Both link ends send datagram in frames with same ids.
+                for t, text in ((at, "from a"), (bt, "from b")):
+                    data = packet_to_datagram(Packet(1, 2, text, 1),
+                        3).serialize()
+                    t.write_frame(Frame(type=FrameType.data, id=0,
+                        is_last=False, data=data[:10],
+                        datagram_size=len(data)).serialize())
+                    t.write_frame(Frame(type=FrameType.data, id=1,
+                        is_last=True, data=data[10:]).serialize())
+                self.assertEqual(len(bt.read_frames()), 2)
+                self.assertEqual(len(at.read_frames()), 2)
+                tap.close()
+
+                decoded = [(record.direction, obj[1].data)
+                    for record, obj in
+                        decode_records(CaptureReader(self.file_name))
+                    if isinstance(obj, tuple)]
+                # Frames are recorded when written and when read, but each
+                # datagram is decoded once.
+                self.assertEqual(decoded, [(0, "from a"), (1, "from b")])
+
+            def test_decode_streams(self):
+                tap = CaptureTap(self.file_name)
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a, capture=tap)
+
+                data1 = packet_to_datagram(Packet(1, 2, "first", 1),
+                    3).serialize()
+                data2 = packet_to_datagram(Packet(1, 2, "second", 1),
+                    4).serialize()
+                frames = {
+                    0: Frame(type=FrameType.data, id=0, stream=1,
+                        is_last=False, data=data1[:10],
+                        datagram_size=len(data1)),
+                    1: Frame(type=FrameType.data, id=1, stream=2,
+                        is_last=False, data=data2[:10],
+                        datagram_size=len(data2)),
+                    2: Frame(type=FrameType.data, id=2, stream=1,
+                        is_last=True, data=data1[10:]),
+                    3: Frame(type=FrameType.data, id=3, stream=2,
+                        is_last=True, data=data2[10:]),
+                    4: Frame(type=FrameType.data, id=4, stream=2,
+                        is_last=False, data="abc", is_chunked=True),
+                    5: Frame(type=FrameType.data, id=5, stream=2,
+                        is_last=True, data="def"),
+                    }
+                # Frames are captured out of order, frame 1 is
+                # retransmitted.
+                for frame_id in [0, 3, 1, 4, 1, 2, 5]:
+                    at.write_frame(frames[frame_id].serialize())
+                tap.close()
+
+                decoded = [(record, obj) for record, obj in
+                    decode_records(CaptureReader(self.file_name))
+                    if not isinstance(obj, Frame)]
+                self.assertEqual(len(decoded), 3)
+                (record1, (protocol1, packet1)), \
+                    (record2, (protocol2, packet2)), \
+                    (record3, message) = decoded
+                # Both datagrams are reassembled when frame 2 is received:
+                # until then it's unknown whether it belongs to the second
+                # datagram.
+                self.assertEqual(Frame.deserialize(record1.data).id, 2)
+                self.assertEqual((protocol1, packet1.data), (3, "first"))
+                self.assertTrue(record2 is record1)
+                self.assertEqual((protocol2, packet2.data), (4, "second"))
+                self.assertEqual(Frame.deserialize(record3.data).id, 5)
+                self.assertEqual(message, "abcdef")
+
+    do_tests(Tests)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        _dump(sys.argv[1])
+    else:
+        _test()
+
+# vim: set ts=4 sw=4 et:
@@ -21,7 +21,18 @@ __license__ = "GPL"
 default_log_format = "%(asctime)-15s %(levelname)-8s %(name)-30s %(message)s"
 
 thread_sleep_time = 0.1
+# Polling interval of FrameTransmitterWorker for links which can't notify
+# about received data (e.g. shared memory written from other process).
 frame_transmitter_thread_sleep_time = 0.04
+# Number of working threads in sliding_window.worker pool.
+frame_transmitter_workers_count = 4
+# High water marks of send queue (in frames) and received datagrams queue of
+# FrameTransmitter's of links between routers.
+frame_transmitter_send_high_water = 1000
+frame_transmitter_receive_high_water = 100
+# Protocols of datagrams sent in separate logical stream of links between
+# routers, so that they are not delayed by bulk data transfers (RIP).
+frame_transmitter_control_protocols = (520,)
 use_openGL = False
 packets_delivery_time_factor = 10
 
@@ -28,6 +28,7 @@ import itertools
 import time
 import heapq
 import Queue
+from collections import deque
 
 from recordtype import recordtype
 
@@ -52,7 +53,7 @@ class ControllableFrameTransmitter(FrameTransmitter):
         #self._id_it = itertools.count(0)
 
         self._transmitting_heap = []
-        self._delivered_frames_queue = []
+        self._delivered_frames_queue = deque()
 
         # Tuples (local packet id, start transmit time (in seconds),
         # end transmit time (in seconds), protocol, packet).
@@ -72,7 +73,7 @@ class ControllableFrameTransmitter(FrameTransmitter):
                 "{1}".format(heap_item.id, str(heap_item.packet)))
             self.send_receive_queue.put((heap_item.id, False))
         self._transmitting_heap = []
-        self._delivered_frames_queue = []
+        self._delivered_frames_queue = deque()
         super(ControllableFrameTransmitter, self)._link_down()
         
     def _non_blocking_receive(self):
@@ -99,9 +100,17 @@ class ControllableFrameTransmitter(FrameTransmitter):
             else:
                 break
 
-        # Check for actual received packets.
-        raw_datagram = \
-            super(ControllableFrameTransmitter, self).receive(block=False)
+        # Check for actual received packets. Deferred and delivered
+        # datagrams are counted in received datagrams queue: while there are
+        # `receive_high_water' of them, received datagrams are left in
+        # FrameTransmitter, which stops delivery of received frames.
+        raw_datagram = None
+        if (self._receive_high_water is None or
+                len(self._transmitting_heap) +
+                    len(self._delivered_frames_queue) <
+                        self._receive_high_water):
+            raw_datagram = \
+                super(ControllableFrameTransmitter, self).receive(block=False)
         if raw_datagram is not None:
             # Try to decode frame as packet.
 
@@ -142,7 +151,7 @@ class ControllableFrameTransmitter(FrameTransmitter):
                 self._delivered_frames_queue.append(raw_datagram)
 
         if self._delivered_frames_queue:
-            return self._delivered_frames_queue.pop(0)
+            return self._delivered_frames_queue.popleft()
         else:
             return None
 
@@ -252,6 +261,36 @@ def _test(level=None, timeout=None):
                 self.assertEqual(self.bft.receive(), datagram.serialize())
                 self.assertEqual(self.bft.receive(block=False), None)
 
+            def test_receive_high_water(self):
+                a, b = FullDuplexLink()
+                aft = ControllableFrameTransmitter(
+                    src_name=1, dest_name=2,
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=a),
+                    debug_src=1, debug_dest=2)
+                bft = ControllableFrameTransmitter(
+                    src_name=2, dest_name=1,
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=b),
+                    receive_high_water=2, debug_src=2, debug_dest=1)
+
+                saved_factor = config.packets_delivery_time_factor
+                # Received packets are deferred.
+                config.packets_delivery_time_factor = 1e6
+                try:
+                    datagram = packet_to_datagram(Packet(1, 2, "test", 1),
+                        100).serialize()
+                    for i in xrange(5):
+                        aft.send(datagram)
+                    time.sleep(0.5)
+                    for i in xrange(5):
+                        self.assertEqual(bft.receive(block=False), None)
+                        time.sleep(0.1)
+                    # The rest datagrams are left in FrameTransmitter.
+                    self.assertEqual(len(bft._transmitting_heap), 2)
+                finally:
+                    config.packets_delivery_time_factor = saved_factor
+                    aft.terminate()
+                    bft.terminate()
+
             # TODO: Test signals.
 
     do_tests(Tests, level=level, qt=True)
@@ -127,6 +127,10 @@ def datagram(type, src, dest, data):
     return Datagram(type=type, src=src, dest=dest, data=data)
 
 class DatagramRouter(object):
+    # Logical streams of FrameTransmitter's between routers.
+    data_stream    = 0
+    control_stream = 1
+
     def __init__(self, *args, **kwargs):
         self._router_name       = kwargs.pop('router_name')
         self._link_manager      = kwargs.pop('link_manager')
@@ -204,8 +208,20 @@ class DatagramRouter(object):
                     datagram.time = time.time()
                     #print Datagram.deserialize(datagram.serialize()).time - datagram.time # DEBUG
                     #assert Datagram.deserialize(datagram.serialize()).time == datagram.time # DEBUG
-                    connected_routers[next_router].send(
-                        datagram.serialize())
+                    if datagram.type in \
+                            config.frame_transmitter_control_protocols:
+                        stream = DatagramRouter.control_stream
+                    else:
+                        stream = DatagramRouter.data_stream
+                    if not connected_routers[next_router].send(
+                            datagram.serialize(), stream=stream,
+                            block=False):
+                        # Send queue of link is full. Drop datagram
+                        # instead of blocking all links.
+                        self._logger.warning(
+                            "Send queue to {0} is full, datagram "
+                            "dropped:\n  {1}".format(
+                                next_router, str(datagram)))
                 else:
                     # Next host is unreachable. Destroy datagram.
                     self._logger.warning(
@@ -18,129 +18,800 @@
 __author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
 __license__ = "GPL"
 
-__all__ = ["ReceivingNode", "SendingNode", "FullDuplexNode", 
-    "FullDuplexLink", "LossFunc"]
+__all__ = ["ChannelListeners", "ByteChannel", "DescriptorChannel",
+    "SharedMemoryChannel", "ShapedChannel", "link_backends", "ReceivingNode", "SendingNode",
+    "FullDuplexNode", "FullDuplexLink", "BaseLossFunc", "LossFunc"]
 
 """Byte channel implementation.
 """
 
-import Queue
 import bisect
+import copy
+import errno
+import os
 import random
-import StringIO
+import select
+import socket
+import threading
+import time
+import multiprocessing
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    # Losses will be applied character by character.
+    numpy = None
 
 # TODO: Maybe loss function will loose bits, not bytes?
 # TODO: Maybe rename `node_a'/`node_b'? `Source' and `destination' are not
 # really good due to symmetric relation between link ends.
 
+class ChannelListeners(object):
+    """Channel mixin which calls registered listeners after data is written
+    into channel.
+    """
+
+    # True if writes from other processes are not reported to listeners and
+    # channel can't be waited with `select()', so reader should poll it.
+    polled = False
+
+    def __init__(self, *args, **kwargs):
+        super(ChannelListeners, self).__init__(*args, **kwargs)
+        # Tuple is replaced on change, so it can be iterated without lock.
+        self._listeners = ()
+
+    def add_listener(self, listener):
+        """Registers callable `listener' which is called without arguments
+        from writing thread after data is written into channel.
+        """
+        self._listeners += (listener,)
+
+    def remove_listener(self, listener):
+        listeners = list(self._listeners)
+        listeners.remove(listener)
+        self._listeners = tuple(listeners)
+
+    def _notify_listeners(self):
+        for listener in self._listeners:
+            listener()
+
+class ByteChannel(ChannelListeners):
+    """Unidirectional byte channel.
+    Bytes are stored in ring buffer which grows when written data doesn't fit
+    in it, so writing never blocks.
+    After `close()' (link goes down) writing and reading from empty channel
+    raise IOError, as with closed pipe.
+    """
+
+    def __init__(self, capacity=4096):
+        super(ByteChannel, self).__init__()
+        assert capacity > 0
+
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        # Index of first unread byte in buffer.
+        self._start = 0
+        # Number of unread bytes in buffer.
+        self._size = 0
+
+        self._not_empty = threading.Condition(threading.Lock())
+        self._closed = False
+
+    def __len__(self):
+        """Returns number of bytes available for reading."""
+        return self._size
+
+    def _grow(self, min_capacity):
+        capacity = len(self._buffer)
+        while capacity < min_capacity:
+            capacity *= 2
+
+        new_buffer = bytearray(capacity)
+        size = self._size
+        self._copy_out(memoryview(new_buffer), size)
+
+        self._buffer = new_buffer
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._size = size
+
+    def _copy_out(self, dest, size):
+        """Moves `size' bytes from the head of ring buffer into `dest'."""
+        assert size <= self._size
+
+        capacity = len(self._buffer)
+        first = min(size, capacity - self._start)
+        dest[:first] = self._view[self._start:self._start + first]
+        if first < size:
+            dest[first:size] = self._view[:size - first]
+
+        self._start = (self._start + size) % capacity
+        self._size -= size
+
+    def _wait(self, size):
+        """Waits until at least `size' bytes will be available.
+        Must be called with acquired lock.
+        """
+        while self._size < size:
+            self._check_closed()
+            self._not_empty.wait()
+
+    def _check_closed(self):
+        if self._closed:
+            raise IOError(errno.EPIPE, "Channel is closed")
+
+    def close(self):
+        with self._not_empty:
+            self._closed = True
+            self._not_empty.notify_all()
+        self._notify_listeners()
+
+    def write(self, data):
+        """Appends whole buffer `data' to the channel."""
+        size = len(data)
+        if size == 0:
+            return
+
+        data = memoryview(data)
+        with self._not_empty:
+            self._check_closed()
+            if self._size + size > len(self._buffer):
+                self._grow(self._size + size)
+
+            capacity = len(self._buffer)
+            end = (self._start + self._size) % capacity
+            first = min(size, capacity - end)
+            self._view[end:end + first] = data[:first]
+            if first < size:
+                self._view[:size - first] = data[first:]
+            self._size += size
+
+            self._not_empty.notify()
+
+        self._notify_listeners()
+
+    def read(self, size=0, block=True):
+        """Read bytes from channel.
+        If `size' equal to zero it reads all available in channel bytes.
+        Assumed that this function is the only reader from channel.
+
+        Otherwise if `block' is True it reads exactly `size' bytes.
+        If `block' is False it reads not more that `size' bytes depending
+        on how much is currently available in channel.
+        """
+
+        assert size >= 0
+
+        with self._not_empty:
+            if size > 0 and block:
+                self._wait(size)
+            elif self._size == 0:
+                self._check_closed()
+
+            read_size = self._size if size == 0 else min(size, self._size)
+            data = bytearray(read_size)
+            self._copy_out(memoryview(data), read_size)
+
+        return str(data)
+
+    def read_into(self, buffer, block=True):
+        """Read available bytes from channel into `buffer'.
+        Reads not more than `len(buffer)' bytes. If `block' is True waits
+        until at least one byte will be available.
+        Returns number of read bytes.
+        """
+
+        if len(buffer) == 0:
+            return 0
+
+        with self._not_empty:
+            if block:
+                self._wait(1)
+            elif self._size == 0:
+                self._check_closed()
+
+            read_size = min(len(buffer), self._size)
+            self._copy_out(memoryview(buffer), read_size)
+
+        return read_size
+
+class DescriptorChannel(ChannelListeners):
+    """Unidirectional byte channel over pair of file descriptors, e.g. ends
+    of `os.pipe()' or sockets from `socket.socketpair()'.
+    Both ends may be used from different processes.
+
+    Writing blocks while operating system buffer is full, so reader should
+    not be blocked on the writer.
+    """
+
+    def __init__(self, read_end, write_end):
+        super(DescriptorChannel, self).__init__()
+
+        # Store ends to keep underlying objects (e.g. sockets) alive.
+        self._read_end = read_end
+        self._write_end = write_end
+
+        self._read_fd = self._fileno(read_end)
+        self._write_fd = self._fileno(write_end)
+
+    @staticmethod
+    def _fileno(end):
+        return end if isinstance(end, (int, long)) else end.fileno()
+
+    def fileno(self):
+        """Returns descriptor which becomes readable when data arrives."""
+        return self._read_fd
+
+    def close(self):
+        for end in (self._read_end, self._write_end):
+            if isinstance(end, (int, long)):
+                try:
+                    os.close(end)
+                except OSError:
+                    pass
+            else:
+                end.close()
+
+    def _readable(self):
+        return bool(select.select([self._read_fd], [], [], 0)[0])
+
+    def write(self, data):
+        """Writes whole buffer `data' to the channel."""
+        data = memoryview(data)
+        while len(data) > 0:
+            written = os.write(self._write_fd, data)
+            data = data[written:]
+
+        self._notify_listeners()
+
+    def read(self, size=0, block=True):
+        """Read bytes from channel.
+        See `ByteChannel.read()' for arguments description.
+        """
+
+        assert size >= 0
+
+        chunks = []
+        remaining = size
+        while size == 0 or remaining > 0:
+            if not ((block and size > 0) or self._readable()):
+                break
+
+            chunk = os.read(self._read_fd,
+                remaining if size > 0 else self.read_chunk_size)
+            if not chunk:
+                # Write end closed.
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+
+        return "".join(chunks)
+
+    def read_into(self, buffer, block=True):
+        """Read available bytes from channel into `buffer'.
+        See `ByteChannel.read_into()' for arguments description.
+        """
+
+        if len(buffer) == 0 or not (block or self._readable()):
+            return 0
+
+        chunk = os.read(self._read_fd, len(buffer))
+        memoryview(buffer)[:len(chunk)] = chunk
+        return len(chunk)
+
+    read_chunk_size = 65536
+
+class SharedMemoryChannel(ChannelListeners):
+    """Unidirectional byte channel over fixed size ring buffer in shared
+    memory. Both ends may be used from different processes created with
+    `multiprocessing'.
+
+    Writing blocks while ring buffer is full.
+    """
+
+    # Only writes from current process are reported to listeners.
+    polled = True
+
+    def __init__(self, capacity=65536):
+        super(SharedMemoryChannel, self).__init__()
+        assert capacity > 0
+
+        self._buffer = multiprocessing.RawArray('c', capacity)
+        self._capacity = capacity
+        self._start = multiprocessing.RawValue('L', 0)
+        self._size = multiprocessing.RawValue('L', 0)
+
+        # Notified when bytes written or read.
+        self._changed = multiprocessing.Condition()
+
+    def __len__(self):
+        """Returns number of bytes available for reading."""
+        return self._size.value
+
+    def _copy_in(self, data):
+        """Appends `data' to the tail of ring buffer.
+        Must be called with acquired lock.
+        """
+        size = len(data)
+        assert self._size.value + size <= self._capacity
+
+        end = (self._start.value + self._size.value) % self._capacity
+        first = min(size, self._capacity - end)
+        self._buffer[end:end + first] = data[:first]
+        if first < size:
+            self._buffer[:size - first] = data[first:]
+        self._size.value += size
+
+    def _copy_out(self, size):
+        """Removes `size' bytes from the head of ring buffer and returns them.
+        Must be called with acquired lock.
+        """
+        assert size <= self._size.value
+
+        start = self._start.value
+        first = min(size, self._capacity - start)
+        data = self._buffer[start:start + first]
+        if first < size:
+            data += self._buffer[:size - first]
+        self._start.value = (start + size) % self._capacity
+        self._size.value -= size
+
+        return data
+
+    def write(self, data):
+        """Writes whole buffer `data' to the channel."""
+        data = str(data)
+        while data:
+            with self._changed:
+                while self._size.value == self._capacity:
+                    self._changed.wait()
+
+                chunk_size = min(len(data),
+                    self._capacity - self._size.value)
+                self._copy_in(data[:chunk_size])
+                data = data[chunk_size:]
+
+                self._changed.notify_all()
+
+        self._notify_listeners()
+
+    def read(self, size=0, block=True):
+        """Read bytes from channel.
+        See `ByteChannel.read()' for arguments description.
+        """
+
+        assert size >= 0
+
+        chunks = []
+        remaining = size
+        with self._changed:
+            while True:
+                if size > 0 and block:
+                    while self._size.value == 0:
+                        self._changed.wait()
+
+                read_size = self._size.value if size == 0 else \
+                    min(remaining, self._size.value)
+                chunks.append(self._copy_out(read_size))
+                remaining -= read_size
+                self._changed.notify_all()
+
+                if not (size > 0 and block and remaining > 0):
+                    break
+
+        return "".join(chunks)
+
+    def read_into(self, buffer, block=True):
+        """Read available bytes from channel into `buffer'.
+        See `ByteChannel.read_into()' for arguments description.
+        """
+
+        if len(buffer) == 0:
+            return 0
+
+        with self._changed:
+            if block:
+                while self._size.value == 0:
+                    self._changed.wait()
+
+            data = self._copy_out(min(len(buffer), self._size.value))
+            self._changed.notify_all()
+
+        memoryview(buffer)[:len(data)] = data
+        return len(data)
+
+class ShapedChannel(object):
+    """Wrapper around channel which limits its bandwidth and delays delivery
+    of written bytes.
+
+    Written data departs according to token bucket with rate `bandwidth'
+    (bytes per second) and bucket size `burst' (bytes), and arrives into
+    underlying channel `delay' seconds after departure.
+    Data is delivered by thread started on the first write, `terminate()'
+    stops it.
+    """
+
+    def __init__(self, channel, bandwidth=None, delay=0, burst=0):
+        super(ShapedChannel, self).__init__()
+        assert bandwidth is None or bandwidth > 0
+        assert delay >= 0
+        assert burst >= 0
+
+        self._channel = channel
+        self._bandwidth = bandwidth
+        self._delay = delay
+        self._burst = burst
+
+        self._tokens = burst
+        self._tokens_time = time.time()
+
+        # Queue of tuples (delivery time, data) ordered by delivery time.
+        self._delivery_queue = deque()
+        self._delivery_queue_changed = threading.Condition(threading.Lock())
+        self._delivery_thread = None
+        self._terminated = False
+
+    @property
+    def bandwidth(self):
+        return self._bandwidth
+
+    @property
+    def delay(self):
+        return self._delay
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    def _departure_time(self, size, curtime):
+        """Takes `size' tokens from bucket and returns time when last of
+        `size' bytes will be transmitted.
+        """
+        if self._bandwidth is None:
+            return curtime
+
+        # Fill bucket. Negative amount of tokens means that previously written
+        # bytes are still not transmitted.
+        self._tokens = min(self._burst, self._tokens +
+            (curtime - self._tokens_time) * self._bandwidth)
+        self._tokens_time = curtime
+
+        self._tokens -= size
+        if self._tokens >= 0:
+            return curtime
+        else:
+            return curtime - self._tokens / float(self._bandwidth)
+
+    def write(self, data):
+        """Writes whole buffer `data' to the channel. Doesn't block."""
+        if len(data) == 0:
+            return
+
+        data = str(data)
+        with self._delivery_queue_changed:
+            if self._terminated:
+                return
+
+            curtime = time.time()
+            delivery_time = \
+                self._departure_time(len(data), curtime) + self._delay
+
+            # Departure times are nondecreasing, so queue remains ordered.
+            self._delivery_queue.append((delivery_time, data))
+            self._delivery_queue_changed.notify()
+
+            if self._delivery_thread is None:
+                self._delivery_thread = threading.Thread(target=self._deliver)
+                self._delivery_thread.daemon = True
+                self._delivery_thread.start()
+
+    def terminate(self):
+        """Stops delivery thread, not delivered data is dropped."""
+        with self._delivery_queue_changed:
+            self._terminated = True
+            self._delivery_queue.clear()
+            self._delivery_queue_changed.notify()
+            thread = self._delivery_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _deliver(self):
+        while True:
+            with self._delivery_queue_changed:
+                # Wait until delivery time of queue head. New data can't be
+                # delivered earlier than queue head.
+                while True:
+                    if self._terminated:
+                        return
+                    wait_time = None
+                    if self._delivery_queue:
+                        wait_time = self._delivery_queue[0][0] - time.time()
+                        if wait_time <= 0:
+                            break
+                    self._delivery_queue_changed.wait(wait_time)
+
+                # Deliver all data which delivery time reached.
+                chunks = []
+                curtime = time.time()
+                while (self._delivery_queue and
+                        self._delivery_queue[0][0] <= curtime):
+                    chunks.append(self._delivery_queue.popleft()[1])
+            self._channel.write("".join(chunks))
+
+    def read(self, size=0, block=True):
+        return self._channel.read(size, block)
+
+    def read_into(self, buffer, block=True):
+        return self._channel.read_into(buffer, block)
+
+def memory_channels():
+    return ByteChannel(), ByteChannel()
+
+def pipe_channels():
+    a_to_b_read, a_to_b_write = os.pipe()
+    b_to_a_read, b_to_a_write = os.pipe()
+    return (DescriptorChannel(a_to_b_read, a_to_b_write),
+        DescriptorChannel(b_to_a_read, b_to_a_write))
+
+def socket_channels():
+    # Single connected pair of sockets serves both directions.
+    socket_a, socket_b = socket.socketpair()
+    return (DescriptorChannel(socket_b, socket_a),
+        DescriptorChannel(socket_a, socket_b))
+
+def shared_memory_channels():
+    return SharedMemoryChannel(), SharedMemoryChannel()
+
+# Functions that create pair of channels (a->b, b->a) for link backend.
+link_backends = {
+    'memory':        memory_channels,
+    'pipe':          pipe_channels,
+    'socket':        socket_channels,
+    'shared_memory': shared_memory_channels,
+    }
+
 class SendingNode(object):
     def __init__(self, **kwds):
-        self.send_queue = kwds.pop('send_queue')
+        self.send_channel = kwds.pop('send_channel')
+        # Optional capture.CaptureTap for written bytes.
+        self._capture = kwds.pop('capture', None)
+        self._capture_direction = kwds.pop('capture_direction', 0)
         super(SendingNode, self).__init__(**kwds)
 
-    def _write_ch(self, ch):
-        assert isinstance(ch, str)
-        assert len(ch) == 1
-        self.send_queue.put(ch)
+    def _write(self, string):
+        if self._capture is not None:
+            # Link layer.
+            self._capture.record(0, self._capture_direction, string)
+        self.send_channel.write(string)
 
     def write(self, string):
-        assert isinstance(string, str)
-        for ch in string:
-            self._write_ch(ch)
+        assert isinstance(string, (str, bytearray))
+        self._write(string)
+
+    def terminate(self):
+        """Stops delivery thread of output channel if it is shaped."""
+        terminate = getattr(self.send_channel, 'terminate', None)
+        if terminate is not None:
+            terminate()
 
 class ReceivingNode(object):
     def __init__(self, **kwds):
-        self.receive_queue = kwds.pop('receive_queue')
+        self.receive_channel = kwds.pop('receive_channel')
         super(ReceivingNode, self).__init__(**kwds)
 
     def read(self, size=0, block=True):
-        """Read bytes from input queue.
-        If `size' equal to zero it reads all available in queue characters.
-        Assumed that this function is the only reader from queue.
+        """Read bytes from input channel.
+        See `ByteChannel.read()' for arguments description.
+        """
 
-        Otherwise if `block' is True it reads exactly `size' elements.
-        If `block' is False it reads not more that `size' elements depending
-        on how much is currently available in queue.
+        return self.receive_channel.read(size, block)
+
+    def read_into(self, buffer, block=True):
+        """Read available bytes from input channel into `buffer'.
+        See `ByteChannel.read_into()' for arguments description.
         """
 
-        assert size >= 0
+        return self.receive_channel.read_into(buffer, block)
 
-        in_str = StringIO.StringIO()
+    def add_read_listener(self, listener):
+        """Registers `listener' called when data is written into input
+        channel. See `ChannelListeners.add_listener()'.
+        """
+        self.receive_channel.add_listener(listener)
 
-        while size == 0 or len(in_str.getvalue()) < size:
-            try:
-                in_str.write(self.receive_queue.get(block and (size > 0)))
-            except Queue.Empty:
-                break
+    def remove_read_listener(self, listener):
+        self.receive_channel.remove_listener(listener)
 
-        return in_str.getvalue()
+    def read_fds(self):
+        """Returns list of descriptors which become readable when data
+        arrives into input channel.
+        """
+        fileno = getattr(self.receive_channel, 'fileno', None)
+        return [fileno()] if fileno is not None else []
+
+    @property
+    def is_polled(self):
+        """True if input channel should be polled for data written by other
+        processes.
+        """
+        return self.receive_channel.polled
 
 # TODO: May be not "loss" but "noise"?
-class LossFunc(object):
-    def __init__(self, skip_ch_prob, modify_ch_prob, new_ch_prob):
-        super(LossFunc, self).__init__()
-        self.configure(skip_ch_prob, modify_ch_prob, new_ch_prob)
+class BaseLossFunc(object):
+    """Base class for loss functions.
+    Subclasses select modification for each character in `_choice()' and
+    for whole buffer in `_choices()' (when NumPy is available).
+    """
 
-    def configure(self, skip_ch_prob, modify_ch_prob, new_ch_prob):
-        assert 0 <= skip_ch_prob <= 1
-        assert 0 <= modify_ch_prob <= 1
-        assert 0 <= new_ch_prob <= 1
-        assert 0 <= skip_ch_prob + modify_ch_prob + new_ch_prob <= 1
+    # Modifications selected for character.
+    skip_ch   = 1
+    modify_ch = 2
+    new_ch    = 3
+    keep_ch   = 4
 
-        # Construct array so that by finding upper bound of random number in it
-        # will be possible to select random modification.
-        self._selection_array = [0, skip_ch_prob, modify_ch_prob, new_ch_prob]
-        for i, v in enumerate(self._selection_array[1:]):
-            self._selection_array[i + 1] = self._selection_array[i] + v
-        self._selection_array.append(1)
+    def __init__(self, seed=None):
+        super(BaseLossFunc, self).__init__()
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Reset random generators, so that same seed produces same losses.
+        """
+        self._random = random.Random(seed)
+        if numpy is not None:
+            self._numpy_random = numpy.random.RandomState(
+                self._random.randint(0, 2**32 - 1))
+
+    def spawn(self):
+        """Returns copy of loss function with independent random generator
+        seeded from this one.
+        """
+        loss_func = copy.copy(self)
+        loss_func.seed(self._random.randint(0, 2**32 - 1))
+        return loss_func
+
+    def _choice(self):
+        """Returns modification selected for next character."""
+        raise NotImplementedError()
+
+    def _choices(self, size):
+        """Returns NumPy array of modifications selected for next `size'
+        characters.
+        """
+        raise NotImplementedError()
 
     def __call__(self, ch):
         """Takes single character and returns transformed string."""
-        choice = bisect.bisect_right(self._selection_array, random.random())
+        choice = self._choice()
 
-        random_ch = lambda: chr(random.randint(0, 255))
+        random_ch = lambda: chr(self._random.randint(0, 255))
 
-        if choice == 1:
+        if choice == BaseLossFunc.skip_ch:
             # Skip character.
             return ""
-        elif choice == 2:
+        elif choice == BaseLossFunc.modify_ch:
             # Modify character.
             return random_ch()
-        elif choice == 3:
+        elif choice == BaseLossFunc.new_ch:
             # Append new character.
             return ch + random_ch()
         else:
-            assert choice == 4
+            assert choice == BaseLossFunc.keep_ch
             # Don't modify character.
             return ch
 
+    def apply(self, string):
+        """Takes whole string and returns transformed string.
+        Equivalent to calling loss function on each character, but
+        modifications for all characters are selected at once.
+        """
+
+        if numpy is None:
+            return "".join(map(self, str(string)))
+
+        size = len(string)
+        if size == 0:
+            return ""
+
+        choices = self._choices(size)
+        if (choices == BaseLossFunc.keep_ch).all():
+            return str(string)
+
+        data = numpy.frombuffer(string, dtype=numpy.uint8)
+
+        modify = choices == BaseLossFunc.modify_ch
+        if modify.any():
+            data = data.copy()
+            data[modify] = self._numpy_random.randint(0, 256,
+                modify.sum()).astype(numpy.uint8)
+
+        # Skipped characters repeated zero times, appended characters
+        # are placeholders after original character.
+        counts = numpy.ones(size, dtype=numpy.intp)
+        counts[choices == BaseLossFunc.skip_ch] = 0
+        new = choices == BaseLossFunc.new_ch
+        counts[new] = 2
+        result = numpy.repeat(data, counts)
+
+        if new.any():
+            new_positions = numpy.cumsum(counts)[new] - 1
+            result[new_positions] = self._numpy_random.randint(0, 256,
+                len(new_positions)).astype(numpy.uint8)
+
+        return result.tostring()
+
+class LossFunc(BaseLossFunc):
+    """Independent losses of each character."""
+
+    def __init__(self, skip_ch_prob, modify_ch_prob, new_ch_prob, seed=None):
+        self.configure(skip_ch_prob, modify_ch_prob, new_ch_prob)
+        super(LossFunc, self).__init__(seed)
+
+    def configure(self, skip_ch_prob, modify_ch_prob, new_ch_prob):
+        assert 0 <= skip_ch_prob <= 1
+        assert 0 <= modify_ch_prob <= 1
+        assert 0 <= new_ch_prob <= 1
+        assert 0 <= skip_ch_prob + modify_ch_prob + new_ch_prob <= 1
+
+        # Construct array so that by finding upper bound of random number in it
+        # will be possible to select random modification.
+        self._selection_array = [0, skip_ch_prob, modify_ch_prob, new_ch_prob]
+        for i, v in enumerate(self._selection_array[1:]):
+            self._selection_array[i + 1] = self._selection_array[i] + v
+        self._selection_array.append(1)
+
+    def _choice(self):
+        return bisect.bisect_right(self._selection_array,
+            self._random.random())
+
+    def _choices(self, size):
+        return numpy.searchsorted(self._selection_array,
+            self._numpy_random.random_sample(size), side='right')
+
 class SendingWithLossNode(SendingNode):
     def __init__(self, **kwds):
+        # If loss function is not specified, link is lossless.
         self._loss_func = kwds.pop('loss_func', None)
-        if self._loss_func is None:
-            self._loss_func = LossFunc(0, 0, 0)
         super(SendingWithLossNode, self).__init__(**kwds)
 
-    def _write_ch(self, ch):
-        for new_ch in self._loss_func(ch):
-            super(SendingWithLossNode, self)._write_ch(new_ch)
+    def _write(self, string):
+        if self._loss_func is not None:
+            string = self._loss_func.apply(string)
+        super(SendingWithLossNode, self)._write(string)
 
 class FullDuplexNode(SendingWithLossNode, ReceivingNode):
     def __init__(self, **kwds):
         super(FullDuplexNode, self).__init__(**kwds)
 
-def FullDuplexLink(a_to_b_queue=None, b_to_a_queue=None, loss_func=None):
-    queue1 = a_to_b_queue if a_to_b_queue is not None else Queue.Queue()
-    queue2 = b_to_a_queue if b_to_a_queue is not None else Queue.Queue()
+def FullDuplexLink(a_to_b_channel=None, b_to_a_channel=None, loss_func=None,
+        backend='memory', bandwidth=None, delay=0, capture=None):
+    """Creates pair of connected nodes.
+    `bandwidth' (bytes per second) and `delay' (seconds) describe each
+    direction of link.
+    If `capture' is specified, bytes transmitted in both directions are
+    recorded into it.
+    """
+
+    if a_to_b_channel is None or b_to_a_channel is None:
+        backend_channels = link_backends[backend]()
+    channel1 = a_to_b_channel if a_to_b_channel is not None else \
+        backend_channels[0]
+    channel2 = b_to_a_channel if b_to_a_channel is not None else \
+        backend_channels[1]
+
+    if bandwidth is not None or delay > 0:
+        channel1 = ShapedChannel(channel1, bandwidth=bandwidth, delay=delay)
+        channel2 = ShapedChannel(channel2, bandwidth=bandwidth, delay=delay)
 
     node_a = FullDuplexNode(
-        send_queue   =queue1,
-        receive_queue=queue2,
-        loss_func=loss_func)
+        send_channel   =channel1,
+        receive_channel=channel2,
+        loss_func=loss_func,
+        capture=capture, capture_direction=0)
     node_b = FullDuplexNode(
-        send_queue   =queue2,
-        receive_queue=queue1,
-        loss_func=loss_func)
+        send_channel   =channel2,
+        receive_channel=channel1,
+        loss_func=loss_func.spawn() if loss_func is not None else None,
+        capture=capture, capture_direction=1)
     return node_a, node_b
 # --- cut here in report ---
 
@@ -156,19 +827,146 @@ def _test():
 
     class Tests(object):
         class TestDuplexLink(unittest.TestCase):
+            def links(self):
+                for backend in sorted(link_backends.iterkeys()):
+                    yield FullDuplexLink(backend=backend)
+
             def test_link(self):
+                for a, b in self.links():
+                    self.assertEqual(a.read(), "")
+                    a.write("test")
+                    self.assertEqual(b.read(4), "test")
+                    b.write("1234")
+                    self.assertEqual(a.read(2), "12")
+                    self.assertEqual(a.read(2), "34")
+                    a.write("789")
+                    a.write("098")
+                    self.assertEqual(b.read(6), "789098")
+                    self.assertEqual(b.read(), "")
+
+            def test_read_all(self):
                 a, b = FullDuplexLink()
 
+                b.write("1234")
+                self.assertEqual(a.read(), "1234")
                 self.assertEqual(a.read(), "")
+
+            def test_read_into(self):
+                for a, b in self.links():
+                    buf = bytearray(4)
+                    self.assertEqual(b.read_into(buf, block=False), 0)
+                    a.write("123456")
+                    self.assertEqual(b.read_into(buf), 4)
+                    self.assertEqual(str(buf), "1234")
+                    self.assertEqual(b.read_into(buf), 2)
+                    self.assertEqual(str(buf[:2]), "56")
+                    self.assertEqual(b.read_into(buf, block=False), 0)
+
+            def test_blocking_read(self):
+                for a, b in self.links():
+                    def writer():
+                        for ch in "abcdef":
+                            a.write(ch)
+                    t = threading.Thread(target=writer)
+                    t.start()
+                    self.assertEqual(b.read(6), "abcdef")
+                    t.join()
+
+            def test_processes(self):
+                for backend in ['pipe', 'socket', 'shared_memory']:
+                    a, b = FullDuplexLink(backend=backend)
+
+                    def echo():
+                        b.write(b.read(5)[::-1])
+                    p = multiprocessing.Process(target=echo)
+                    p.start()
+                    a.write("hello")
+                    self.assertEqual(a.read(5), "olleh")
+                    p.join()
+
+        class TestByteChannel(unittest.TestCase):
+            def test_wrap_around(self):
+                c = ByteChannel(capacity=8)
+                c.write("12345")
+                self.assertEqual(c.read(4), "1234")
+                # Written data wraps around end of ring buffer.
+                c.write("6789ab")
+                self.assertEqual(len(c), 7)
+                self.assertEqual(c.read(), "56789ab")
+
+            def test_grow(self):
+                c = ByteChannel(capacity=4)
+                c.write("123")
+                self.assertEqual(c.read(2), "12")
+                data = "".join(map(chr, xrange(256))) * 10
+                c.write(data)
+                c.write(bytearray("end"))
+                self.assertEqual(c.read(), "3" + data + "end")
+
+            def test_close(self):
+                channel = ByteChannel()
+                channel.write("test")
+                channel.close()
+                self.assertRaises(IOError, channel.write, "x")
+                # Already written data can be read.
+                self.assertEqual(channel.read(2), "te")
+                self.assertEqual(channel.read(0), "st")
+                self.assertRaises(IOError, channel.read, 0)
+                self.assertRaises(IOError, channel.read, 1)
+
+        class TestShapedChannel(unittest.TestCase):
+            # TODO: Assume that computer is not very slow.
+
+            def test_delay(self):
+                a, b = FullDuplexLink(delay=0.2)
+
+                start = time.time()
                 a.write("test")
-                self.assertEqual(b.read(), "test")
-                b.write("1234")
-                self.assertEqual(a.read(2), "12")
-                self.assertEqual(a.read(), "34")
-                a.write("789")
-                a.write("098")
-                self.assertEqual(b.read(), "789098")
-                self.assertEqual(b.read(), "")
+                self.assertEqual(b.read(block=False), "")
+                self.assertEqual(b.read(4), "test")
+                self.assertGreaterEqual(time.time() - start, 0.2)
+                self.assertLess(time.time() - start, 0.4)
+
+            def test_bandwidth(self):
+                a, b = FullDuplexLink(bandwidth=10000)
+
+                start = time.time()
+                for i in xrange(10):
+                    a.write("x" * 200)
+                self.assertEqual(b.read(2000), "x" * 2000)
+                self.assertGreaterEqual(time.time() - start, 0.2)
+                self.assertLess(time.time() - start, 0.4)
+
+            def test_backend(self):
+                a, b = FullDuplexLink(backend='socket', bandwidth=1e6,
+                    delay=0.01)
+                a.write("test")
+                self.assertEqual(b.read(4), "test")
+
+            def test_terminate(self):
+                threads_count = threading.active_count()
+                a, b = FullDuplexLink(delay=10)
+                a.write("test")
+                b.write("test")
+                self.assertEqual(threading.active_count(), threads_count + 2)
+
+                a.terminate()
+                b.terminate()
+                self.assertEqual(threading.active_count(), threads_count)
+                # Data written after termination is dropped.
+                a.write("test")
+                self.assertEqual(b.read(block=False), "")
+
+        class TestSharedMemoryChannel(unittest.TestCase):
+            def test_overflow(self):
+                c = SharedMemoryChannel(capacity=8)
+                data = "".join(map(chr, xrange(256)))
+
+                # Writer blocks until reader frees space in ring buffer.
+                t = threading.Thread(target=lambda: c.write(data))
+                t.start()
+                self.assertEqual(c.read(len(data)), data)
+                t.join()
 
         class TestLossFunc(unittest.TestCase):
             def test_losses(self):
@@ -202,6 +1000,36 @@ def _test():
                 print "All:               '{0}'".format(result)
                 self.assertNotEqual(result, text)
 
+            def test_apply(self):
+                text = "".join(map(chr, xrange(256))) * 4
+
+                self.assertEqual(LossFunc(0, 0, 0).apply(text), text)
+                self.assertEqual(LossFunc(1, 0, 0).apply(text), "")
+
+                result = LossFunc(0, 1, 0).apply(text)
+                self.assertEqual(len(result), len(text))
+
+                result = LossFunc(0, 0, 1).apply(text)
+                self.assertEqual(len(result), 2 * len(text))
+                self.assertEqual(result[::2], text)
+
+                result = LossFunc(0.1, 0.1, 0.1).apply(bytearray(text))
+                self.assertNotEqual(result, text)
+
+            def test_seed(self):
+                text = "".join(map(chr, xrange(256))) * 4
+
+                f1 = LossFunc(0.1, 0.1, 0.1, seed=13)
+                f2 = LossFunc(0.1, 0.1, 0.1, seed=13)
+                self.assertEqual(f1.apply(text), f2.apply(text))
+                self.assertEqual(f1(text[0]), f2(text[0]))
+                self.assertEqual(f1.spawn().apply(text),
+                    f2.spawn().apply(text))
+
+                f1.seed(7)
+                f2.seed(7)
+                self.assertEqual(f1.apply(text), f2.apply(text))
+
     suite = unittest.TestSuite()
     for k, v in Tests.__dict__.iteritems():
         if k.startswith('Test'):
@@ -18,24 +18,376 @@
 __author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
 __license__ = "GPL"
 
-__all__ = ["SimpleFrameTransmitter"]
+__all__ = ["FrameEncoder", "FrameDecoder",
+    "SlipCodec", "SlipEncoder", "SlipDecoder",
+    "LengthPrefixCodec", "LengthPrefixEncoder", "LengthPrefixDecoder",
+    "CobsCodec", "CobsEncoder", "CobsDecoder",
+    "framing_modes", "SimpleFrameTransmitter"]
 
 """Transmit raw frame between two connected hosts without any acknowledge.
 """
 
-import StringIO
+import re
+import binascii
+import struct
+from collections import deque
 
-class SimpleFrameTransmitter(object):
+class FrameEncoder(object):
+    """Base class for encoders of frames into byte stream."""
+
+    def encode(self, frame):
+        """Returns encoded frame."""
+        raise NotImplementedError()
+
+    def encoded_size(self, frame):
+        """Returns size of encoded frame."""
+        return len(self.encode(frame))
+
+    def encode_into(self, frame, buffer, offset=0):
+        """Writes encoded frame into `buffer' starting from `offset'.
+        Returns number of written bytes.
+        """
+        encoded = self.encode(frame)
+        end = offset + len(encoded)
+        if end > len(buffer):
+            raise ValueError("Buffer is too small for encoded frame")
+
+        memoryview(buffer)[offset:end] = encoded
+        return end - offset
+
+class FrameDecoder(object):
+    """Base class for incremental decoders: bytes of stream are fed in chunks
+    of any size, incomplete frame is kept till next chunk.
+    """
+
+    def __init__(self):
+        super(FrameDecoder, self).__init__()
+        # Received bytes of incomplete frame.
+        self._buffer = bytearray()
+        self._errors_count = 0
+
+    def set_max_frame_size(self, size):
+        """Limits size of decoded frames to `size' bytes. Ignored by
+        decoders which don't need to know frame size in advance.
+        """
+        pass
+
+    @property
+    def pending_size(self):
+        """Number of buffered bytes of incomplete frame."""
+        return len(self._buffer)
+
+    @property
+    def errors_count(self):
+        """Number of dropped corrupted frames."""
+        return self._errors_count
+
+    def reset(self):
+        """Drops incomplete frame."""
+        del self._buffer[:]
+
+    def feed(self, data):
+        """Decodes next chunk of stream. Returns list of completed frames."""
+        raise NotImplementedError()
+
+class SlipCodec(object):
     # Similar to SLIP.
     frame_end       = "\xC0"
     esc_char        = "\xDB"
     frame_end_subst = esc_char + "\xDC"
     esc_subst       = esc_char + "\xDD"
 
+    @staticmethod
+    def escape(frame):
+        return (
+            # Replace escape characters.
+            frame.replace(SlipCodec.esc_char, SlipCodec.esc_subst)
+            # Replace frame end characters inside frame.
+                .replace(SlipCodec.frame_end, SlipCodec.frame_end_subst))
+
+    @staticmethod
+    def unescape(encoded_frame):
+        return encoded_frame.\
+            replace(SlipCodec.frame_end_subst, SlipCodec.frame_end).\
+            replace(SlipCodec.esc_subst, SlipCodec.esc_char)
+
+class SlipEncoder(SlipCodec, FrameEncoder):
+    def encoded_size(self, frame):
+        """Returns size of encoded frame including frame end."""
+        return (len(frame) + frame.count(self.esc_char) +
+            frame.count(self.frame_end) + 1)
+
+    def encode(self, frame):
+        """Returns encoded frame terminated with frame end."""
+        return self.escape(frame) + self.frame_end
+
+    # Characters which are replaced with escape sequences.
+    _special_chars_re = re.compile("[" + re.escape(SlipCodec.frame_end) +
+        re.escape(SlipCodec.esc_char) + "]")
+    _substs = {
+        SlipCodec.frame_end: SlipCodec.frame_end_subst,
+        SlipCodec.esc_char:  SlipCodec.esc_subst,
+        }
+
+    def encode_into(self, frame, buffer, offset=0):
+        """Escapes frame directly into `buffer': runs of ordinary
+        characters are copied between escape sequences.
+        """
+        end = offset + self.encoded_size(frame)
+        if end > len(buffer):
+            raise ValueError("Buffer is too small for encoded frame")
+
+        view = memoryview(buffer)
+        frame_view = memoryview(frame)
+        pos = offset
+        start = 0
+        for match in self._special_chars_re.finditer(frame):
+            special = match.start()
+            view[pos:pos + special - start] = frame_view[start:special]
+            pos += special - start
+            view[pos:pos + 2] = self._substs[match.group()]
+            pos += 2
+            start = special + 1
+        view[pos:end - 1] = frame_view[start:]
+        view[end - 1:end] = self.frame_end
+        return end - offset
+
+class SlipDecoder(SlipCodec, FrameDecoder):
+    """Incremental SLIP decoder. Split escape sequence is kept with
+    incomplete frame.
+    """
+
+    def feed(self, data):
+        if not data:
+            return []
+
+        # Buffered data doesn't contain frame end.
+        start = len(self._buffer)
+        self._buffer.extend(data)
+
+        frames = []
+        frame_start = 0
+        while True:
+            frame_end = self._buffer.find(self.frame_end, start)
+            if frame_end == -1:
+                break
+
+            frames.append(self.unescape(
+                str(self._buffer[frame_start:frame_end])))
+            frame_start = start = frame_end + 1
+
+        # Keep only incomplete frame in buffer.
+        del self._buffer[:frame_start]
+
+        return frames
+
+class LengthPrefixCodec(object):
+    # Encoded frame:
+    #    2        4         2           length          4      - size
+    # *------*--------*------------*------  ------*-----------*
+    # | sync | length | header CRC |     data     | data CRC  |
+    # *------*--------*------------*------  ------*-----------*
+    #
+    # Header CRC (CRC-CCITT of sync and length) rejects false sync
+    # sequences inside data before waiting for `length' bytes.
+    sync = "\xA5\x5A"
+    header_format = '<2sLH'
+    header_size = struct.calcsize(header_format)
+    trailer_format = '<L'
+    trailer_size = struct.calcsize(trailer_format)
+    max_frame_size = 2**20
+
+    @staticmethod
+    def header_crc(length):
+        return binascii.crc_hqx(
+            LengthPrefixCodec.sync + struct.pack('<L', length), 0xffff)
+
+class LengthPrefixEncoder(LengthPrefixCodec, FrameEncoder):
+    def encoded_size(self, frame):
+        return self.header_size + len(frame) + self.trailer_size
+
+    def encode(self, frame):
+        assert len(frame) <= self.max_frame_size
+        return "".join((
+            struct.pack(self.header_format,
+                self.sync, len(frame), self.header_crc(len(frame))),
+            frame,
+            struct.pack(self.trailer_format,
+                binascii.crc32(frame) & 0xffffffff)))
+
+class LengthPrefixDecoder(LengthPrefixCodec, FrameDecoder):
+    """Incremental length-prefixed frames decoder. On header or data CRC
+    mismatch decoder skips one byte and searches for next sync sequence.
+    """
+
+    def set_max_frame_size(self, size):
+        """Limits `length' of accepted headers. False sync sequence which
+        header CRC happens to match is otherwise rejected only by data CRC,
+        after up to `LengthPrefixCodec.max_frame_size' bytes are received.
+        """
+        assert 0 < size
+        self.max_frame_size = min(size, LengthPrefixCodec.max_frame_size)
+
+    def feed(self, data):
+        self._buffer.extend(data)
+
+        frames = []
+        pos = 0
+        while True:
+            sync_pos = self._buffer.find(self.sync, pos)
+            if sync_pos == -1:
+                # Keep last byte, it may be start of sync sequence.
+                pos = max(len(self._buffer) - len(self.sync) + 1, pos)
+                break
+            pos = sync_pos
+
+            data_start = pos + self.header_size
+            if data_start > len(self._buffer):
+                # Incomplete header.
+                break
+
+            sync, length, header_crc = struct.unpack_from(
+                self.header_format, self._buffer, pos)
+            if (length > self.max_frame_size or
+                    header_crc != self.header_crc(length)):
+                # False sync sequence.
+                pos += 1
+                continue
+
+            data_end = data_start + length
+            if data_end + self.trailer_size > len(self._buffer):
+                # Incomplete frame.
+                break
+
+            frame = str(self._buffer[data_start:data_end])
+            crc, = struct.unpack_from(self.trailer_format, self._buffer,
+                data_end)
+            if crc != binascii.crc32(frame) & 0xffffffff:
+                # Corrupted frame, resynchronize.
+                self._errors_count += 1
+                pos += 1
+                continue
+
+            frames.append(frame)
+            pos = data_end + self.trailer_size
+
+        del self._buffer[:pos]
+
+        return frames
+
+class CobsCodec(object):
+    # Consistent Overhead Byte Stuffing: frame is split into blocks without
+    # zero bytes, each block is prefixed with its length plus one. Block of
+    # maximum length 254 is not followed by implicit zero byte. Encoded
+    # frames are delimited with zero byte. Overhead is at most one byte per
+    # 254 bytes of data plus delimiter.
+    frame_end = "\x00"
+    max_block_size = 254
+
+    @staticmethod
+    def stuff(frame):
+        blocks = []
+        for block in frame.split(CobsCodec.frame_end):
+            while len(block) >= CobsCodec.max_block_size:
+                blocks.append("\xFF")
+                blocks.append(block[:CobsCodec.max_block_size])
+                block = block[CobsCodec.max_block_size:]
+            blocks.append(chr(len(block) + 1))
+            blocks.append(block)
+        return "".join(blocks)
+
+    @staticmethod
+    def unstuff(encoded_frame):
+        """Returns decoded frame or None if `encoded_frame' is corrupted."""
+        blocks = []
+        pos = 0
+        while pos < len(encoded_frame):
+            code = ord(encoded_frame[pos])
+            end = pos + code
+            if code == 0 or end > len(encoded_frame):
+                return None
+            blocks.append(encoded_frame[pos + 1:end])
+            pos = end
+            if code <= CobsCodec.max_block_size and pos < len(encoded_frame):
+                blocks.append(CobsCodec.frame_end)
+        return "".join(blocks)
+
+class CobsEncoder(CobsCodec, FrameEncoder):
+    def encoded_size(self, frame):
+        """Returns size of encoded frame including frame end."""
+        return sum(len(block) + len(block) // self.max_block_size + 1
+            for block in frame.split(self.frame_end)) + 1
+
+    def encode(self, frame):
+        """Returns encoded frame terminated with frame end."""
+        return self.stuff(frame) + self.frame_end
+
+class CobsDecoder(CobsCodec, FrameDecoder):
+    """Incremental COBS decoder."""
+
+    def feed(self, data):
+        if not data:
+            return []
+
+        # Buffered data doesn't contain frame end.
+        start = len(self._buffer)
+        self._buffer.extend(data)
+
+        frames = []
+        frame_start = 0
+        while True:
+            frame_end = self._buffer.find(self.frame_end, start)
+            if frame_end == -1:
+                break
+
+            frame = self.unstuff(str(self._buffer[frame_start:frame_end]))
+            if frame is not None:
+                frames.append(frame)
+            else:
+                self._errors_count += 1
+            frame_start = start = frame_end + 1
+
+        # Keep only incomplete frame in buffer.
+        del self._buffer[:frame_start]
+
+        return frames
+
+# { framing mode name: (encoder class, decoder class) }
+framing_modes = {
+    'slip':   (SlipEncoder, SlipDecoder),
+    'length': (LengthPrefixEncoder, LengthPrefixDecoder),
+    'cobs':   (CobsEncoder, CobsDecoder),
+    }
+
+class SimpleFrameTransmitter(object):
+    frame_end       = SlipCodec.frame_end
+    esc_char        = SlipCodec.esc_char
+    frame_end_subst = SlipCodec.frame_end_subst
+    esc_subst       = SlipCodec.esc_subst
+
     def __init__(self, *args, **kwargs):
         self.node = kwargs.pop('node')
+        # Optional capture.CaptureTap for written and read frames.
+        self._capture = kwargs.pop('capture', None)
+        # Index of link end of this transmitter. Frames are captured with
+        # direction of link end which wrote them, so that one tap may be
+        # shared by both link ends.
+        self._capture_end = kwargs.pop('capture_end', 0)
+        # Name of framing mode from `framing_modes'. Both link ends should
+        # use the same framing.
+        self._framing = kwargs.pop('framing', 'slip')
+        # Maximum size of frames written by other link end, see
+        # `set_max_frame_size()'.
+        max_frame_size = kwargs.pop('max_frame_size', None)
         super(SimpleFrameTransmitter, self).__init__(*args, **kwargs)
-        self._read_buffer = StringIO.StringIO()
+
+        encoder_class, decoder_class = framing_modes[self._framing]
+        self._encoder = encoder_class()
+        self._decoder = decoder_class()
+        if max_frame_size is not None:
+            self.set_max_frame_size(max_frame_size)
+        # Received and decoded frames.
+        self._decoded_frames = deque()
 
         self._read_frames_count = 0
         self._write_frames_count = 0
@@ -48,46 +400,92 @@ class SimpleFrameTransmitter(object):
     def write_frames_count(self):
         return self._write_frames_count
 
+    @property
+    def framing(self):
+        return self._framing
+
+    @property
+    def corrupted_frames_count(self):
+        """Number of received frames dropped by framing decoder."""
+        return self._decoder.errors_count
+
+    def set_max_frame_size(self, size):
+        """Sets maximum size of frames written by other link end, so that
+        decoder rejects longer frames without waiting for their data.
+        """
+        self._decoder.set_max_frame_size(size)
+
+    def add_read_listener(self, listener):
+        """Registers `listener' called when data for reading arrives.
+        See `ReceivingNode.add_read_listener()'.
+        """
+        self.node.add_read_listener(listener)
+
+    def remove_read_listener(self, listener):
+        self.node.remove_read_listener(listener)
+
+    def read_fds(self):
+        return self.node.read_fds()
+
+    @property
+    def is_polled(self):
+        return self.node.is_polled
+
     def write_frame(self, frame):
-        raw_data = (
-            # Replace escape characters.
-            frame.replace(self.esc_char, self.esc_subst)
-            # Replace frame end characters inside frame.
-                .replace(self.frame_end, self.frame_end_subst) +
-            # Append frame end at end.
-            self.frame_end)
-        self.node.write(raw_data)
+        if self._capture is not None:
+            # Frame layer, written by this link end.
+            self._capture.record(1, self._capture_end, frame)
+
+        # Whole encoded frame is written into node, so `encode()' is used:
+        # it escapes with str.replace() and is faster than `encode_into()'.
+        self.node.write(self._encoder.encode(frame))
 
         self._write_frames_count += 1
 
+    def _read_available(self, block):
+        """Reads all available bytes from input channel and decodes complete
+        frames from them.
+        """
+        data = self.node.read(0)
+        if not data and block:
+            # Wait for at least one byte.
+            data = self.node.read(1) + self.node.read(0)
+
+        frames = self._decoder.feed(data)
+        self._read_frames_count += len(frames)
+        if self._capture is not None:
+            for frame in frames:
+                # Frame layer, written by other link end.
+                self._capture.record(1, 1 - self._capture_end, frame)
+        self._decoded_frames.extend(frames)
+
     def read_frame(self, block=True):
         """Read single frame from input channel.
         Assumed that this is the only reader from channel.
         """
-        while True:
-            ch = self.node.read(1, block=block)
-            if ch == "":
-                # No more characters for now.
-                return None
-            elif ch == self.frame_end:
-                # Read till frame end. Decode and return it.
-
-                # Obtain encoded frame.
-                encoded_frame = self._read_buffer.getvalue()
-
-                # Reset input buffer.
-                self._read_buffer = StringIO.StringIO()
+        while not self._decoded_frames:
+            self._read_available(block)
+            if not block:
+                break
 
-                # Decode frame.
-                frame = encoded_frame.replace(self.frame_end_subst,
-                                              self.frame_end).\
-                    replace(self.esc_subst, self.esc_char)
+        if self._decoded_frames:
+            return self._decoded_frames.popleft()
+        else:
+            # No complete frames for now.
+            return None
 
-                self._read_frames_count += 1
+    def read_frames(self, block=False):
+        """Read all complete frames from input channel.
+        If `block' is True waits for at least one frame.
+        Assumed that this is the only reader from channel.
+        """
+        self._read_available(False)
+        while block and not self._decoded_frames:
+            self._read_available(True)
 
-                return frame
-            else:
-                self._read_buffer.write(ch)
+        frames = list(self._decoded_frames)
+        self._decoded_frames.clear()
+        return frames
 # --- cut here in report ---
 
 def _test():
@@ -129,6 +527,171 @@ def _test():
                 at.write_frame(test)
                 self.assertEqual(bt.read_frame(), test)
 
+            def test_read_frames(self):
+                a, b = FullDuplexLink()
+
+                at = SimpleFrameTransmitter(node=a)
+                bt = SimpleFrameTransmitter(node=b)
+
+                self.assertEqual(bt.read_frames(), [])
+
+                frames = ["1", "", SimpleFrameTransmitter.frame_end * 3,
+                    SimpleFrameTransmitter.esc_char + "2"]
+                for frame in frames:
+                    at.write_frame(frame)
+                self.assertEqual(bt.read_frames(), frames)
+                self.assertEqual(bt.read_frames_count, len(frames))
+
+                # Incomplete frame is kept till its end arrives.
+                a.write("12" + SimpleFrameTransmitter.frame_end + "34")
+                self.assertEqual(bt.read_frame(), "12")
+                self.assertEqual(bt.read_frame(block=False), None)
+                a.write("5" + SimpleFrameTransmitter.frame_end)
+                self.assertEqual(bt.read_frames(block=True), ["345"])
+
+        class TestSlipCodec(unittest.TestCase):
+            frames = ["", "test", SlipCodec.frame_end, SlipCodec.esc_char,
+                SlipCodec.frame_end_subst + SlipCodec.esc_subst,
+                "".join(map(chr, xrange(256)))]
+
+            def test_encoder(self):
+                encoder = SlipEncoder()
+                for frame in self.frames:
+                    encoded = encoder.encode(frame)
+                    self.assertEqual(encoded.count(SlipCodec.frame_end), 1)
+                    self.assertEqual(encoder.encoded_size(frame),
+                        len(encoded))
+
+                    buf = bytearray(len(encoded) + 2)
+                    self.assertEqual(encoder.encode_into(frame, buf, 1),
+                        len(encoded))
+                    self.assertEqual(str(buf[1:-1]), encoded)
+
+                self.assertRaises(ValueError, encoder.encode_into,
+                    "test", bytearray(4))
+
+            def test_decoder(self):
+                encoder = SlipEncoder()
+                stream = "".join(map(encoder.encode, self.frames))
+
+                decoder = SlipDecoder()
+                self.assertEqual(decoder.feed(stream), self.frames)
+                self.assertEqual(decoder.pending_size, 0)
+
+                # Feed by single byte, so escape sequences are split.
+                frames = []
+                for ch in stream:
+                    frames.extend(decoder.feed(ch))
+                self.assertEqual(frames, self.frames)
+
+                self.assertEqual(decoder.feed(stream[:-1]), self.frames[:-1])
+                self.assertEqual(decoder.pending_size,
+                    len(encoder.encode(self.frames[-1])) - 1)
+                decoder.reset()
+                self.assertEqual(decoder.feed(SlipCodec.frame_end), [""])
+
+        class TestFramingModes(unittest.TestCase):
+            frames = ["", "test", SlipCodec.frame_end, SlipCodec.esc_char,
+                "".join(map(chr, xrange(256))), "\x00" * 300, "\xFF" * 600,
+                LengthPrefixCodec.sync * 10]
+
+            def test_codecs(self):
+                for framing, (encoder_class, decoder_class) in \
+                        framing_modes.iteritems():
+                    encoder = encoder_class()
+                    encoded = map(encoder.encode, self.frames)
+                    self.assertEqual(map(encoder.encoded_size, self.frames),
+                        map(len, encoded))
+
+                    buf = bytearray(sum(map(len, encoded)))
+                    offset = 0
+                    for frame in self.frames:
+                        offset += encoder.encode_into(frame, buf, offset)
+                    self.assertEqual(str(buf), "".join(encoded))
+
+                    decoder = decoder_class()
+                    self.assertEqual(decoder.feed(str(buf)), self.frames)
+                    frames = []
+                    for ch in str(buf):
+                        frames.extend(decoder.feed(ch))
+                    self.assertEqual(frames, self.frames, framing)
+                    self.assertEqual(decoder.pending_size, 0)
+
+            def test_link(self):
+                for framing in framing_modes:
+                    a, b = FullDuplexLink()
+                    at = SimpleFrameTransmitter(node=a, framing=framing)
+                    bt = SimpleFrameTransmitter(node=b, framing=framing)
+                    self.assertEqual(at.framing, framing)
+
+                    for frame in self.frames:
+                        at.write_frame(frame)
+                    self.assertEqual(bt.read_frames(), self.frames)
+
+            def test_length_resync(self):
+                encoder = LengthPrefixEncoder()
+                decoder = LengthPrefixDecoder()
+
+                # Corrupted data, lost bytes in header and garbage between
+                # frames.
+                corrupted = bytearray(encoder.encode("test1"))
+                corrupted[LengthPrefixCodec.header_size] ^= 1
+                stream = (str(corrupted) + encoder.encode("test2") +
+                    encoder.encode("lost")[3:] + LengthPrefixCodec.sync +
+                    "garbage" + encoder.encode("test3"))
+                self.assertEqual(decoder.feed(stream), ["test2", "test3"])
+                self.assertEqual(decoder.errors_count, 1)
+
+                # Garbage without sync sequence isn't accumulated.
+                decoder.feed("x" * 1000 + LengthPrefixCodec.sync[0])
+                self.assertEqual(decoder.pending_size, 1)
+                self.assertEqual(decoder.feed(
+                    encoder.encode("test4")[1:]), ["test4"])
+
+            def test_length_max_frame_size(self):
+                encoder = LengthPrefixEncoder()
+                # False sync sequence with matching header CRC.
+                false_header = struct.pack(LengthPrefixCodec.header_format,
+                    LengthPrefixCodec.sync, 1000,
+                    LengthPrefixCodec.header_crc(1000))
+                frames = [encoder.encode("test{0}".format(i))
+                    for i in xrange(3)]
+
+                decoder = LengthPrefixDecoder()
+                self.assertEqual(decoder.feed(false_header + "".join(frames)),
+                    [])
+
+                decoder = LengthPrefixDecoder()
+                decoder.set_max_frame_size(100)
+                self.assertEqual(decoder.feed(false_header + "".join(frames)),
+                    ["test0", "test1", "test2"])
+                self.assertEqual(decoder.pending_size, 0)
+                self.assertEqual(decoder.feed(encoder.encode("x" * 100)),
+                    ["x" * 100])
+
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a, framing='length')
+                bt = SimpleFrameTransmitter(node=b, framing='length',
+                    max_frame_size=100)
+                a.write(false_header)
+                at.write_frame("test")
+                self.assertEqual(bt.read_frames(), ["test"])
+
+            def test_cobs(self):
+                encoder = CobsEncoder()
+                for frame in self.frames:
+                    encoded = encoder.encode(frame)
+                    self.assertEqual(encoded.index(CobsCodec.frame_end),
+                        len(encoded) - 1)
+                    # Bounded overhead.
+                    self.assertLessEqual(len(encoded),
+                        len(frame) + len(frame) // 254 + 2)
+
+                decoder = CobsDecoder()
+                self.assertEqual(decoder.feed(
+                    "\x05ab\x00" + encoder.encode("test")), ["test"])
+                self.assertEqual(decoder.errors_count, 1)
+
     suite = unittest.TestSuite()
     for k, v in Tests.__dict__.iteritems():
         if k.startswith('Test'):
@@ -136,6 +699,91 @@ def _test():
 
     unittest.TextTestRunner(verbosity=2).run(suite)
     
+def _benchmark(frames_count=10000, max_frame_size=1000, seed=0,
+        framing='slip'):
+    """Fuzz-benchmark of framing codec on random frames fed in random
+    chunks.
+    """
+
+    import random
+    import time
+
+    rnd = random.Random(seed)
+    frames = ["".join(chr(rnd.randint(0, 255))
+            for i in xrange(rnd.randint(0, max_frame_size)))
+        for j in xrange(frames_count)]
+
+    encoder_class, decoder_class = framing_modes[framing]
+    encoder = encoder_class()
+    start = time.time()
+    stream = "".join(map(encoder.encode, frames))
+    encode_time = time.time() - start
+
+    chunks = []
+    offset = 0
+    while offset < len(stream):
+        size = rnd.randint(1, 2 * max_frame_size)
+        chunks.append(stream[offset:offset + size])
+        offset += size
+
+    decoder = decoder_class()
+    start = time.time()
+    decoded = []
+    for chunk in chunks:
+        decoded.extend(decoder.feed(chunk))
+    decode_time = time.time() - start
+
+    assert decoded == frames
+    print "{0} frames, {1} bytes encoded in {2} bytes".format(
+        len(frames), sum(map(len, frames)), len(stream))
+    print "encode: {0:.3f} s, decode in {1} chunks: {2:.3f} s".format(
+        encode_time, len(chunks), decode_time)
+
+def _benchmark_framing(frames_count=2000, frame_size=1000, seed=0):
+    """Compares framing modes: wire bytes and CPU time per frame for
+    different kinds of payload.
+    """
+
+    import random
+    import time
+
+    rnd = random.Random(seed)
+    payloads = [
+        ("text", lambda: "".join(rnd.choice("abcdefgh ") for i in
+            xrange(frame_size))),
+        ("binary", lambda: "".join(chr(rnd.randint(0, 255)) for i in
+            xrange(frame_size))),
+        # Worst case for SLIP.
+        ("special", lambda: "".join(rnd.choice(
+            SlipCodec.frame_end + SlipCodec.esc_char) for i in
+            xrange(frame_size))),
+        ]
+
+    print "{0:8} {1:8} {2:>14} {3:>14} {4:>14}".format("payload", "framing",
+        "bytes/frame", "encode us/fr", "decode us/fr")
+    for payload_name, make_frame in payloads:
+        frames = [make_frame() for i in xrange(frames_count)]
+        for framing in sorted(framing_modes):
+            encoder_class, decoder_class = framing_modes[framing]
+            encoder, decoder = encoder_class(), decoder_class()
+
+            start = time.clock()
+            encoded = map(encoder.encode, frames)
+            encode_time = time.clock() - start
+
+            start = time.clock()
+            decoded = []
+            for data in encoded:
+                decoded.extend(decoder.feed(data))
+            decode_time = time.clock() - start
+            assert decoded == frames
+
+            print "{0:8} {1:8} {2:14.1f} {3:14.1f} {4:14.1f}".format(
+                payload_name, framing,
+                sum(map(len, encoded)) / float(frames_count),
+                encode_time / frames_count * 1e6,
+                decode_time / frames_count * 1e6)
+
 if __name__ == "__main__":
     _test()
 
@@ -35,6 +35,7 @@ import palette
 import config
 from duplex_link import FullDuplexLink
 from frame import SimpleFrameTransmitter
+from bonding import BondedLink
 from controllable_frame_transmitter import ControllableFrameTransmitter
 from rip import RIPService
 from rip_packet_scene_item import RIPPacketItem
@@ -47,7 +48,7 @@ class LinkItem(QGraphicsObject):
             'packet start_time end_time packet_item')
             
     def __init__(self, src_router, dest_router, enabled=False,
-            loss_func=None, parent=None):
+            loss_func=None, links_count=1, parent=None):
         super(LinkItem, self).__init__(parent)
 
         self._logger = logging.getLogger(
@@ -79,18 +80,28 @@ class LinkItem(QGraphicsObject):
         # Initial state is disabled.
         self._enabled = False
         self.hide()
-        l1, l2 = FullDuplexLink(loss_func=loss_func)
-        sft1 = SimpleFrameTransmitter(node=l1)
-        sft2 = SimpleFrameTransmitter(node=l2)
+        if links_count > 1:
+            # Frames striped over several links.
+            sft1, sft2 = BondedLink(links_count, loss_func=loss_func)
+        else:
+            l1, l2 = FullDuplexLink(loss_func=loss_func)
+            sft1 = SimpleFrameTransmitter(node=l1)
+            sft2 = SimpleFrameTransmitter(node=l2)
         self._src_frame_transmitter = \
             ControllableFrameTransmitter(
                 src_name=self.src.name, dest_name=self.dest.name,
                 simple_frame_transmitter=sft1,
+                send_high_water=config.frame_transmitter_send_high_water,
+                receive_high_water=
+                    config.frame_transmitter_receive_high_water,
                 debug_src=self.src.name, debug_dest=self.dest.name)
         self._dest_frame_transmitter = \
             ControllableFrameTransmitter(
                 src_name=self.dest.name, dest_name=self.src.name,
                 simple_frame_transmitter=sft2,
+                send_high_water=config.frame_transmitter_send_high_water,
+                receive_high_water=
+                    config.frame_transmitter_receive_high_water,
                 debug_src=self.dest.name, debug_dest=self.src.name)
 
         self.enabled = enabled
@@ -0,0 +1,349 @@
+#  This file is part of network emulation test model.
+#
+#  Copyright (C) 2010, 2011  Vladimir Rutsky <altsysrq@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
+__license__ = "GPL"
+
+__all__ = ["GilbertElliottLossFunc", "TraceLossFunc"]
+
+"""Loss functions with correlated losses.
+"""
+
+import bisect
+import mmap
+
+from duplex_link import BaseLossFunc, numpy
+
+class GilbertElliottLossFunc(BaseLossFunc):
+    """Two-state (good and bad channel) Markov loss model.
+    Channel changes state before each character with probability
+    `good_to_bad_prob' or `bad_to_good_prob' and corrupts character with
+    probability `good_error_prob' or `bad_error_prob' depending on current
+    state. Corruption is selected among skip, modify and append new character
+    according to `error_weights'.
+    """
+
+    good = 0
+    bad  = 1
+
+    def __init__(self, good_to_bad_prob, bad_to_good_prob, good_error_prob=0,
+            bad_error_prob=1, error_weights=(1, 1, 1), seed=None):
+        assert 0 <= good_to_bad_prob <= 1
+        assert 0 <= bad_to_good_prob <= 1
+        assert 0 <= good_error_prob <= 1
+        assert 0 <= bad_error_prob <= 1
+        assert len(error_weights) == 3 and sum(error_weights) > 0
+
+        self._transition_probs = (good_to_bad_prob, bad_to_good_prob)
+        self._error_probs = (good_error_prob, bad_error_prob)
+
+        # Upper bounds of random number for skip, modify and new character.
+        total = float(sum(error_weights))
+        self._error_selection_array = []
+        for weight in error_weights:
+            last = (self._error_selection_array[-1]
+                if self._error_selection_array else 0)
+            self._error_selection_array.append(last + weight / total)
+        self._error_selection_array[-1] = 1
+
+        super(GilbertElliottLossFunc, self).__init__(seed)
+
+    def seed(self, seed=None):
+        """Reset random generators and channel state to good, so that same
+        seed produces same losses.
+        """
+        super(GilbertElliottLossFunc, self).seed(seed)
+        self.state = GilbertElliottLossFunc.good
+
+    @classmethod
+    def from_mean(cls, loss_prob, burst_length, bad_error_prob=0.5,
+            **kwargs):
+        """Constructs model with mean loss probability `loss_prob' and mean
+        length of bad state `burst_length' characters.
+        """
+        assert burst_length >= 1
+        bad_fraction = loss_prob / float(bad_error_prob)
+        assert bad_fraction < 1
+
+        bad_to_good_prob = 1.0 / burst_length
+        good_to_bad_prob = \
+            bad_to_good_prob * bad_fraction / (1 - bad_fraction)
+        return cls(good_to_bad_prob, bad_to_good_prob, 0, bad_error_prob,
+            **kwargs)
+
+    @property
+    def mean_error_prob(self):
+        """Stationary probability of character corruption."""
+        good_to_bad_prob, bad_to_good_prob = self._transition_probs
+        if good_to_bad_prob + bad_to_good_prob == 0:
+            return self._error_probs[self.state]
+        bad_fraction = good_to_bad_prob / \
+            float(good_to_bad_prob + bad_to_good_prob)
+        return (self._error_probs[GilbertElliottLossFunc.good] *
+                (1 - bad_fraction) +
+            self._error_probs[GilbertElliottLossFunc.bad] * bad_fraction)
+
+    def _error_choice(self, random_value):
+        return BaseLossFunc.skip_ch + bisect.bisect_right(
+            self._error_selection_array, random_value)
+
+    def _choice(self):
+        if self._random.random() < self._transition_probs[self.state]:
+            self.state = 1 - self.state
+
+        if self._random.random() < self._error_probs[self.state]:
+            return self._error_choice(self._random.random())
+        else:
+            return BaseLossFunc.keep_ch
+
+    def _states(self, size):
+        """Returns states of channel for next `size' characters."""
+        states = []
+        total = 0
+        state = self.state
+        first_run = True
+        while total < size:
+            # Length of each run of characters in same state is
+            # geometrically distributed. First run continues current state.
+            transition_prob = self._transition_probs[state]
+            if transition_prob == 0:
+                length = size - total
+            else:
+                length = self._numpy_random.geometric(transition_prob)
+                if first_run:
+                    # State changes before the first character.
+                    length -= 1
+            first_run = False
+            states.append((state, length))
+            total += length
+            state = 1 - state
+
+        values, lengths = zip(*states)
+        result = numpy.repeat(numpy.array(values, dtype=numpy.uint8),
+            lengths)[:size]
+        # Geometric distribution is memoryless, so only last state should be
+        # preserved.
+        self.state = int(result[-1])
+        return result
+
+    def _choices(self, size):
+        states = self._states(size)
+        error_probs = numpy.array(self._error_probs)[states]
+        errors = self._numpy_random.random_sample(size) < error_probs
+
+        choices = numpy.empty(size, dtype=numpy.intp)
+        choices.fill(BaseLossFunc.keep_ch)
+        choices[errors] = BaseLossFunc.skip_ch + numpy.searchsorted(
+            self._error_selection_array,
+            self._numpy_random.random_sample(errors.sum()), side='right')
+        return choices
+
+class TraceLossFunc(BaseLossFunc):
+    """Replays recorded losses from memory-mapped trace file.
+    In byte mode each byte of trace is modification for one character:
+    zero or `keep_ch' keeps character, `skip_ch', `modify_ch' and `new_ch'
+    modify it. In bit mode each bit (starting from the most significant bit
+    of first byte) corresponds to one character: set bit applies
+    `bit_choice' to the character.
+    Trace is repeated when it ends.
+    """
+
+    def __init__(self, file_name, bits=False, bit_choice=BaseLossFunc.skip_ch,
+            seed=None):
+        with open(file_name, "rb") as f:
+            self._trace = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._bits = bits
+        self._bit_choice = bit_choice
+        self._length = len(self._trace) * (8 if bits else 1)
+        assert self._length > 0
+        # Index of next used trace element.
+        self.position = 0
+
+        super(TraceLossFunc, self).__init__(seed)
+
+    def _choice_at(self, code):
+        if self._bits:
+            return self._bit_choice if code else BaseLossFunc.keep_ch
+        elif code in (BaseLossFunc.skip_ch, BaseLossFunc.modify_ch,
+                BaseLossFunc.new_ch):
+            return code
+        else:
+            return BaseLossFunc.keep_ch
+
+    def _choice(self):
+        if self._bits:
+            byte = ord(self._trace[self.position // 8])
+            code = (byte >> (7 - self.position % 8)) & 1
+        else:
+            code = ord(self._trace[self.position])
+        self.position = (self.position + 1) % self._length
+        return self._choice_at(code)
+
+    def _choices(self, size):
+        trace = numpy.frombuffer(self._trace, dtype=numpy.uint8)
+        if self._bits:
+            # Unpack only bytes used in this call.
+            first_byte = self.position // 8
+            bytes_count = (self.position % 8 + size + 7) // 8
+            indices = numpy.arange(first_byte, first_byte + bytes_count) % \
+                len(trace)
+            codes = numpy.unpackbits(trace[indices])[
+                self.position % 8:self.position % 8 + size]
+        else:
+            indices = numpy.arange(self.position, self.position + size) % \
+                self._length
+            codes = trace[indices]
+        self.position = (self.position + size) % self._length
+
+        choices = numpy.empty(size, dtype=numpy.intp)
+        choices.fill(BaseLossFunc.keep_ch)
+        if self._bits:
+            choices[codes != 0] = self._bit_choice
+        else:
+            for choice in (BaseLossFunc.skip_ch, BaseLossFunc.modify_ch,
+                    BaseLossFunc.new_ch):
+                choices[codes == choice] = choice
+        return choices
+# --- cut here in report ---
+
+def _test():
+    # TODO: Use in separate file to test importing functionality.
+
+    import os
+    import tempfile
+
+    from testing import unittest, do_tests
+
+    import duplex_link
+    from duplex_link import FullDuplexLink
+
+    def with_and_without_numpy(test):
+        def wrapper(self):
+            test(self)
+            saved_numpy = duplex_link.numpy
+            duplex_link.numpy = None
+            try:
+                test(self)
+            finally:
+                duplex_link.numpy = saved_numpy
+        return wrapper
+
+    class Tests(object):
+        class TestGilbertElliottLossFunc(unittest.TestCase):
+            text = "".join(map(chr, xrange(256))) * 400
+
+            @with_and_without_numpy
+            def test_bursts(self):
+                f = GilbertElliottLossFunc(0.001, 0.1, 0, 1,
+                    error_weights=(0, 1, 0), seed=1)
+                result = f.apply(self.text)
+                self.assertEqual(len(result), len(self.text))
+
+                errors = [a != b for a, b in zip(result, self.text)]
+                errors_count = sum(errors)
+                bursts_count = sum(1 for i in xrange(1, len(errors))
+                    if errors[i] and not errors[i - 1])
+                # Mean error probability is ~1%, mean burst length is 10
+                # (some modified characters are equal to original ones).
+                self.assertAlmostEqual(
+                    errors_count / float(len(self.text)),
+                    f.mean_error_prob, delta=0.005)
+                self.assertGreater(errors_count / float(bursts_count), 5)
+
+            @with_and_without_numpy
+            def test_no_errors(self):
+                f = GilbertElliottLossFunc(0.5, 0.5, 0, 0)
+                self.assertEqual(f.apply(self.text), self.text)
+
+            def test_from_mean(self):
+                f = GilbertElliottLossFunc.from_mean(0.003, 20)
+                self.assertAlmostEqual(f.mean_error_prob, 0.003)
+
+            def test_burst_length(self):
+                f = GilbertElliottLossFunc.from_mean(0.25, 4, seed=1)
+                # Small calls, so that first run of each call is often
+                # empty.
+                states = numpy.concatenate(
+                    [f._states(1) for i in xrange(100000)])
+                bursts = []
+                length = 0
+                for state in states:
+                    if state == GilbertElliottLossFunc.bad:
+                        length += 1
+                    elif length > 0:
+                        bursts.append(length)
+                        length = 0
+                self.assertAlmostEqual(sum(bursts) / float(len(bursts)), 4,
+                    delta=0.2)
+
+            def test_seed(self):
+                f1 = GilbertElliottLossFunc.from_mean(0.01, 10, seed=3)
+                f2 = GilbertElliottLossFunc.from_mean(0.01, 10, seed=3)
+                self.assertEqual(f1.apply(self.text), f2.apply(self.text))
+
+                # Channel state is reset with random generators.
+                f1.state = GilbertElliottLossFunc.bad
+                f1.seed(4)
+                self.assertEqual(f1.state, GilbertElliottLossFunc.good)
+                f2.seed(4)
+                self.assertEqual(f1.apply(self.text), f2.apply(self.text))
+
+            def test_link(self):
+                a, b = FullDuplexLink(
+                    loss_func=GilbertElliottLossFunc(0.01, 0.1, seed=1))
+                a.write(self.text)
+                self.assertNotEqual(b.read(), self.text)
+
+        class TestTraceLossFunc(unittest.TestCase):
+            def setUp(self):
+                fd, self.file_name = tempfile.mkstemp()
+                os.close(fd)
+
+            def tearDown(self):
+                os.remove(self.file_name)
+
+            @with_and_without_numpy
+            def test_bytes(self):
+                with open(self.file_name, "wb") as f:
+                    f.write("\x00\x01\x00\x03\x00")
+
+                f = TraceLossFunc(self.file_name)
+                result = f.apply("abcde")
+                self.assertEqual(len(result), 5)
+                self.assertEqual(result[0], "a")
+                self.assertEqual(result[1:3], "cd")
+                self.assertEqual(result[4], "e")
+                # Trace is repeated.
+                self.assertEqual(len(f.apply("abcdeabcde")), 10)
+                self.assertEqual(f.position, 0)
+
+            @with_and_without_numpy
+            def test_bits(self):
+                with open(self.file_name, "wb") as f:
+                    f.write("\x81")
+
+                f = TraceLossFunc(self.file_name, bits=True)
+                self.assertEqual(f.apply("abcdefgh"), "bcdefg")
+                self.assertEqual(f.apply("abc"), "bc")
+                self.assertEqual(f.apply("abcdefghij"), "abcdghij")
+
+    do_tests(Tests)
+
+if __name__ == "__main__":
+    _test()
+
+# vim: set ts=4 sw=4 et:
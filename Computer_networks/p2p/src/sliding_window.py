@@ -18,13 +18,19 @@
 __author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
 __license__ = "GPL"
 
-__all__ = ["FrameTransmitter", "FrameTransmitterWorker", "worker"]
+__all__ = ["FrameTransmitter", "FrameTransmitterWorker",
+    "FrameTransmitterWorkerPool", "RttEstimator", "worker"]
 
 """Transmit frame between two connected hosts with acknowledge.
 """
 
-import itertools
+import os
+import errno
+import fcntl
+import select
 import struct
+import heapq
+import itertools
 import binascii
 import threading
 import time
@@ -35,10 +41,17 @@ from recordtype import recordtype
 
 import config
 from frame import SimpleFrameTransmitter
+from arq import get_arq_strategy
 
 class FrameType(object):
     data = 1
     ack  = 2
+    # Cumulative ACK: `id' is id of next expected frame, `data' is bitmap of
+    # received frames after it (see `Frame.sack_bitmap()').
+    sack = 3
+    # Negative ACK: `id' is id of the first missing frame, `data' is bitmap
+    # of other missing frames after it (in format of SACK bitmap).
+    nak  = 4
 
 class InvalidFrameException(Exception):
     # TODO: Remove dummy constructor.
@@ -48,20 +61,54 @@ class InvalidFrameException(Exception):
 # TODO: Inherit from recordtype.
 class Frame(object):
     # Frame:
-    #    1     2     1      4             4     - field size
-    # *------*----*------*-----*--  --*-------*
-    # | type | id | last | len | data | CRC32 |
-    # *------*----*------*-----*--  --*-------*
-
-    format_string = '<BHBL{0}sL'
-    empty_frame_size = struct.calcsize(format_string.format(0))
+    #    1      2     1        1      2     4        4               4  - size
+    # *------*----*-------*--------*-----*-----*------------*--  --*-------*
+    # | type | id | flags | stream | seq | len | dgram size | data | CRC32 |
+    # *------*----*-------*--------*-----*-----*------------*--  --*-------*
+    #
+    # `flags' marks the first and the last frames of datagram. `dgram size'
+    # field is present only in the first frame of datagram, so that
+    # receiver can preallocate buffer for the whole datagram. The first
+    # frame of chunked message (which size is not known in advance) is
+    # marked with `chunked_flag' instead. `stream' is id of logical stream:
+    # datagrams of different streams are reassembled separately. `seq' is
+    # number of frame in its stream (modulo `seq_period'): frames of stream
+    # which follow already reassembled ones are reassembled even if frames
+    # of other streams before them are lost. `len' is length of `data'.
+
+    header_format = '<BHBBHL'
+    header_size = struct.calcsize(header_format)
+    datagram_size_format = '<L'
+    datagram_size_size = struct.calcsize(datagram_size_format)
+    trailer_format = '<L'
+    trailer_size = struct.calcsize(trailer_format)
+    empty_frame_size = header_size + trailer_size
+    seq_period = 2**16
+
+    last_flag    = 0x01
+    first_flag   = 0x02
+    chunked_flag = 0x04
 
     def __init__(self, *args, **kwargs):
         self.type = kwargs.pop('type')
         self.id = kwargs.pop('id')
+        self.stream = kwargs.pop('stream', 0)
+        self.seq = kwargs.pop('seq', 0)
+        # Size of whole datagram for the first frame of datagram.
+        self.datagram_size = kwargs.pop('datagram_size', None)
+        # True for the first frame of chunked message.
+        self.is_chunked = kwargs.pop('is_chunked', False)
         if self.type == FrameType.data:
+            # String or memoryview of sent datagram.
             self.data    = kwargs.pop('data')
             self.is_last = kwargs.pop('is_last')
+        elif self.type in (FrameType.sack, FrameType.nak):
+            self.data = kwargs.pop('data', "")
+            self.is_last = False
+            if 'is_last' in kwargs:
+                kwargs.pop('is_last')
+            self.datagram_size = None
+            self.is_chunked = False
         else:
             self.data = ""
             if 'data' in kwargs:
@@ -69,60 +116,136 @@ class Frame(object):
             self.is_last = False
             if 'is_last' in kwargs:
                 kwargs.pop('is_last')
+            self.datagram_size = None
+            self.is_chunked = False
         super(Frame, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def sack_bitmap(offsets):
+        """Returns SACK bitmap for frames with ids `cumulative id + offset'
+        for each offset in `offsets' (offsets start from 1). Bit `offset - 1'
+        is stored in byte `(offset - 1) // 8' starting from least
+        significant bit.
+        """
+        bitmap = bytearray()
+        for offset in offsets:
+            assert offset >= 1
+            byte, bit = divmod(offset - 1, 8)
+            if byte >= len(bitmap):
+                bitmap.extend("\0" * (byte + 1 - len(bitmap)))
+            bitmap[byte] |= 1 << bit
+        return str(bitmap)
+
+    @staticmethod
+    def sack_offsets(bitmap):
+        """Returns list of offsets stored in SACK `bitmap'."""
+        offsets = []
+        for byte_idx, byte in enumerate(bytearray(bitmap)):
+            for bit in xrange(8):
+                if byte & (1 << bit):
+                    offsets.append(byte_idx * 8 + bit + 1)
+        return offsets
+
+    def _header(self):
+        flags = 0
+        if self.is_last:
+            flags |= Frame.last_flag
+        if self.datagram_size is not None:
+            flags |= Frame.first_flag
+        if self.is_chunked:
+            flags |= Frame.chunked_flag
+        header = struct.pack(self.header_format,
+            self.type, self.id, flags, self.stream, self.seq,
+            len(self.data))
+        if self.datagram_size is not None:
+            header += struct.pack(self.datagram_size_format,
+                self.datagram_size)
+        return header
+
     def crc(self):
-        return binascii.crc32(self.serialize(0)) & 0xffffffff
+        return binascii.crc32(self.data,
+            binascii.crc32(self._header())) & 0xffffffff
 
-    def serialize(self, crc = None):
-        """Returns string representing frame."""
+    def serialize(self):
+        """Returns string representing frame. String frame data is copied
+        once, into returned string; memoryview data is copied into
+        temporary string first, because str.join() accepts only strings.
+        """
 
-        if crc is not None:
-            return struct.pack(
-                self.format_string.format(len(self.data)),
-                self.type, self.id, self.is_last, len(self.data),
-                self.data, crc)
-        else:
-            return self.serialize(self.crc())
+        data = self.data
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return "".join((self._header(), data,
+            struct.pack(self.trailer_format, self.crc())))
 
     @staticmethod
     def deserialize(frame_str):
         # TODO: Add frame dump into InvalidFrameException error message.
 
-        data_len = len(frame_str) - Frame.empty_frame_size
-        if data_len < 0:
+        if len(frame_str) < Frame.empty_frame_size:
             raise InvalidFrameException(
                 "Frame too small, not enough fields")
 
-        frame_type, frame_id, is_last, read_data_len, frame_data, frame_crc = \
-                struct.unpack(Frame.format_string.format(data_len), frame_str)
-        
-        if frame_type not in [FrameType.data, FrameType.ack]:
+        frame_type, frame_id, flags, stream, seq, read_data_len = \
+                struct.unpack_from(Frame.header_format, frame_str)
+
+        if frame_type not in [FrameType.data, FrameType.ack, FrameType.sack,
+                FrameType.nak]:
             raise InvalidFrameException(
                 "Invalid frame type '{0}'".format(frame_type))
 
-        if read_data_len != data_len:
+        data_start = Frame.header_size
+        datagram_size = None
+        if flags & Frame.first_flag:
+            data_start += Frame.datagram_size_size
+            if len(frame_str) < data_start + Frame.trailer_size:
+                raise InvalidFrameException(
+                    "Frame too small, not enough fields")
+            datagram_size, = struct.unpack_from(Frame.datagram_size_format,
+                frame_str, Frame.header_size)
+
+        data_end = len(frame_str) - Frame.trailer_size
+        if read_data_len != data_end - data_start:
             raise InvalidFrameException(
                 "Invalid data length: {0}, expected {1}".format(
-                    read_data_len, data_len))
-
-        frame = Frame(type=frame_type, id=frame_id, is_last=is_last,
-            data=frame_data)
+                    read_data_len, data_end - data_start))
 
-        if frame_crc != frame.crc():
+        # Check CRC before copying frame data.
+        frame_crc, = struct.unpack_from(Frame.trailer_format, frame_str,
+            data_end)
+        crc = binascii.crc32(memoryview(frame_str)[:data_end]) & 0xffffffff
+        if frame_crc != crc:
             raise InvalidFrameException(
                 "Invalid ckecksum: {0:04X}, correct one is {1:04X}".format(
-                    frame_crc, frame.crc()))
+                    frame_crc, crc))
 
-        return frame
+        return Frame(type=frame_type, id=frame_id, stream=stream, seq=seq,
+            is_last=bool(flags & Frame.last_flag),
+            data=frame_str[data_start:data_end], datagram_size=datagram_size,
+            is_chunked=bool(flags & Frame.chunked_flag))
 
     def __str__(self):
         if self.type == FrameType.data:
-            return "Data({id}, is_last={is_last}, 0x{data})".format(
-                id=self.id, is_last=self.is_last,
-                data=self.data.encode('hex'))
+            data = self.data
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            return ("Data({id}, stream={stream}, seq={seq}, "
+                    "is_last={is_last}, datagram_size={datagram_size}, "
+                    "is_chunked={is_chunked}, 0x{data})".format(
+                id=self.id, stream=self.stream, seq=self.seq,
+                is_last=self.is_last,
+                datagram_size=self.datagram_size, is_chunked=self.is_chunked,
+                data=data.encode('hex')))
         elif self.type == FrameType.ack:
             return "Ack({id})".format(id=self.id)
+        elif self.type == FrameType.sack:
+            return "SAck({id}, selective={offsets})".format(id=self.id,
+                offsets=[(self.id + offset) % FrameTransmitter._frame_id_period
+                    for offset in self.sack_offsets(self.data)])
+        elif self.type == FrameType.nak:
+            return "Nak({ids})".format(ids=[self.id] +
+                [(self.id + offset) % FrameTransmitter._frame_id_period
+                    for offset in self.sack_offsets(self.data)])
         else:
             assert False
 
@@ -136,155 +259,754 @@ def clear_queue(q):
             break
 
 class FrameTransmitterWorker(object):
+    """Calls `update()' of registered frame transmitters from working thread.
+    Working thread sleeps until data is sent or received by one of
+    transmitters or until the earliest retransmission deadline.
+    """
+
     def __init__(self):
         super(FrameTransmitterWorker, self).__init__()
 
         self._logger = logging.getLogger("FrameTransmitterWorker")
 
-        self._frame_transmitters = set()
+        # Transmitters are updated in round-robin order starting from
+        # `_next_frame_transmitter', so that each of them gets its budget
+        # and busy transmitter doesn't delay others.
+        self._frame_transmitters = []
+        self._next_frame_transmitter = 0
         self._frame_transmitters_lock = threading.RLock()
 
         self._working_thread = None
-        self._exit_lock = threading.RLock()
+        # Set to terminate current working thread.
+        self._exit_event = None
+
+        # Working thread waits for self-pipe to become readable.
+        self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+        flags = fcntl.fcntl(self._wakeup_write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._wakeup_write_fd, fcntl.F_SETFL,
+            flags | os.O_NONBLOCK)
+        self._wakeup_pending = False
+
+    @property
+    def frame_transmitters_count(self):
+        return len(self._frame_transmitters)
 
     def add_frame_transmitter(self, frame_transmitter):
+        """Starts updating `frame_transmitter'. Returns worker which updates
+        transmitter (this worker).
+        """
         with self._frame_transmitters_lock:
-            if self._working_thread is None:
-                # If working thread will be able to acquire the lock, then it
-                # should terminate himself.
-                self._exit_lock.acquire()
+            assert frame_transmitter not in self._frame_transmitters
+            self._frame_transmitters.append(frame_transmitter)
 
-                self._working_thread = threading.Thread(target=self._work)
+            if self._working_thread is None:
+                self._exit_event = threading.Event()
+                self._working_thread = threading.Thread(target=self._work,
+                    args=(self._exit_event,))
                 self._working_thread.start()
 
-            self._frame_transmitters.add(frame_transmitter)
+        self.wakeup()
+
+        return self
 
     def remove_frame_transmitter(self, frame_transmitter):
+        working_thread = None
         with self._frame_transmitters_lock:
             self._frame_transmitters.remove(frame_transmitter)
 
             if not self._frame_transmitters:
-                # Release exit lock and wait until working thread will not
-                # terminate.
+                self._exit_event.set()
+                working_thread = self._working_thread
+                self._working_thread = None
+
+        if working_thread is not None:
+            # Wait for working thread termination without lock, because
+            # working thread acquires it.
+            self.wakeup()
+            if working_thread is not threading.current_thread():
+                working_thread.join()
+
+    def wakeup(self):
+        """Makes working thread to update transmitters. May be called from
+        any thread.
+        """
+        if self._wakeup_pending:
+            # Working thread will update transmitters after clearing flag.
+            return
+
+        self._wakeup_pending = True
+        try:
+            os.write(self._wakeup_write_fd, "\0")
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
 
-                # If _exit_lock already released then somebody already called
-                # terminate().
-                self._exit_lock.release()
-                self._working_thread.join()
+    def _wait(self, fds, timeout):
+        try:
+            select.select([self._wakeup_read_fd] + fds, [], [], timeout)
+        except (select.error, ValueError):
+            # Some of link descriptors closed.
+            time.sleep(config.frame_transmitter_thread_sleep_time)
 
-                self._working_thread = None        
+        if self._wakeup_pending:
+            os.read(self._wakeup_read_fd, 4096)
+            self._wakeup_pending = False
 
-    def _work(self):
+    def _work(self, exit_event):
         self._logger.info("Working thread started")
         
-        while True:
-            if self._exit_lock.acquire(False):
-                # Obtained exit lock. Terminate.
-
-                self._exit_lock.release()
-                self._logger.info("Exit working thread")
-                return
-
+        while not exit_event.is_set():
+            deadline = None
+            fds = []
             with self._frame_transmitters_lock:
-                for frame_transmitter in self._frame_transmitters:
+                count = len(self._frame_transmitters)
+                if count == 0:
+                    # Last transmitter removed, exit event is set.
+                    continue
+                start = self._next_frame_transmitter % count
+                self._next_frame_transmitter = start + 1
+                for i in xrange(count):
+                    frame_transmitter = \
+                        self._frame_transmitters[(start + i) % count]
                     frame_transmitter.update()
 
-            time.sleep(config.frame_transmitter_thread_sleep_time)
+                    update_time = frame_transmitter.next_update_time()
+                    if update_time is not None:
+                        deadline = update_time if deadline is None else \
+                            min(deadline, update_time)
+                    if frame_transmitter.is_polled:
+                        # Data written by other process will be noticed
+                        # only on next update.
+                        poll_time = time.time() + \
+                            config.frame_transmitter_thread_sleep_time
+                        deadline = poll_time if deadline is None else \
+                            min(deadline, poll_time)
+                    fds.extend(frame_transmitter.read_fds())
+
+            timeout = max(0, deadline - time.time()) \
+                if deadline is not None else None
+            self._wait(fds, timeout)
+
+        self._logger.info("Exit working thread")
+
+class FrameTransmitterWorkerPool(object):
+    """Distributes frame transmitters between several workers, so that slow
+    update of one transmitter doesn't delay transmitters of other workers.
+    Transmitter is assigned to the least loaded worker.
+    """
+
+    def __init__(self, workers_count=None):
+        super(FrameTransmitterWorkerPool, self).__init__()
+
+        if workers_count is None:
+            workers_count = config.frame_transmitter_workers_count
+        assert workers_count > 0
+
+        self._workers = [FrameTransmitterWorker()
+            for i in xrange(workers_count)]
+        # Number of transmitters assigned to each worker.
+        self._loads = [0] * workers_count
+        # { frame transmitter: index of worker }
+        self._assignment = {}
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        return tuple(self._workers)
+
+    def add_frame_transmitter(self, frame_transmitter):
+        """Assigns `frame_transmitter' to worker. Returns assigned worker."""
+        with self._lock:
+            assert frame_transmitter not in self._assignment
+            index = min(xrange(len(self._workers)),
+                key=self._loads.__getitem__)
+            self._assignment[frame_transmitter] = index
+            self._loads[index] += 1
+
+        return self._workers[index].add_frame_transmitter(frame_transmitter)
+
+    def remove_frame_transmitter(self, frame_transmitter):
+        with self._lock:
+            index = self._assignment.pop(frame_transmitter)
+            self._loads[index] -= 1
+
+        self._workers[index].remove_frame_transmitter(frame_transmitter)
+
+    def wakeup(self):
+        for worker in self._workers:
+            worker.wakeup()
+
+worker = FrameTransmitterWorkerPool()
+
+class RttEstimator(object):
+    """Estimates smoothed round trip time `srtt', its variation `rttvar' and
+    retransmission timeout `rto' as described in RFC 6298. Timeout is
+    doubled on each `backoff()' until next RTT sample or `reset_backoff()'.
+    If `adaptive' is False RTT is estimated, but timeout remains
+    `initial_rto'.
+    """
+
+    alpha = 1 / 8.0
+    beta  = 1 / 4.0
+    k     = 4
+
+    def __init__(self, initial_rto, min_rto=0.02, max_rto=10.0,
+            adaptive=True):
+        super(RttEstimator, self).__init__()
+        assert 0 < min_rto <= max_rto
+
+        self._min_rto = min_rto
+        self._max_rto = max_rto
+        self._adaptive = adaptive
+
+        self._initial_rto = initial_rto
+        self._srtt = None
+        self._rttvar = None
+        self._rto = initial_rto
+
+        self._samples_count = 0
+        self._backoffs_count = 0
+
+    @property
+    def srtt(self):
+        """Smoothed RTT or None if there were no samples."""
+        return self._srtt
 
-worker = FrameTransmitterWorker()
+    @property
+    def rttvar(self):
+        return self._rttvar
+
+    @property
+    def rto(self):
+        return self._rto
+
+    @property
+    def samples_count(self):
+        return self._samples_count
+
+    @property
+    def backoffs_count(self):
+        return self._backoffs_count
+
+    def add_sample(self, rtt):
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2.0
+        else:
+            self._rttvar = (1 - self.beta) * self._rttvar + \
+                self.beta * abs(self._srtt - rtt)
+            self._srtt = (1 - self.alpha) * self._srtt + self.alpha * rtt
+        self._samples_count += 1
+
+        if self._adaptive:
+            self._rto = min(self._max_rto, max(self._min_rto,
+                self._srtt + self.k * self._rttvar))
+
+    def backoff(self):
+        """Called on retransmission timeout."""
+        self._backoffs_count += 1
+        if self._adaptive:
+            self._rto = min(self._max_rto, self._rto * 2)
+
+    def reset_backoff(self):
+        """Recalculates timeout from RTT estimation, dropping backoff.
+        Called when new data is acknowledged (RFC 6298, 5.7): otherwise, if
+        all acknowledged frames were retransmitted (so they can't be
+        sampled by Karn's algorithm), timeout would stay backed off.
+        """
+        if not self._adaptive:
+            return
+        if self._srtt is None:
+            self._rto = self._initial_rto
+        else:
+            self._rto = min(self._max_rto, max(self._min_rto,
+                self._srtt + self.k * self._rttvar))
 
 class FrameTransmitter(object):
     _frame_id_period = 32768
+    # Number of logical streams.
+    streams_count = 256
+
+    # `items' are memoryviews of datagrams and _ChunkSource's of chunked
+    # messages waiting for sending, `offset' is offset of next frame data in
+    # the first item.
+    _SendStream = recordtype('SendStream', 'items offset')
+    # `buffer' is buffer of currently reassembled datagram (allocated when
+    # its first frame is received), `size' is size of data received into
+    # it, `chunk_reader' is _ChunkReader of currently received chunked
+    # message, `seq' is number of the next frame of stream, `pending' is
+    # { frame number: frame } of out of order received frames of stream.
+    _ReceiveStream = recordtype('ReceiveStream',
+        'buffer size chunk_reader seq pending')
 
     class _SendWindow(object):
-        SendItem = recordtype('SendItem', 'id time frame ack_received')
+        # `time' is time of last transmission of frame, `deadline' is time
+        # of retransmission.
+        SendItem = recordtype('SendItem',
+            'id time frame ack_received deadline retransmissions')
 
-        def __init__(self, logger, maxlen, frame_id_it, timeout):
+        def __init__(self, logger, maxlen, frame_id_period, rtt_estimator):
             super(FrameTransmitter._SendWindow, self).__init__()
+            assert maxlen <= frame_id_period
 
             self._logger = logger
             self.maxlen = maxlen
-            self.queue = deque(maxlen=maxlen)
-            self.frame_id_it = frame_id_it
-            self.timeout = timeout
+            self.frame_id_period = frame_id_period
+            self.rtt_estimator = rtt_estimator
+            # Maximum number of not acknowledged items (effective window
+            # size), not greater than `maxlen'.
+            self.limit = maxlen
+
+            # Ring of sent and not yet acknowledged items. Item for frame
+            # with id `frame_id' is stored in slot
+            # `(head + (frame_id - base) mod frame_id_period) mod maxlen'.
+            self._slots = [None] * maxlen
+            # Slot of the oldest item in window.
+            self._head = 0
+            # Id of the oldest item in window.
+            self._base = 0
+            self._count = 0
+
+            # Heap of retransmission timers: tuples (deadline, sequence
+            # number, item). Timers are cancelled lazily: timer is dropped
+            # when it reaches top of heap if item is acknowledged or its
+            # timer was restarted.
+            self._timers = []
+            self._timers_seq = itertools.count()
+
+        def __len__(self):
+            return self._count
+
+        @property
+        def base(self):
+            """Id of the oldest not acknowledged frame."""
+            return self._base
+
+        def _slot(self, frame_id):
+            """Returns slot index for `frame_id' or None if frame is outside
+            window.
+            """
+            offset = (frame_id - self._base) % self.frame_id_period
+            if offset < self._count:
+                return (self._head + offset) % self.maxlen
+            else:
+                return None
+
+        def items(self):
+            """Iterates over items from the oldest to the newest."""
+            for offset in xrange(self._count):
+                yield self._slots[(self._head + offset) % self.maxlen]
 
         def can_add_next(self):
-            return len(self.queue) < self.maxlen
+            return self._count < self.limit
 
-        def add_next(self, is_last, data, curtime=None):
+        def add_next(self, is_last, data, curtime=None, datagram_size=None,
+                is_chunked=False, stream=0, seq=0):
             assert self.can_add_next()
 
             using_curtime = curtime if curtime is not None else time.time()
 
-            frame_id = self.frame_id_it.next()
+            frame_id = (self._base + self._count) % self.frame_id_period
             p = Frame(type=FrameType.data, id=frame_id, is_last=is_last,
-                data=data)
+                data=data, datagram_size=datagram_size, is_chunked=is_chunked,
+                stream=stream, seq=seq)
             item = FrameTransmitter._SendWindow.SendItem(
-                frame_id, using_curtime, p, False)
-            self.queue.append(item)
+                frame_id, using_curtime, p, False, None, 0)
+            self._slots[(self._head + self._count) % self.maxlen] = item
+            self._count += 1
+            self._push_timer(item)
 
             return item
 
+        def _push_timer(self, item):
+            item.deadline = item.time + self.rtt_estimator.rto
+            heapq.heappush(self._timers,
+                (item.deadline, self._timers_seq.next(), item))
+
+            if len(self._timers) > 4 * self.maxlen:
+                # Too many cancelled timers, rebuild heap.
+                self._timers = [timer for timer in self._timers
+                    if self._is_timer_active(timer)]
+                heapq.heapify(self._timers)
+
+        def _is_timer_active(self, timer):
+            deadline, seq, item = timer
+            return not item.ack_received and deadline == item.deadline
+
+        def _drop_cancelled_timers(self):
+            while self._timers and not self._is_timer_active(self._timers[0]):
+                heapq.heappop(self._timers)
+
+        def next_deadline(self):
+            """Returns time of the earliest retransmission or None."""
+            self._drop_cancelled_timers()
+            return self._timers[0][0] if self._timers else None
+
         def timeout_items(self, curtime=None):
+            """Returns list of items with expired timers. Expired timers are
+            removed, so `restart_timer()' should be called for each returned
+            item.
+            """
             using_curtime = curtime if curtime is not None else time.time()
-            for item in self.queue:
-                if item.time + self.timeout < using_curtime:
-                    yield item
-
-        def ack_received(self, frame_id):
-            # TODO: Performance issue.
-            for item in self.queue:
-                if item.id == frame_id:
-                    item.ack_received = True
+            items = []
+            while True:
+                self._drop_cancelled_timers()
+                if not self._timers or self._timers[0][0] >= using_curtime:
                     break
+                items.append(heapq.heappop(self._timers)[2])
+            return items
+
+        def restart_timer(self, item, curtime=None):
+            """Restarts timer of retransmitted item."""
+            item.time = curtime if curtime is not None else time.time()
+            item.retransmissions += 1
+            self._push_timer(item)
+
+        def _sample_rtt(self, acknowledged, curtime):
+            """Updates RTT estimation using newly `acknowledged' items."""
+            # Karn's algorithm: acknowledge of retransmitted frame is
+            # ambiguous.
+            times = [item.time for item in acknowledged
+                if item.retransmissions == 0]
+            if times:
+                # The most recently sent frame caused acknowledge.
+                using_curtime = \
+                    curtime if curtime is not None else time.time()
+                self.rtt_estimator.add_sample(using_curtime - max(times))
+
+        def ack_received(self, frame_id, curtime=None):
+            """Returns number of newly acknowledged items."""
+            acknowledged_count = 0
+            slot = self._slot(frame_id)
+            if slot is not None:
+                item = self._slots[slot]
+                if not item.ack_received:
+                    item.ack_received = True
+                    acknowledged_count = 1
+                    self._sample_rtt([item], curtime)
             else:
                 self._logger.warning(
                     "Received ack for frame outside working window: {0}".
                         format(frame_id))
 
-            while len(self.queue) > 0 and self.queue[0].ack_received:
-                self.queue.popleft()
+            self._remove_acknowledged()
+            return acknowledged_count
+
+        def sack_received(self, next_id, selective_ids, curtime=None):
+            """Handles cumulative ACK of all frames before `next_id' and
+            selective ACKs of frames with `selective_ids'. Returns number of
+            newly acknowledged items.
+            """
+            slots = []
+            offset = (next_id - self._base) % self.frame_id_period
+            if offset <= self._count:
+                slots.extend((self._head + i) % self.maxlen
+                    for i in xrange(offset))
+            # Otherwise ACK is outdated.
+
+            for frame_id in selective_ids:
+                slot = self._slot(frame_id)
+                if slot is not None:
+                    slots.append(slot)
+
+            acknowledged = []
+            for slot in slots:
+                item = self._slots[slot]
+                if not item.ack_received:
+                    item.ack_received = True
+                    acknowledged.append(item)
+            self._sample_rtt(acknowledged, curtime)
+
+            self._remove_acknowledged()
+            return len(acknowledged)
+
+        def nak_received(self, missing_ids):
+            """Returns not acknowledged items for frames with `missing_ids'
+            reported missing by receiver.
+            """
+            items = []
+            for frame_id in missing_ids:
+                slot = self._slot(frame_id)
+                if slot is not None and not self._slots[slot].ack_received:
+                    items.append(self._slots[slot])
+            return items
+
+        def _remove_acknowledged(self):
+            while self._count > 0 and self._slots[self._head].ack_received:
+                self._slots[self._head] = None
+                self._head = (self._head + 1) % self.maxlen
+                self._base = (self._base + 1) % self.frame_id_period
+                self._count -= 1
 
     class _ReceiveWindow(object):
-        ReceiveItem = recordtype('ReceiveItem', 'id frame')
-
-        def __init__(self, logger, maxlen, frame_id_it):
+        # Missing frame not reported yet: `id' is its id, `received_after'
+        # is number of received frames after it.
+        _Gap = recordtype('Gap', 'id received_after')
+        # Placeholder of frame which was delivered before preceding frames.
+        delivered = object()
+
+        def __init__(self, logger, maxlen, frame_id_period,
+                nak_threshold=1):
             super(FrameTransmitter._ReceiveWindow, self).__init__()
+            assert maxlen <= frame_id_period
+            assert nak_threshold is None or nak_threshold >= 1
 
             self._logger = logger
-            self.queue = deque(maxlen=maxlen)
-            self.frame_id_it = frame_id_it
-
-            # Fill receive window with placeholders for receiving frames.
-            for idx in xrange(maxlen):
-                item = FrameTransmitter._ReceiveWindow.ReceiveItem(
-                    self.frame_id_it.next(), None)
-                self.queue.append(item)
-
-        def receive_frame(self, frame):
-            # TODO: Performance issue.
-            for item in self.queue:
-                if item.id == frame.id:
-                    item.frame = frame
-                    break
+            self.maxlen = maxlen
+            self.frame_id_period = frame_id_period
+            # Number of frames received after missing frame, when it is
+            # reported missing. If None missing frames aren't tracked.
+            self.nak_threshold = nak_threshold
+
+            # Ring of received frames (None for not yet received frames).
+            # Frame with id `frame_id' is stored in slot
+            # `(head + (frame_id - base) mod frame_id_period) mod maxlen'.
+            self._slots = [None] * maxlen
+            # Slot of the next expected frame.
+            self._head = 0
+            # Id of the next expected frame.
+            self._base = 0
+            # Offset from `base' following the farthest received frame.
+            self._end = 0
+            # Not reported missing frames in order of ids.
+            self._gaps = deque()
+
+        @property
+        def base(self):
+            """Id of the next expected frame."""
+            return self._base
+
+        def selective_offsets(self):
+            """Returns offsets from `base' of received out of order frames.
+            """
+            return [offset for offset in xrange(1, self.maxlen)
+                if self._slots[(self._head + offset) % self.maxlen]
+                    is not None]
+
+        def get(self, frame_id):
+            """Returns stored frame with `frame_id' or None."""
+            offset = (frame_id - self._base) % self.frame_id_period
+            if offset >= self.maxlen:
+                return None
+            return self._slots[(self._head + offset) % self.maxlen]
+
+        def mark_delivered(self, frame_id):
+            """Replaces stored frame with `frame_id' with `delivered'
+            placeholder, so that it is acknowledged, but not yielded by
+            `in_order_frames()'.
+            """
+            offset = (frame_id - self._base) % self.frame_id_period
+            assert offset < self.maxlen
+            self._slots[(self._head + offset) % self.maxlen] = self.delivered
+
+        def add_frame(self, frame):
+            """Stores received `frame'. Returns offsets from `base' of newly
+            detected missing frames: not received frames followed by
+            `nak_threshold' received frames. Each missing frame is reported
+            only once.
+            """
+            offset = (frame.id - self._base) % self.frame_id_period
+            if offset < self.maxlen:
+                slot = (self._head + offset) % self.maxlen
+                if self._slots[slot] is not None:
+                    # Duplicate frame.
+                    return []
+                self._slots[slot] = frame
+                missing = []
+                if self.nak_threshold is not None:
+                    missing = self._update_gaps(offset)
+                self._end = max(self._end, offset + 1)
+                return missing
             else:
                 self._logger.warning(
                     "Received frame outside working window: {0}".
                         format(frame))
+                return []
+
+        def _update_gaps(self, offset):
+            """Updates missing frames when frame with `offset' is received.
+            Returns offsets of missing frames which should be reported.
+            Usually frames are received in order and there are no gaps, or
+            gaps are reported after `nak_threshold' frames.
+            """
+            for i in xrange(self._end, offset):
+                self._gaps.append(FrameTransmitter._ReceiveWindow._Gap(
+                    (self._base + i) % self.frame_id_period, 0))
+
+            missing = []
+            gaps = deque()
+            for gap in self._gaps:
+                gap_offset = (gap.id - self._base) % self.frame_id_period
+                if gap_offset == offset:
+                    # Missing frame received.
+                    continue
+                if gap_offset < offset:
+                    gap.received_after += 1
+                    if gap.received_after >= self.nak_threshold:
+                        missing.append(gap_offset)
+                        continue
+                gaps.append(gap)
+            self._gaps = gaps
+            return missing
 
-            while self.queue[0].frame is not None:
-                yield self.queue[0].frame
-
-                self.queue.popleft()
-                new_item = FrameTransmitter._ReceiveWindow.ReceiveItem(
-                    self.frame_id_it.next(), None)
-                self.queue.append(new_item)
+        def receive_frame(self, frame):
+            self.add_frame(frame)
+            return self.in_order_frames()
+
+        def in_order_frames(self):
+            """Yields received frames starting from `base'. Frame is removed
+            from window only when the next frame is requested, so frame
+            which caller didn't handle is yielded again on the next call.
+            Already delivered frames are skipped.
+            """
+            while self._slots[self._head] is not None:
+                if self._slots[self._head] is not self.delivered:
+                    yield self._slots[self._head]
+
+                self._slots[self._head] = None
+                self._head = (self._head + 1) % self.maxlen
+                self._base = (self._base + 1) % self.frame_id_period
+                self._end = max(0, self._end - 1)
+
+    class _ChunkSource(object):
+        """Slices frames data from message source: file-like object (with
+        `read()' method, e.g. file or mmap) or iterable of strings. Source
+        is read only when the next frame data is requested.
+        """
+
+        def __init__(self, source, max_frame_data):
+            super(FrameTransmitter._ChunkSource, self).__init__()
+
+            if hasattr(source, 'read'):
+                self._pieces = iter(
+                    lambda: source.read(max_frame_data), "")
+            else:
+                self._pieces = iter(source)
+            self._max_frame_data = max_frame_data
+            # Not sent part of current piece of source.
+            self._piece = memoryview("")
+            # Next frame data (read one frame ahead to detect the last
+            # frame).
+            self._next = self._read()
+
+        def _read(self):
+            while not self._piece:
+                try:
+                    self._piece = memoryview(self._pieces.next())
+                except StopIteration:
+                    return None
+            data = self._piece[:self._max_frame_data]
+            self._piece = self._piece[self._max_frame_data:]
+            return data
+
+        def next_frame_data(self):
+            """Returns tuple (is_last, data)."""
+            data = self._next
+            self._next = self._read()
+            return (self._next is None,
+                data if data is not None else memoryview(""))
+
+    class _ChunkReader(object):
+        """Iterator over chunks of message received in order. Chunks are
+        buffered until `limit' chunks are not read.
+        """
+
+        def __init__(self, limit, on_read):
+            super(FrameTransmitter._ChunkReader, self).__init__()
+
+            self.limit = limit
+            # Called after chunk is read.
+            self._on_read = on_read
+            # Chunks, None marks the end of message.
+            self._chunks = Queue.Queue()
+            self._closed = False
+            # False if message end was not received (e.g. link went down).
+            self.complete = None
+
+        def __iter__(self):
+            return self
+
+        def full(self):
+            return self._chunks.qsize() >= self.limit
+
+        def put(self, chunk):
+            self._chunks.put(chunk)
+
+        def close(self, complete=True):
+            self.complete = complete
+            self._chunks.put(None)
+
+        def next(self):
+            if self._closed:
+                raise StopIteration
+
+            chunk = self._chunks.get()
+            self._on_read()
+            if chunk is None:
+                self._closed = True
+                raise StopIteration
+            return chunk
 
     def __init__(self, *args, **kwargs):
         self._simple_frame_transmitter = kwargs.pop('simple_frame_transmitter')
+        # Maximum size of data in frame. Frames received from other link
+        # end are limited to the same size, so both link ends should use
+        # the same value (or other link end the smaller one).
         self._max_frame_data = kwargs.pop('max_frame_data', 100)
+        # Maximum size of sent and received datagrams. Receiver allocates
+        # buffer of size taken from the first frame of datagram, so size
+        # should be limited.
+        self._max_datagram_size = kwargs.pop('max_datagram_size', 16 * 2**20)
         self._window_size = kwargs.pop('window_size', 100)
+        # ARQ strategy name from `arq.arq_strategies' or ArqStrategy object.
+        self._arq = get_arq_strategy(kwargs.pop('arq', 'selective_repeat'))
+        # Initial retransmission timeout (constant if adaptive timeout is
+        # disabled).
         self._ack_timeout = kwargs.pop('ack_timeout', 0.5)
+        self._adaptive_ack_timeout = kwargs.pop('adaptive_ack_timeout', True)
+        self._min_ack_timeout = kwargs.pop('min_ack_timeout', 0.02)
+        self._max_ack_timeout = kwargs.pop('max_ack_timeout', 10.0)
+        # Delay of acknowledge of in order received frame. All frames
+        # received during delay are acknowledged with single frame.
+        self._ack_delay = kwargs.pop('ack_delay', 0.005)
+        # Number of in order received frames which are acknowledged without
+        # waiting for `ack_delay' (limited by receive window size, so that
+        # small windows aren't stalled by delayed acknowledges).
+        self._ack_frames = kwargs.pop('ack_frames', 2)
+        # If True receiver sends NAK for missing frame when it receives
+        # `nak_threshold' frames after the gap, and sender retransmits it
+        # without waiting for timeout. Threshold should exceed reordering
+        # depth of link (e.g. bonded link), otherwise reordered frames are
+        # retransmitted spuriously.
+        self._fast_retransmit = kwargs.pop('fast_retransmit', True)
+        self._nak_threshold = kwargs.pop('nak_threshold', 3)
+        # If True effective send window size is adjusted in range from 1 to
+        # `window_size': increased on acknowledges and decreased twice on
+        # timeouts (AIMD).
+        self._adaptive_window = kwargs.pop('adaptive_window', False)
+        # Maximum number of new frames sent and received frames handled in
+        # one `update()' call. By default whole window can be filled in one
+        # call.
+        self._update_budget = kwargs.pop('update_budget', None)
+        if self._update_budget is None:
+            self._update_budget = self._window_size
+        # High and low water marks of queue of not sent frames. When queue
+        # size reaches high water mark, `send()' blocks (or fails in
+        # non-blocking mode) until queue size drops to low water mark
+        # (by default half of high water mark). By default queue is not
+        # bounded.
+        self._send_high_water = kwargs.pop('send_high_water', None)
+        self._send_low_water = kwargs.pop('send_low_water', None)
+        if self._send_low_water is None and self._send_high_water is not None:
+            self._send_low_water = self._send_high_water // 2
+        # Same for queue of received datagrams. When it is full, received
+        # frames are not delivered (and not acknowledged) until `receive()'
+        # takes datagrams from queue, so sender is slowed down.
+        self._receive_high_water = kwargs.pop('receive_high_water', None)
+        self._receive_low_water = kwargs.pop('receive_low_water', None)
+        if (self._receive_low_water is None and
+                self._receive_high_water is not None):
+            self._receive_low_water = self._receive_high_water // 2
 
         global worker
         self._worker = kwargs.pop('worker', worker)
@@ -298,25 +1020,95 @@ class FrameTransmitter(object):
                 "FrameTransmitter.{0}->{1}".format(
                     self._debug_src, self._debug_dest))
 
-        # Queue of tuples (is_last, frame_data).
-        self._frames_data_to_send = Queue.Queue()
-        # Queue of tuples (is_last, frame_data).
+        # { stream id: _SendStream }. Frames data is sliced from queued
+        # datagrams only when frames are sent.
+        self._send_streams = {}
+        # Ids of streams with queued data in round-robin order: frames of
+        # different streams are interleaved.
+        self._active_streams = deque()
+        # { stream id: number of the next sent frame of stream }.
+        self._send_seqs = {}
+        # Number of not yet sent frames of queued datagrams (each chunked
+        # message is counted as one frame).
+        self._frames_to_send_count = 0
+        self._send_queue_lock = threading.Lock()
+        # Notified when send queue is not full.
+        self._send_queue_not_full = threading.Condition(self._send_queue_lock)
+        # True since send queue reached high water mark until it drops to
+        # low water mark.
+        self._send_queue_full = False
+        # Total time spent by senders waiting for space in send queue.
+        self._send_blocked_time = 0.0
+        # Number of datagrams not sent due to full send queue.
+        self._send_rejected_count = 0
+        # Queue of tuples (stream id, received datagram).
         self._received_data = Queue.Queue()
-
-        self._received_frames_buffer = []
-
+        # True since queue of received datagrams reached high water mark
+        # until it drops to low water mark.
+        self._receive_queue_full = False
+
+        # { stream id: _ReceiveStream }.
+        self._receive_streams = {}
+        # Ids of streams with out of order received frames.
+        self._pending_streams = set()
+        # Queue of _ChunkReader's of received chunked messages.
+        self._received_chunks = Queue.Queue()
+        # True if delivery of received frames is postponed until receiver
+        # reads received data.
+        self._delivery_blocked = False
+        # Set when receiver reads data, so that postponed delivery is
+        # retried.
+        self._delivery_retry = False
+        # Time when delivery was postponed and total time of postponed
+        # delivery.
+        self._delivery_blocked_since = None
+        self._delivery_blocked_time = 0.0
+        # Read raw frames which didn't fit in budget of `update()' call.
+        self._frames_to_handle = deque()
+        # Time when acknowledge of received frames should be sent or None.
+        self._ack_deadline = None
+        # Number of in order received frames not acknowledged yet.
+        self._not_acknowledged_count = 0
+
+        self._rtt_estimator = RttEstimator(self._ack_timeout,
+            min_rto=min(self._min_ack_timeout, self._ack_timeout),
+            max_rto=max(self._max_ack_timeout, self._ack_timeout),
+            adaptive=self._adaptive_ack_timeout)
+        self._retransmissions_count = 0
+        self._fast_retransmissions_count = 0
+        # Time of the last timeout backoff. Timers started before it expire
+        # in the same timeout event and don't back off timeout again.
+        self._backoff_time = None
+
+        self._send_window_size = \
+            self._arq.send_window_size(self._window_size)
         self._send_window = FrameTransmitter._SendWindow(
-            self._logger, self._window_size,
-            itertools.cycle(xrange(self._frame_id_period)),
-            self._ack_timeout)
+            self._logger, self._send_window_size, self._frame_id_period,
+            self._rtt_estimator)
+
+        # Congestion window. Below slow start threshold it grows by one
+        # frame on each acknowledged frame, above it grows by one frame per
+        # window of acknowledged frames.
+        self._congestion_window = float(self._send_window_size)
+        self._slow_start_threshold = float(self._send_window_size)
+        if self._adaptive_window:
+            self._congestion_window = 1.0
+        self._update_window_limit()
         self._receive_window = FrameTransmitter._ReceiveWindow(
-            self._logger, self._window_size,
-            itertools.cycle(xrange(self._frame_id_period)))
+            self._logger, self._arq.receive_window_size(self._window_size),
+            self._frame_id_period,
+            self._nak_threshold if self._fast_retransmit else None)
 
         self._enabled = True
         self._enabled_lock = threading.RLock()
 
-        self._worker.add_frame_transmitter(self)
+        # Worker which updates this transmitter (one of workers if
+        # `_worker' is a pool).
+        self._serving_worker = None
+        self._simple_frame_transmitter.set_max_frame_size(
+            self.max_frame_size)
+        self._simple_frame_transmitter.add_read_listener(self._wakeup)
+        self._serving_worker = self._worker.add_frame_transmitter(self)
 
     @property
     def enabled(self):
@@ -339,131 +1131,658 @@ class FrameTransmitter(object):
         pass
 
     def _link_down(self):
-        clear_queue(self._frames_data_to_send)
+        with self._send_queue_lock:
+            self._send_streams.clear()
+            self._active_streams.clear()
+            self._frames_to_send_count = 0
+            self._send_queue_full = False
+            self._send_queue_not_full.notify_all()
         clear_queue(self._received_data)
+        self._receive_queue_full = False
+        clear_queue(self._received_chunks)
+        # Streams keep numbers of frames: frames in windows are
+        # retransmitted when link is up again.
+        for stream in self._receive_streams.values():
+            self._drop_incomplete_message(stream)
+        self._set_delivery_blocked(False)
+
+    @property
+    def arq(self):
+        return self._arq
+
+    @property
+    def max_frame_size(self):
+        """Maximum size of serialized frame: data frame with datagram size
+        or SACK/NAK frame with bitmap for the whole frame id period.
+        """
+        return (Frame.empty_frame_size + Frame.datagram_size_size +
+            max(self._max_frame_data, self._frame_id_period // 8))
+
+    @property
+    def effective_window_size(self):
+        """Current maximum number of not acknowledged frames."""
+        return self._send_window.limit
+
+    def _update_window_limit(self):
+        self._send_window.limit = \
+            max(1, min(self._send_window_size, int(self._congestion_window)))
+
+    def _frames_acknowledged(self, count):
+        if not self._adaptive_window or count == 0:
+            return
+
+        for i in xrange(count):
+            if self._congestion_window < self._slow_start_threshold:
+                self._congestion_window += 1
+            else:
+                self._congestion_window += 1.0 / self._congestion_window
+        self._congestion_window = \
+            min(self._congestion_window, float(self._send_window_size))
+        self._update_window_limit()
+
+    def _frames_timed_out(self):
+        if not self._adaptive_window:
+            return
+
+        self._slow_start_threshold = max(1.0, self._congestion_window / 2)
+        self._congestion_window = self._slow_start_threshold
+        self._update_window_limit()
+
+    @property
+    def rtt_estimator(self):
+        """RttEstimator with current RTT estimation and retransmission
+        timeout.
+        """
+        return self._rtt_estimator
+
+    @property
+    def retransmissions_count(self):
+        return self._retransmissions_count
+
+    @property
+    def fast_retransmissions_count(self):
+        """Number of frames retransmitted on NAK (included in
+        `retransmissions_count').
+        """
+        return self._fast_retransmissions_count
+
+    @property
+    def outstanding_frames_count(self):
+        """Number of not sent or not acknowledged frames (not sent chunked
+        message is counted as one frame).
+        """
+        return len(self._send_window) + self._frames_to_send_count
+
+    @property
+    def send_blocked_time(self):
+        """Total time spent by senders waiting for space in send queue."""
+        return self._send_blocked_time
+
+    @property
+    def send_rejected_count(self):
+        """Number of datagrams not sent due to full send queue."""
+        return self._send_rejected_count
+
+    @property
+    def delivery_blocked_time(self):
+        """Total time when received frames were not delivered due to full
+        queue of received data.
+        """
+        blocked_since = self._delivery_blocked_since
+        return self._delivery_blocked_time + \
+            (time.time() - blocked_since if blocked_since is not None else 0)
 
     # TODO
     def terminate(self):
         self._worker.remove_frame_transmitter(self)
+        self._simple_frame_transmitter.remove_read_listener(self._wakeup)
+
+    def _wakeup(self):
+        serving_worker = self._serving_worker
+        if serving_worker is not None:
+            serving_worker.wakeup()
+
+    def _wait_send_queue(self, block, timeout):
+        """Waits until send queue is not full. Returns False if queue is
+        still full.
+        """
+        with self._send_queue_not_full:
+            if self._send_queue_full and block:
+                start = time.time()
+                while self._send_queue_full:
+                    if timeout is None:
+                        self._send_queue_not_full.wait()
+                    else:
+                        remaining = start + timeout - time.time()
+                        if remaining <= 0:
+                            break
+                        self._send_queue_not_full.wait(remaining)
+                self._send_blocked_time += time.time() - start
+
+            if self._send_queue_full:
+                self._send_rejected_count += 1
+                return False
+            return True
+
+    def _put_to_send(self, item, frames_count, stream, block, timeout):
+        assert 0 <= stream < self.streams_count
+
+        if not self._wait_send_queue(block, timeout):
+            return False
 
-    def send(self, data_string):
-        """Sends raw datagram."""
         with self._enabled_lock:
             if self._enabled:
-                # Subdivide data string on frames and put them into working
-                # queue.
-                frame_data_parts = \
-                    [data_string[i:i + self._max_frame_data]
-                        for i in xrange(
-                            0, len(data_string), self._max_frame_data)]
-                for frame_data_part in frame_data_parts[:-1]:
-                    self._frames_data_to_send.put((False, frame_data_part))
-                self._frames_data_to_send.put((True, frame_data_parts[-1]))
+                with self._send_queue_lock:
+                    send_stream = self._send_streams.get(stream)
+                    if send_stream is None:
+                        send_stream = FrameTransmitter._SendStream(
+                            deque(), 0)
+                        self._send_streams[stream] = send_stream
+                    if not send_stream.items:
+                        self._active_streams.append(stream)
+                    send_stream.items.append(item)
+                    self._frames_to_send_count += frames_count
+                    if (self._send_high_water is not None and
+                            self._frames_to_send_count >=
+                                self._send_high_water):
+                        self._send_queue_full = True
+                self._wakeup()
+                return True
             else:
                 # Link is down.
-                pass
+                return False
+
+    def send(self, data_string, stream=0, block=True, timeout=None):
+        """Sends raw datagram in logical stream `stream'. Frames of
+        datagrams of different streams are interleaved. `data_string' is
+        not copied, so it must not be modified until it is sent (if it is
+        mutable).
+        If send queue is full, waits for free space in it, at most `timeout'
+        seconds if `timeout' is not None. In non-blocking mode doesn't wait.
+        Returns True if datagram is queued for sending.
+        """
+        # Datagram is subdivided on frames when they are sent.
+        data = memoryview(data_string)
+        assert len(data) <= self._max_datagram_size
+        frames_count = max(1,
+            (len(data) + self._max_frame_data - 1) // self._max_frame_data)
+        return self._put_to_send(data, frames_count, stream, block, timeout)
 
     def receive(self, block=True):
         """Returns raw datagram if any received."""
+        return self.receive_with_stream(block)[1]
+
+    def receive_with_stream(self, block=True):
+        """Returns tuple (stream id, raw datagram) for received datagram or
+        (None, None) if no datagram received. Datagrams of different
+        streams are returned in order of reassembly completion.
+        """
         with self._enabled_lock:
             if self._enabled:
-                while True:
-                    try:
-                        is_last, frame = self._received_data.get(block)
-                        self._received_frames_buffer.append(frame)
-                        if is_last:
-                            data_string = "".join(self._received_frames_buffer)
-                            self._received_frames_buffer = []
-                            return data_string
-                    except Queue.Empty:
-                        break
+                try:
+                    stream, data = self._received_data.get(block)
+                except Queue.Empty:
+                    return None, None
+                if (self._receive_queue_full and
+                        self._received_data.qsize() <=
+                            self._receive_low_water):
+                    self._receive_queue_full = False
+                    self._data_read()
+                return stream, data
             else:
                 # Link is down.
                 assert self._received_data.empty()
-                assert not self._received_frames_buffer
+                return None, None
+
+    def send_chunks(self, source, stream=0, block=True, timeout=None):
+        """Sends message read from `source': file-like object (e.g. file or
+        mmap) or iterable of strings. Source is read only when frames are
+        sent (in working thread), so at most send window of message data is
+        held in memory. Message is received with `receive_chunks()'.
+        Blocks on full send queue as `send()'.
+        """
+        chunk_source = FrameTransmitter._ChunkSource(source,
+            self._max_frame_data)
+        return self._put_to_send(chunk_source, 1, stream, block, timeout)
+
+    def receive_chunks(self, block=True):
+        """Returns iterator over chunks of received message sent with
+        `send_chunks()' if any received (its `stream' attribute is id of
+        stream). Chunks are returned as soon as they are received in order.
+        Receiver doesn't acknowledge frames while window of chunks is not
+        read, so unread data is bounded by window size.
+        """
+        with self._enabled_lock:
+            if self._enabled:
+                try:
+                    return self._received_chunks.get(block)
+                except Queue.Empty:
+                    return None
+            else:
+                # Link is down.
+                assert self._received_chunks.empty()
                 return None
 
-    def update(self):
-        """Send/receive frames. Called from working thread."""
-        # Send frames.
-        if (not self._frames_data_to_send.empty() and
-                self._send_window.can_add_next()):
-            # Have frame for sending in queue and free space in send
-            # window. Send frame.
-
-            is_last, frame_data = self._frames_data_to_send.get()
+    def _data_read(self):
+        """Called when receiver reads received data."""
+        self._delivery_retry = True
+        if self._delivery_blocked:
+            self._wakeup()
+
+    def _next_frame_data(self):
+        """Slices data for next frame from queued datagrams, taking streams
+        in round-robin order. Returns dictionary with `stream', `seq',
+        `is_last', `data' (memoryview), `datagram_size' (None if frame is not
+        the first frame of datagram) and `is_chunked' keys or None if there
+        is no data to send.
+        """
+        with self._send_queue_lock:
+            if not self._active_streams:
+                return None
 
-            item = self._send_window.add_next(is_last, frame_data)
+            stream = self._active_streams.popleft()
+            send_stream = self._send_streams[stream]
+            datagram = send_stream.items[0]
+            start = send_stream.offset
+            is_source = isinstance(datagram, FrameTransmitter._ChunkSource)
+            if is_source:
+                try:
+                    is_last, data = datagram.next_frame_data()
+                except Exception:
+                    self._logger.exception(
+                        "Failed to read chunked message, message truncated")
+                    is_last, data = True, memoryview("")
+                end = start + len(data)
+                datagram_size = None
+                is_chunked = start == 0
+            else:
+                end = start + self._max_frame_data
+                is_last = end >= len(datagram)
+                data = datagram[start:end]
+                datagram_size = len(datagram) if start == 0 else None
+                is_chunked = False
+
+            if is_last:
+                send_stream.items.popleft()
+                send_stream.offset = 0
+            else:
+                send_stream.offset = end
+            seq = self._send_seqs.get(stream, 0)
+            self._send_seqs[stream] = (seq + 1) % Frame.seq_period
+            if send_stream.items:
+                self._active_streams.append(stream)
+            else:
+                del self._send_streams[stream]
+
+            if not is_source or is_last:
+                # Chunked message is counted as one frame.
+                self._frames_to_send_count -= 1
+                self._check_send_queue_drained()
+
+            return dict(stream=stream, seq=seq, is_last=is_last, data=data,
+                datagram_size=datagram_size, is_chunked=is_chunked)
+
+    def _check_send_queue_drained(self):
+        # Called with `_send_queue_lock' held.
+        if (self._send_queue_full and
+                self._frames_to_send_count <= self._send_low_water):
+            self._send_queue_full = False
+            self._send_queue_not_full.notify_all()
+
+    def _drop_incomplete_message(self, stream):
+        if stream.buffer is not None:
+            self._logger.warning("Dropping incomplete datagram")
+            stream.buffer = None
+        if stream.chunk_reader is not None:
+            self._logger.warning("Chunked message is incomplete")
+            stream.chunk_reader.close(complete=False)
+            stream.chunk_reader = None
+
+    def _receive_stream(self, stream_id):
+        stream = self._receive_streams.get(stream_id)
+        if stream is None:
+            stream = FrameTransmitter._ReceiveStream(None, 0, None, 0, {})
+            self._receive_streams[stream_id] = stream
+        return stream
+
+    def _reassemble(self, frame):
+        """Copies data of in order received `frame' into buffer of
+        reassembled datagram of frame stream. Puts datagram into queue of
+        received data when its last frame is received. Returns False if
+        frame can't be handled until receiver reads received data.
+        """
+        if frame.datagram_size is not None and self._receive_queue_full:
+            return False
+
+        stream = self._receive_stream(frame.stream)
+        if frame.is_chunked:
+            # The first frame of chunked message.
+            self._drop_incomplete_message(stream)
+            stream.chunk_reader = FrameTransmitter._ChunkReader(
+                self._receive_window.maxlen, self._data_read)
+            stream.chunk_reader.stream = frame.stream
+            self._received_chunks.put(stream.chunk_reader)
+        elif frame.datagram_size is not None:
+            # The first frame of datagram.
+            self._drop_incomplete_message(stream)
+
+            if frame.datagram_size > self._max_datagram_size:
+                self._logger.warning(
+                    "Dropping too large datagram: {0} bytes".format(
+                        frame.datagram_size))
+                return True
+
+            if frame.is_last and len(frame.data) == frame.datagram_size:
+                # Single frame datagram is passed without copying.
+                self._put_received(frame.stream, frame.data)
+                return True
+
+            stream.buffer = bytearray(frame.datagram_size)
+            stream.size = 0
+        elif stream.chunk_reader is None and stream.buffer is None:
+            self._logger.warning(
+                "Received frame of unknown datagram: {0}".format(frame))
+            return True
+
+        if stream.chunk_reader is not None:
+            if stream.chunk_reader.full():
+                return False
+            if frame.data:
+                stream.chunk_reader.put(frame.data)
+            if frame.is_last:
+                stream.chunk_reader.close()
+                stream.chunk_reader = None
+            return True
+
+        start = stream.size
+        end = start + len(frame.data)
+        if end > len(stream.buffer) or \
+                (frame.is_last and end != len(stream.buffer)):
+            self._logger.warning(
+                "Datagram size mismatch, expected {0} bytes".format(
+                    len(stream.buffer)))
+            stream.buffer = None
+            return True
+
+        stream.buffer[start:end] = frame.data
+        stream.size = end
+
+        if frame.is_last:
+            self._put_received(frame.stream, str(stream.buffer))
+            stream.buffer = None
+        return True
+
+    def _put_received(self, stream, data):
+        self._received_data.put((stream, data))
+        if (self._receive_high_water is not None and
+                self._received_data.qsize() >= self._receive_high_water):
+            self._receive_queue_full = True
+
+    def _can_deliver_frames(self):
+        """Returns True if postponed delivery of frames should be retried.
+        """
+        return self._delivery_blocked and self._delivery_retry
+
+    def _set_delivery_blocked(self, blocked):
+        if blocked and not self._delivery_blocked:
+            self._delivery_blocked_since = time.time()
+        elif not blocked and self._delivery_blocked:
+            blocked_since = self._delivery_blocked_since
+            if blocked_since is not None:
+                self._delivery_blocked_time += time.time() - blocked_since
+            self._delivery_blocked_since = None
+        self._delivery_blocked = blocked
+
+    def _deliver_frames(self):
+        """Reassembles in order received frames and out of order received
+        frames which follow already reassembled frames of their streams.
+        Returns number of delivered frames.
+        """
+        delivered = 0
+        self._delivery_retry = False
+        blocked = False
+        for frame in self._receive_window.in_order_frames():
+            if not self._reassemble(frame):
+                blocked = True
+                break
+            self._frame_reassembled(frame)
+            delivered += 1
+
+        for stream_id in list(self._pending_streams):
+            stream = self._receive_streams[stream_id]
+            while not blocked and stream.seq in stream.pending:
+                frame = stream.pending[stream.seq]
+                if not self._reassemble(frame):
+                    blocked = True
+                    break
+                self._frame_reassembled(frame)
+                self._receive_window.mark_delivered(frame.id)
+                delivered += 1
+
+        self._set_delivery_blocked(blocked)
+        return delivered
+
+    def _frame_reassembled(self, frame):
+        stream = self._receive_streams[frame.stream]
+        stream.seq = (frame.seq + 1) % Frame.seq_period
+        stream.pending.pop(frame.seq, None)
+        if not stream.pending:
+            self._pending_streams.discard(frame.stream)
+
+    def next_update_time(self):
+        """Returns time when `update()' should be called next time, or None
+        if it should be called only on new data. Called from working thread.
+        """
+        if (self._frames_to_handle or
+                (self._active_streams and
+                    self._send_window.can_add_next()) or
+                self._can_deliver_frames()):
+            # Next frame can be handled right now.
+            return 0
+
+        deadline = self._send_window.next_deadline()
+        if self._ack_deadline is not None:
+            deadline = self._ack_deadline if deadline is None else \
+                min(deadline, self._ack_deadline)
+        return deadline
+
+    def read_fds(self):
+        """Returns descriptors which become readable when frames arrive."""
+        return self._simple_frame_transmitter.read_fds()
 
-            self._logger.debug("Sending:\n  {0}".format(str(item.frame)))
-            self._simple_frame_transmitter.write_frame(
-                item.frame.serialize())
+    @property
+    def is_polled(self):
+        return self._simple_frame_transmitter.is_polled
+
+    def update(self, budget=None):
+        """Send/receive frames. Called from working thread.
+        Handles at most `budget' (by default `update_budget' constructor
+        argument) received frames and sends at most `budget' new frames.
+        """
+        if budget is None:
+            budget = self._update_budget
+
+        # Handle receiving data first, so received ACKs free space in send
+        # window.
+        if len(self._frames_to_handle) < budget:
+            self._frames_to_handle.extend(
+                self._simple_frame_transmitter.read_frames())
+        if self._can_deliver_frames():
+            # Reader of chunked message has read chunks, acknowledge frames
+            # delivered now.
+            if self._deliver_frames() > 0:
+                self._ack_deadline = 0
+        for i in xrange(min(budget, len(self._frames_to_handle))):
+            self._handle_frame(self._frames_to_handle.popleft())
 
-        # Handle timeouts.
         curtime = time.time()
-        for item in self._send_window.timeout_items(curtime):
-            # TODO: Currently it is selective repeat.
+        if self._ack_deadline is not None and self._ack_deadline <= curtime:
+            self._send_ack()
 
+        # Handle timeouts.
+        timeout_items = self._send_window.timeout_items(curtime)
+        if any(self._backoff_time is None or item.time >= self._backoff_time
+                for item in timeout_items):
+            self._rtt_estimator.backoff()
+            self._backoff_time = curtime
+            self._frames_timed_out()
+        for item in self._arq.frames_to_retransmit(self._send_window,
+                timeout_items):
             self._logger.warning("Resending due to timeout:\n  {0}".format(
                 str(item.frame)))
             self._simple_frame_transmitter.write_frame(
                 item.frame.serialize())
-            item.time = curtime
-        assert len(list(self._send_window.timeout_items(curtime))) == 0
-
-        # Handle receiving data.
-        frame = self._simple_frame_transmitter.read_frame(block=False)
-        if frame is not None:
-            # Received frame.
-
-            try:
-                p = Frame.deserialize(frame)
-            except InvalidFrameException as ex:
-                self._logger.warning("Received invalid frame: {0}".format(
-                    str(ex)))
-            else:
-                self._logger.debug("Received:\n  {0}".format(p))
+            self._send_window.restart_timer(item, curtime)
+            self._retransmissions_count += 1
 
-                if p.type == FrameType.data:
-                    # Received data.
+        # Send frames while have frames for sending in queue and free space
+        # in send window.
+        for i in xrange(budget):
+            if not self._send_window.can_add_next():
+                break
+            frame_data = self._next_frame_data()
+            if frame_data is None:
+                break
 
-                    # Send ACK (even if frame already received before).
-                    ack = Frame(type=FrameType.ack, id=p.id, data="")
-                    self._logger.debug("Sending acknowledge:\n  {0}".format(ack))
-                    self._simple_frame_transmitter.write_frame(
-                        ack.serialize())
+            item = self._send_window.add_next(curtime=curtime, **frame_data)
 
-                    for frame in self._receive_window.receive_frame(p):
-                        self._received_data.put((frame.is_last, frame.data))
+            self._logger.debug("Sending:\n  {0}".format(str(item.frame)))
+            self._simple_frame_transmitter.write_frame(
+                item.frame.serialize())
 
-                elif p.type == FrameType.ack:
-                    # Received ACK.
+    def _handle_frame(self, frame):
+        """Handles received raw frame."""
+        try:
+            p = Frame.deserialize(frame)
+        except InvalidFrameException as ex:
+            self._logger.warning("Received invalid frame: {0}".format(
+                str(ex)))
+            return
+
+        self._logger.debug("Received:\n  {0}".format(p))
+
+        send_base = self._send_window.base
+        if p.type == FrameType.data:
+            # Received data.
+
+            in_order = (p.id == self._receive_window.base)
+            base = self._receive_window.base
+            missing_offsets = self._receive_window.add_frame(p)
+            if missing_offsets:
+                self._send_nak([(base + offset) % self._frame_id_period
+                    for offset in missing_offsets])
+            if not in_order and self._receive_window.get(p.id) is p:
+                # Frame may follow reassembled frames of its stream.
+                self._receive_stream(p.stream).pending[p.seq] = p
+                self._pending_streams.add(p.stream)
+            if not self._delivery_blocked:
+                self._deliver_frames()
+
+            # Schedule ACK (even if frame already received before). Out of
+            # order frame is acknowledged without delay, so that sender
+            # learns about gap as soon as possible.
+            if not in_order:
+                self._ack_deadline = 0
+            else:
+                self._not_acknowledged_count += 1
+                if self._not_acknowledged_count >= min(self._ack_frames,
+                        self._receive_window.maxlen):
+                    self._ack_deadline = 0
+                elif self._ack_deadline is None:
+                    self._ack_deadline = time.time() + self._ack_delay
+
+        elif p.type == FrameType.ack:
+            # Received ACK.
+
+            self._frames_acknowledged(self._send_window.ack_received(p.id))
+
+        elif p.type == FrameType.sack:
+            # Received cumulative ACK.
+
+            self._frames_acknowledged(self._send_window.sack_received(p.id,
+                [(p.id + offset) % self._frame_id_period
+                    for offset in Frame.sack_offsets(p.data)]))
+
+        elif p.type == FrameType.nak:
+            # Received negative ACK, retransmit missing frames now.
+
+            items = self._send_window.nak_received([p.id] +
+                [(p.id + offset) % self._frame_id_period
+                    for offset in Frame.sack_offsets(p.data)])
+            if items:
+                self._frames_timed_out()
+            curtime = time.time()
+            for item in items:
+                self._logger.info("Resending due to NAK:\n  {0}".format(
+                    str(item.frame)))
+                self._simple_frame_transmitter.write_frame(
+                    item.frame.serialize())
+                self._send_window.restart_timer(item, curtime)
+                self._retransmissions_count += 1
+                self._fast_retransmissions_count += 1
 
-                    self._send_window.ack_received(p.id)
+        else:
+            assert False
 
-                else:
-                    assert False
+        if self._send_window.base != send_base:
+            # New data is acknowledged.
+            self._rtt_estimator.reset_backoff()
+
+    def _send_nak(self, missing_ids):
+        """Sends NAK for frames with `missing_ids' (in increasing order)."""
+        first_id = missing_ids[0]
+        nak = Frame(type=FrameType.nak, id=first_id,
+            data=Frame.sack_bitmap([
+                (frame_id - first_id) % self._frame_id_period
+                    for frame_id in missing_ids[1:]]))
+        self._logger.debug("Sending negative acknowledge:\n  {0}".format(nak))
+        self._simple_frame_transmitter.write_frame(nak.serialize())
+
+    def _send_ack(self):
+        """Sends single ACK for all received frames."""
+        self._ack_deadline = None
+        self._not_acknowledged_count = 0
+
+        # While delivery is postponed frames are acknowledged only
+        # cumulatively, otherwise sender would advance its window beyond
+        # receive window.
+        selective_offsets = [] if self._delivery_blocked else \
+            self._receive_window.selective_offsets()
+        ack = Frame(type=FrameType.sack, id=self._receive_window.base,
+            data=Frame.sack_bitmap(selective_offsets))
+        self._logger.debug("Sending acknowledge:\n  {0}".format(ack))
+        self._simple_frame_transmitter.write_frame(ack.serialize())
 # --- cut here in report ---
 
-def experiment(window_size, max_frame_data, data_list, loss_prob=None):
+def experiment(window_size, max_frame_data, data_list, loss_prob=None,
+        seed=None, backend='memory', bandwidth=None, delay=0, loss_func=None,
+        framing='slip', **kwargs):
+    """Transmits `data_list' from one transmitter to another. If `loss_func'
+    is specified it is used instead of independent losses with probability
+    `loss_prob'. `framing' is name of frame.framing_modes mode. Rest keyword
+    arguments (e.g. `ack_delay') passed to FrameTransmitter's.
+    """
+
     from duplex_link import FullDuplexLink, LossFunc
 
-    if loss_prob is not None:
+    if loss_func is not None:
+        if seed is not None:
+            loss_func.seed(seed)
+    elif loss_prob is not None:
         loss_func = LossFunc(
-            loss_prob / 3.0, loss_prob / 3.0, loss_prob / 3.0)
-        a, b = FullDuplexLink(loss_func=loss_func)
-    else:
-        a, b = FullDuplexLink()
+            loss_prob / 3.0, loss_prob / 3.0, loss_prob / 3.0, seed=seed)
+    a, b = FullDuplexLink(loss_func=loss_func, backend=backend,
+        bandwidth=bandwidth, delay=delay)
 
-    at = SimpleFrameTransmitter(node=a)
-    bt = SimpleFrameTransmitter(node=b)
+    at = SimpleFrameTransmitter(node=a, framing=framing)
+    bt = SimpleFrameTransmitter(node=b, framing=framing)
 
     aft = FrameTransmitter(window_size=window_size,
         max_frame_data=max_frame_data, simple_frame_transmitter=at,
-        debug_src=1, debug_dest=2)
+        debug_src=1, debug_dest=2, **kwargs)
     bft = FrameTransmitter(window_size=window_size,
         max_frame_data=max_frame_data, simple_frame_transmitter=bt,
-        debug_src=2, debug_dest=1)
+        debug_src=2, debug_dest=1, **kwargs)
 
     receive_list = []
 
@@ -482,18 +1801,29 @@ def experiment(window_size, max_frame_data, data_list, loss_prob=None):
         receive_list.append(recv_data)
     end_time = time.time()
 
+    # Count delayed acknowledges too.
+    while aft.outstanding_frames_count > 0:
+        time.sleep(1e-3)
+
     aft.terminate()
     bft.terminate()
+    a.terminate()
+    b.terminate()
 
     return (end_time - start_time,
         at.write_frames_count + bt.write_frames_count)
 
 def average_experiment(window_size, max_frame_data, data_list, loss_prob=None,
-        tries=3):
+        tries=3, seed=None, **kwargs):
+    """Repeats experiment `tries' times. Rest keyword arguments passed to
+    `experiment()'.
+    """
+
     results = []
     for i in xrange(tries):
         results.append(experiment(
-            window_size, max_frame_data, data_list, loss_prob))
+            window_size, max_frame_data, data_list, loss_prob,
+            seed=seed + i if seed is not None else None, **kwargs))
 
     avg_time  = sum(zip(*results)[0]) / float(len(results))
     avg_count = sum(zip(*results)[1]) / float(len(results))
@@ -503,9 +1833,26 @@ def average_experiment(window_size, max_frame_data, data_list, loss_prob=None,
 def _test(level=None):
     # TODO: Use in separate file to test importing functionality.
 
+    import mmap
+    import multiprocessing
+    import tempfile
+
     from testing import unittest, do_tests
     
-    from duplex_link import FullDuplexLink, LossFunc
+    from duplex_link import FullDuplexLink, LossFunc, link_backends
+    from frame import SlipEncoder
+    from loss_models import GilbertElliottLossFunc
+
+    class ManualWorker(object):
+        # Transmitters are updated by test.
+        def add_frame_transmitter(self, frame_transmitter):
+            return self
+
+        def remove_frame_transmitter(self, frame_transmitter):
+            pass
+
+        def wakeup(self):
+            pass
 
     class Tests(object):
         class TestFrame(unittest.TestCase):
@@ -526,6 +1873,317 @@ def _test(level=None):
                 self.assertEqual(p.id, np.id)
                 self.assertEqual("", np.data)
 
+            def test_datagram_size(self):
+                data = memoryview("0123456789")[2:6]
+                p = Frame(type=FrameType.data, id=3, is_last=False,
+                    data=data, datagram_size=10)
+                s = p.serialize()
+                self.assertEqual(len(s), Frame.empty_frame_size +
+                    Frame.datagram_size_size + 4)
+                np = Frame.deserialize(s)
+                self.assertEqual(np.data, "2345")
+                self.assertEqual(np.datagram_size, 10)
+                self.assertFalse(np.is_last)
+
+                np = Frame.deserialize(Frame(type=FrameType.data, id=4,
+                    is_last=True, data=data).serialize())
+                self.assertEqual(np.datagram_size, None)
+                self.assertTrue(np.is_last)
+
+                with self.assertRaises(InvalidFrameException):
+                    Frame.deserialize(s[:-1] + chr(ord(s[-1]) ^ 1))
+
+            def test_stream(self):
+                p = Frame(type=FrameType.data, id=5, is_last=True,
+                    data="abc", stream=7, seq=300)
+                np = Frame.deserialize(p.serialize())
+                self.assertEqual(np.stream, 7)
+                self.assertEqual(np.seq, 300)
+                self.assertEqual(np.data, "abc")
+                self.assertEqual(Frame.deserialize(Frame(type=FrameType.ack,
+                    id=5).serialize()).stream, 0)
+
+            def test_sack(self):
+                offsets = [1, 3, 8, 9, 20]
+                bitmap = Frame.sack_bitmap(offsets)
+                self.assertEqual(len(bitmap), 3)
+                self.assertEqual(Frame.sack_offsets(bitmap), offsets)
+                self.assertEqual(Frame.sack_bitmap([]), "")
+
+                p = Frame(type=FrameType.sack, id=10, data=bitmap)
+                np = Frame.deserialize(p.serialize())
+                self.assertEqual(np.type, FrameType.sack)
+                self.assertEqual(np.id, 10)
+                self.assertEqual(Frame.sack_offsets(np.data), offsets)
+
+            def test_nak(self):
+                p = Frame(type=FrameType.nak, id=10,
+                    data=Frame.sack_bitmap([2, 3]))
+                np = Frame.deserialize(p.serialize())
+                self.assertEqual(np.type, FrameType.nak)
+                self.assertEqual(np.id, 10)
+                self.assertEqual(Frame.sack_offsets(np.data), [2, 3])
+
+        class TestWindows(unittest.TestCase):
+            logger = logging.getLogger("TestWindows")
+
+            def test_send_window(self):
+                # Small frame id period to test wrapping of ids.
+                w = FrameTransmitter._SendWindow(self.logger, 3, 5,
+                    RttEstimator(1.0, adaptive=False))
+                ids = []
+                for i in xrange(7):
+                    while not w.can_add_next():
+                        # Acknowledge out of order.
+                        w.ack_received(ids[-2])
+                        w.ack_received(ids[-3])
+                    ids.append(w.add_next(False, str(i), 0).id)
+                self.assertEqual(ids, [0, 1, 2, 3, 4, 0, 1])
+                self.assertEqual([item.id for item in w.items()], [4, 0, 1])
+                self.assertEqual(w.next_deadline(), 1.0)
+
+                # Frame 3 already acknowledged, frame 2 outside window.
+                w.ack_received(3)
+                w.ack_received(2)
+                self.assertEqual(len(w), 3)
+                w.ack_received(0)
+                self.assertEqual(len(w), 3)
+                w.ack_received(4)
+                self.assertEqual([item.id for item in w.items()], [1])
+
+            def test_timers(self):
+                w = FrameTransmitter._SendWindow(self.logger, 10, 100,
+                    RttEstimator(1.0, adaptive=False))
+                for i in xrange(5):
+                    w.add_next(False, str(i), i)
+                w.ack_received(1)
+                w.ack_received(2)
+                self.assertEqual(w.next_deadline(), 1.0)
+                self.assertEqual(w.timeout_items(1.0), [])
+
+                timeout_items = w.timeout_items(3.5)
+                self.assertEqual([item.id for item in timeout_items], [0])
+                self.assertEqual(w.timeout_items(3.5), [])
+                w.restart_timer(timeout_items[0], 3.5)
+                self.assertEqual(w.next_deadline(), 4.0)
+
+                w.ack_received(3)
+                self.assertEqual([item.id for item in w.timeout_items(10)],
+                    [0, 4])
+                self.assertEqual(w.next_deadline(), None)
+                w.ack_received(0)
+                w.ack_received(4)
+                self.assertEqual(len(w), 0)
+
+                # Cancelled timers don't accumulate.
+                for i in xrange(1000):
+                    w.ack_received(w.add_next(False, "", 10).id)
+                self.assertLessEqual(len(w._timers), 4 * w.maxlen)
+
+            def test_sack(self):
+                w = FrameTransmitter._SendWindow(self.logger, 10, 16,
+                    RttEstimator(1.0, adaptive=False))
+                for i in xrange(10):
+                    w.add_next(False, str(i), 0)
+                w.sack_received(3, [5, 7])
+                self.assertEqual([item.id for item in w.items()],
+                    [3, 4, 5, 6, 7, 8, 9])
+                self.assertEqual([item.id for item in w.timeout_items(2)],
+                    [3, 4, 6, 8, 9])
+                # Outdated cumulative ACK.
+                w.sack_received(2, [4])
+                self.assertEqual(len(w), 7)
+                w.sack_received(7, [])
+                self.assertEqual([item.id for item in w.items()], [8, 9])
+
+            def test_karn(self):
+                rtt = RttEstimator(1.0)
+                w = FrameTransmitter._SendWindow(self.logger, 10, 100, rtt)
+                items = [w.add_next(False, str(i), 0) for i in xrange(3)]
+                w.restart_timer(items[0], 1.0)
+                # Retransmitted frame doesn't give RTT sample.
+                w.ack_received(0, 1.5)
+                self.assertEqual(rtt.samples_count, 0)
+                # Single sample by the most recently sent frame.
+                w.sack_received(3, [], 0.2)
+                self.assertEqual(rtt.samples_count, 1)
+                self.assertAlmostEqual(rtt.srtt, 0.2)
+
+            def test_receive_window(self):
+                w = FrameTransmitter._ReceiveWindow(self.logger, 3, 5)
+                frame = lambda id_: Frame(type=FrameType.data, id=id_,
+                    is_last=False, data=str(id_))
+
+                self.assertEqual(list(w.receive_frame(frame(1))), [])
+                received = list(w.receive_frame(frame(0)))
+                self.assertEqual([f.id for f in received], [0, 1])
+                # Duplicate and outside window frames are ignored.
+                self.assertEqual(list(w.receive_frame(frame(1))), [])
+                self.assertEqual(list(w.receive_frame(frame(0))), [])
+                received = list(w.receive_frame(frame(3)))
+                received += list(w.receive_frame(frame(4)))
+                received += list(w.receive_frame(frame(2)))
+                self.assertEqual([f.id for f in received], [2, 3, 4])
+                received = list(w.receive_frame(frame(0)))
+                self.assertEqual([f.id for f in received], [0])
+
+                self.assertEqual(list(w.receive_frame(frame(3))), [])
+                self.assertEqual(w.base, 1)
+                self.assertEqual(w.selective_offsets(), [2])
+
+            def test_missing_frames(self):
+                w = FrameTransmitter._ReceiveWindow(self.logger, 5, 8)
+                frame = lambda id_: Frame(type=FrameType.data, id=id_,
+                    is_last=False, data=str(id_))
+
+                self.assertEqual(w.add_frame(frame(2)), [0, 1])
+                # Missing frames are reported once.
+                self.assertEqual(w.add_frame(frame(4)), [3])
+                self.assertEqual(w.add_frame(frame(1)), [])
+                self.assertEqual(w.add_frame(frame(0)), [])
+                self.assertEqual([f.id for f in w.in_order_frames()],
+                    [0, 1, 2])
+                # Offsets of frames 5 and 6 from new base.
+                self.assertEqual(w.add_frame(frame(7)), [2, 3])
+                self.assertEqual(w.add_frame(frame(3)), [])
+                self.assertEqual(w.add_frame(frame(5)), [])
+
+            def test_nak_threshold(self):
+                w = FrameTransmitter._ReceiveWindow(self.logger, 8, 16, 3)
+                frame = lambda id_: Frame(type=FrameType.data, id=id_,
+                    is_last=False, data=str(id_))
+
+                self.assertEqual(w.add_frame(frame(1)), [])
+                self.assertEqual(w.add_frame(frame(3)), [])
+                # Frame 0 is followed by three frames.
+                self.assertEqual(w.add_frame(frame(4)), [0])
+                self.assertEqual(w.add_frame(frame(4)), [])
+                self.assertEqual(w.add_frame(frame(6)), [2])
+                # Reordered frame arrived before threshold.
+                self.assertEqual(w.add_frame(frame(5)), [])
+                self.assertEqual(w.add_frame(frame(7)), [])
+
+                # Missing frames aren't tracked without threshold.
+                w = FrameTransmitter._ReceiveWindow(self.logger, 8, 16, None)
+                for i in xrange(1, 8):
+                    self.assertEqual(w.add_frame(frame(i)), [])
+                self.assertEqual(len(w._gaps), 0)
+
+            def test_nak(self):
+                w = FrameTransmitter._SendWindow(self.logger, 5, 8,
+                    RttEstimator(1.0, adaptive=False))
+                for i in xrange(5):
+                    w.add_next(False, str(i), 0)
+                w.sack_received(1, [2])
+                self.assertEqual([item.id for item in
+                    w.nak_received([0, 1, 2, 3, 6])], [1, 3])
+
+        class TestRttEstimator(unittest.TestCase):
+            def test_estimation(self):
+                rtt = RttEstimator(1.0, min_rto=0.01, max_rto=5.0)
+                self.assertEqual(rtt.srtt, None)
+                self.assertEqual(rtt.rto, 1.0)
+
+                rtt.add_sample(0.1)
+                self.assertAlmostEqual(rtt.srtt, 0.1)
+                self.assertAlmostEqual(rtt.rttvar, 0.05)
+                self.assertAlmostEqual(rtt.rto, 0.3)
+                for i in xrange(100):
+                    rtt.add_sample(0.1)
+                self.assertAlmostEqual(rtt.srtt, 0.1)
+                self.assertLess(rtt.rto, 0.11)
+
+                rtt.backoff()
+                rtt.backoff()
+                self.assertLess(rtt.rto, 0.44)
+                self.assertGreater(rtt.rto, 0.4)
+                for i in xrange(10):
+                    rtt.backoff()
+                self.assertEqual(rtt.rto, 5.0)
+                self.assertEqual(rtt.backoffs_count, 12)
+                rtt.add_sample(0.1)
+                self.assertLess(rtt.rto, 0.11)
+
+            def test_reset_backoff(self):
+                rtt = RttEstimator(1.0, min_rto=0.01, max_rto=5.0)
+                rtt.backoff()
+                rtt.reset_backoff()
+                self.assertEqual(rtt.rto, 1.0)
+
+                rtt.add_sample(0.1)
+                for i in xrange(5):
+                    rtt.backoff()
+                rtt.reset_backoff()
+                self.assertAlmostEqual(rtt.rto, 0.3)
+
+            def test_not_adaptive(self):
+                rtt = RttEstimator(1.0, adaptive=False)
+                rtt.add_sample(0.1)
+                rtt.backoff()
+                self.assertAlmostEqual(rtt.srtt, 0.1)
+                self.assertEqual(rtt.rto, 1.0)
+
+            def test_transmitter(self):
+                a, b = FullDuplexLink()
+                aft = FrameTransmitter(ack_timeout=1.0,
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=a))
+                bft = FrameTransmitter(
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=b))
+                for i in xrange(5):
+                    aft.send("test")
+                    self.assertEqual(bft.receive(), "test")
+                while aft.outstanding_frames_count > 0:
+                    time.sleep(1e-3)
+
+                self.assertGreater(aft.rtt_estimator.samples_count, 0)
+                self.assertLess(aft.rtt_estimator.rto, 1.0)
+                self.assertEqual(aft.retransmissions_count, 0)
+
+                aft.terminate()
+                bft.terminate()
+
+            def test_backoff_once_per_timeout(self):
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a)
+                bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                aft = FrameTransmitter(simple_frame_transmitter=at,
+                    worker=w, max_frame_data=1, ack_timeout=0.2)
+                bft = FrameTransmitter(simple_frame_transmitter=bt,
+                    worker=w, max_frame_data=1, ack_delay=0)
+
+                start = time.time()
+                def sleep_until(offset):
+                    time.sleep(max(0, start + offset - time.time()))
+
+                aft.send("ab")
+                aft.update()
+                sleep_until(0.1)
+                aft.send("cd")
+                aft.update()
+                # All frames are lost.
+                bt.read_frames()
+
+                # Timers of all frames expire in the same timeout event, so
+                # timeout is doubled once.
+                sleep_until(0.25)
+                aft.update()
+                sleep_until(0.35)
+                aft.update()
+                self.assertEqual(aft.retransmissions_count, 4)
+                self.assertEqual(aft.rtt_estimator.backoffs_count, 1)
+                self.assertAlmostEqual(aft.rtt_estimator.rto, 0.4)
+
+                # Acknowledge of retransmitted frames can't be sampled, but
+                # it drops backoff.
+                bft.update()
+                aft.update()
+                self.assertEqual(bft.receive(False), "ab")
+                self.assertEqual(bft.receive(False), "cd")
+                self.assertEqual(aft.outstanding_frames_count, 0)
+                self.assertEqual(aft.rtt_estimator.samples_count, 0)
+                self.assertAlmostEqual(aft.rtt_estimator.rto, 0.2)
+
         class TestFrameTransmitterConstructor(unittest.TestCase):
             def setUp(self):
                 self.a, self.b = FullDuplexLink()
@@ -548,6 +2206,545 @@ def _test(level=None):
                 aft.terminate()
                 aft.terminate()
 
+        class TestFrameTransmitterWorker(unittest.TestCase):
+            def test_wakeup(self):
+                a, b = FullDuplexLink()
+                w = FrameTransmitterWorker()
+                aft = FrameTransmitter(worker=w,
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=a))
+                bft = FrameTransmitter(worker=w,
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=b))
+
+                saved_sleep_time = config.frame_transmitter_thread_sleep_time
+                config.frame_transmitter_thread_sleep_time = 10
+                try:
+                    # Latency doesn't depend on polling interval.
+                    start = time.time()
+                    for i in xrange(10):
+                        aft.send("ping")
+                        self.assertEqual(bft.receive(), "ping")
+                        bft.send("pong")
+                        self.assertEqual(aft.receive(), "pong")
+                    self.assertLess(time.time() - start, 1.0)
+                finally:
+                    config.frame_transmitter_thread_sleep_time = \
+                        saved_sleep_time
+
+                aft.terminate()
+                bft.terminate()
+
+            def test_restart(self):
+                w = FrameTransmitterWorker()
+                for i in xrange(3):
+                    a, b = FullDuplexLink()
+                    aft = FrameTransmitter(worker=w,
+                        simple_frame_transmitter=SimpleFrameTransmitter(
+                            node=a))
+                    bft = FrameTransmitter(worker=w,
+                        simple_frame_transmitter=SimpleFrameTransmitter(
+                            node=b))
+                    aft.send("test")
+                    self.assertEqual(bft.receive(), "test")
+                    aft.terminate()
+                    bft.terminate()
+
+        class TestFrameTransmitterWorkerPool(unittest.TestCase):
+            def test_pool(self):
+                pool = FrameTransmitterWorkerPool(3)
+                transmitters = []
+                for i in xrange(6):
+                    a, b = FullDuplexLink()
+                    transmitters.append((
+                        FrameTransmitter(worker=pool,
+                            simple_frame_transmitter=
+                                SimpleFrameTransmitter(node=a)),
+                        FrameTransmitter(worker=pool,
+                            simple_frame_transmitter=
+                                SimpleFrameTransmitter(node=b))))
+                self.assertEqual(
+                    [w.frame_transmitters_count for w in pool.workers],
+                    [4, 4, 4])
+
+                for aft, bft in transmitters:
+                    aft.send("test")
+                for aft, bft in transmitters:
+                    self.assertEqual(bft.receive(), "test")
+
+                for aft, bft in transmitters:
+                    aft.terminate()
+                    bft.terminate()
+                self.assertEqual(
+                    [w.frame_transmitters_count for w in pool.workers],
+                    [0, 0, 0])
+
+            def test_concurrent_registration(self):
+                pool = FrameTransmitterWorkerPool(2)
+                errors = []
+
+                def run():
+                    try:
+                        for i in xrange(10):
+                            a, b = FullDuplexLink()
+                            aft = FrameTransmitter(worker=pool,
+                                simple_frame_transmitter=
+                                    SimpleFrameTransmitter(node=a))
+                            bft = FrameTransmitter(worker=pool,
+                                simple_frame_transmitter=
+                                    SimpleFrameTransmitter(node=b))
+                            aft.send(str(i))
+                            if bft.receive() != str(i):
+                                errors.append(i)
+                            aft.terminate()
+                            bft.terminate()
+                    except Exception as ex:
+                        errors.append(ex)
+
+                threads = [threading.Thread(target=run) for i in xrange(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(errors, [])
+
+        class TestUpdateBudget(unittest.TestCase):
+            def test_budget(self):
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a)
+                bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                aft = FrameTransmitter(simple_frame_transmitter=at,
+                    worker=w, max_frame_data=1, window_size=30,
+                    update_budget=10)
+                bft = FrameTransmitter(simple_frame_transmitter=bt,
+                    worker=w, max_frame_data=1, window_size=30,
+                    update_budget=10, ack_delay=0)
+
+                aft.send("x" * 50)
+                aft.update()
+                self.assertEqual(at.write_frames_count, 10)
+                aft.update(budget=100)
+                # Window is full.
+                self.assertEqual(at.write_frames_count, 30)
+                self.assertNotEqual(aft.next_update_time(), 0)
+
+                # Receiver handles 10 frames per update and acknowledges
+                # them with single frame.
+                bft.update()
+                self.assertEqual(bft.next_update_time(), 0)
+                bft.update()
+                bft.update()
+                self.assertEqual(bt.write_frames_count, 3)
+                aft.update()
+                self.assertEqual(at.write_frames_count, 40)
+                # Not sent frames are left for next update.
+                self.assertEqual(aft.next_update_time(), 0)
+                aft.update()
+                self.assertEqual(at.write_frames_count, 50)
+                bft.update()
+                bft.update()
+                self.assertEqual(bft.receive(), "x" * 50)
+
+        class TestSegmentation(unittest.TestCase):
+            def setUp(self):
+                a, b = FullDuplexLink()
+                self.at = SimpleFrameTransmitter(node=a)
+                self.bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                self.aft = FrameTransmitter(simple_frame_transmitter=self.at,
+                    worker=w, max_frame_data=4, window_size=20)
+                self.bft = FrameTransmitter(simple_frame_transmitter=self.bt,
+                    worker=w, max_frame_data=4, window_size=20)
+
+            def test_lazy_segmentation(self):
+                data = "0123456789"
+                self.aft.send(data)
+                self.aft.send("")
+                self.assertEqual(self.at.write_frames_count, 0)
+                self.assertEqual(self.aft.outstanding_frames_count, 4)
+
+                self.aft.update(budget=2)
+                self.assertEqual(self.aft.outstanding_frames_count, 4)
+                frames = [item.frame for item in self.aft._send_window.items()]
+                # Frames refer to sent data.
+                self.assertTrue(all(isinstance(f.data, memoryview)
+                    for f in frames))
+                self.assertEqual([f.datagram_size for f in frames],
+                    [10, None])
+
+                self.aft.update()
+                self.assertEqual(self.at.write_frames_count, 4)
+                self.bft.update()
+                self.assertEqual(self.bft.receive(False), data)
+                self.assertEqual(self.bft.receive(False), "")
+                self.assertEqual(self.bft.receive(False), None)
+
+            def test_reassembly(self):
+                frame = lambda id_, data, **kwargs: Frame(
+                    type=FrameType.data, id=id_, seq=id_, data=data,
+                    **kwargs).serialize()
+
+                # Out of order frames, then frames of incomplete datagram
+                # and frame of unknown datagram.
+                for f in [frame(1, "4567", is_last=False),
+                        frame(0, "0123", is_last=False, datagram_size=9),
+                        frame(2, "8", is_last=True),
+                        frame(3, "ab", is_last=False, datagram_size=6),
+                        frame(4, "cd", is_last=True, datagram_size=2),
+                        frame(5, "ef", is_last=True)]:
+                    self.at.write_frame(f)
+                self.bft.update()
+                self.assertEqual(self.bft.receive(False), "012345678")
+                self.assertEqual(self.bft.receive(False), "cd")
+                self.assertEqual(self.bft.receive(False), None)
+
+            def test_max_datagram_size(self):
+                bft = FrameTransmitter(simple_frame_transmitter=self.bt,
+                    worker=ManualWorker(), max_frame_data=4,
+                    max_datagram_size=8)
+                frame = lambda id_, data, **kwargs: Frame(
+                    type=FrameType.data, id=id_, data=data,
+                    **kwargs).serialize()
+
+                # Buffer for too large datagram is not allocated.
+                for f in [frame(0, "0123", is_last=False,
+                            datagram_size=2**32 - 1),
+                        frame(1, "4567", is_last=True),
+                        frame(2, "ab", is_last=True, datagram_size=2)]:
+                    self.at.write_frame(f)
+                bft.update()
+                self.assertEqual(bft.receive(False), "ab")
+                self.assertEqual(bft.receive(False), None)
+
+        class TestChunks(unittest.TestCase):
+            def setUp(self):
+                a, b = FullDuplexLink()
+                self.at = SimpleFrameTransmitter(node=a)
+                self.bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                self.aft = FrameTransmitter(simple_frame_transmitter=self.at,
+                    worker=w, max_frame_data=4, window_size=3, ack_delay=0)
+                self.bft = FrameTransmitter(simple_frame_transmitter=self.bt,
+                    worker=w, max_frame_data=4, window_size=3, ack_delay=0)
+
+            def exchange(self, count=10):
+                for i in xrange(count):
+                    self.aft.update()
+                    self.bft.update()
+
+            def test_iterable(self):
+                pieces = iter(["abc", "", "defghij"])
+                self.aft.send_chunks(pieces)
+                self.aft.send("datagram")
+                self.exchange()
+                reader = self.bft.receive_chunks(False)
+                self.assertEqual(list(reader), ["abc", "defg", "hij"])
+                self.assertTrue(reader.complete)
+                self.assertEqual(self.bft.receive(False), "datagram")
+                self.assertEqual(self.bft.receive_chunks(False), None)
+
+                self.aft.send_chunks([])
+                self.exchange()
+                self.assertEqual(list(self.bft.receive_chunks(False)), [])
+
+            def test_mmap(self):
+                data = "".join(map(chr, xrange(256))) * 4
+                with tempfile.TemporaryFile() as f:
+                    f.write(data)
+                    f.flush()
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.aft.send_chunks(m)
+
+                    reader = None
+                    chunks = []
+                    for i in xrange(1000):
+                        self.exchange(1)
+                        if reader is None:
+                            reader = self.bft.receive_chunks(False)
+                        if reader is not None:
+                            # Reader is slower than transmitter.
+                            chunks.append(reader.next())
+                            # Source is read only when frames are sent.
+                            self.assertLessEqual(m.tell(),
+                                (len(chunks) + 3 * 3) * 4)
+                            if len(chunks) == len(data) // 4:
+                                break
+                    m.close()
+                self.assertEqual("".join(chunks), data)
+                self.assertRaises(StopIteration, reader.next)
+
+            def test_bounded_receive(self):
+                self.aft.send_chunks("x" * 4 for i in xrange(20))
+                self.exchange()
+                reader = self.bft.receive_chunks(False)
+                # Not read chunks are not acknowledged.
+                self.assertEqual(reader._chunks.qsize(), 3)
+                self.assertEqual(self.bft._receive_window.base, 3)
+                self.assertGreater(self.aft.outstanding_frames_count, 0)
+
+                received = []
+                while len(received) < 20:
+                    received.append(reader.next())
+                    self.exchange(2)
+                self.assertRaises(StopIteration, reader.next)
+                self.assertEqual(self.aft.outstanding_frames_count, 0)
+
+        class TestBackpressure(unittest.TestCase):
+            def setUp(self):
+                a, b = FullDuplexLink()
+                self.at = SimpleFrameTransmitter(node=a)
+                self.bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                self.aft = FrameTransmitter(simple_frame_transmitter=self.at,
+                    worker=w, max_frame_data=1, window_size=2,
+                    send_high_water=4, ack_delay=0)
+                self.bft = FrameTransmitter(simple_frame_transmitter=self.bt,
+                    worker=w, max_frame_data=1, window_size=2,
+                    receive_high_water=2, receive_low_water=1, ack_delay=0)
+
+            def exchange(self, count=10):
+                for i in xrange(count):
+                    self.aft.update()
+                    self.bft.update()
+
+            def test_send(self):
+                self.assertTrue(self.aft.send("ab"))
+                self.assertTrue(self.aft.send("cd"))
+                # High water mark is reached.
+                self.assertFalse(self.aft.send("e", block=False))
+                self.assertFalse(self.aft.send("e", timeout=0.05))
+                self.assertEqual(self.aft.send_rejected_count, 2)
+                self.assertGreaterEqual(self.aft.send_blocked_time, 0.05)
+
+                # Send window takes frames until low water mark.
+                self.aft.update()
+                self.assertTrue(self.aft.send("e", block=False))
+
+                def update():
+                    time.sleep(0.05)
+                    self.exchange()
+                thread = threading.Thread(target=update)
+                thread.start()
+                self.assertTrue(self.aft.send("fgh"))
+                self.assertFalse(self.aft.send("i", block=False))
+                thread.join()
+
+            def test_receive(self):
+                for data in ["a", "b", "c", "d"]:
+                    self.aft.send(data)
+                self.exchange()
+                # Queue of received datagrams is full, so sender can't send
+                # more than window.
+                self.assertEqual(self.bft._received_data.qsize(), 2)
+                self.assertEqual(self.aft.outstanding_frames_count, 2)
+                self.assertGreater(self.bft.delivery_blocked_time, 0)
+
+                self.assertEqual(self.bft.receive(False), "a")
+                self.exchange()
+                self.assertEqual(self.bft.receive(False), "b")
+                self.exchange()
+                self.assertEqual([self.bft.receive(False) for i in xrange(3)],
+                    ["c", "d", None])
+                self.exchange()
+                self.assertEqual(self.aft.outstanding_frames_count, 0)
+
+        class TestStreams(unittest.TestCase):
+            def setUp(self):
+                a, b = FullDuplexLink()
+                self.at = SimpleFrameTransmitter(node=a)
+                self.bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                self.aft = FrameTransmitter(simple_frame_transmitter=self.at,
+                    worker=w, max_frame_data=2, window_size=4, ack_delay=0)
+                self.bft = FrameTransmitter(simple_frame_transmitter=self.bt,
+                    worker=w, max_frame_data=2, window_size=4, ack_delay=0)
+
+            def exchange(self, count=10):
+                for i in xrange(count):
+                    self.aft.update()
+                    self.bft.update()
+
+            def test_interleaving(self):
+                bulk = "0123456789" * 4
+                self.aft.send(bulk)
+                self.aft.update()
+                self.aft.send("ctl", stream=1)
+                self.aft.send("ctl2", stream=1)
+
+                # Frames are numbered in each stream.
+                self.assertEqual([(item.frame.stream, item.frame.seq)
+                    for item in self.aft._send_window.items()],
+                    [(0, 0), (0, 1), (0, 2), (0, 3)])
+
+                # Control datagrams are sent before the rest of bulk data.
+                self.exchange(3)
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (1, "ctl"))
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (1, "ctl2"))
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (None, None))
+                self.exchange()
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (0, bulk))
+                self.assertEqual(self.bft.receive(False), None)
+
+            def test_reassembly(self):
+                frame = lambda id_, data, stream, **kwargs: Frame(
+                    type=FrameType.data, id=id_, data=data, stream=stream,
+                    **kwargs).serialize()
+
+                for f in [frame(0, "ab", 2, is_last=False, datagram_size=4),
+                        frame(1, "01", 3, is_last=False, datagram_size=3),
+                        frame(2, "cd", 2, seq=1, is_last=True),
+                        frame(3, "2", 3, seq=1, is_last=True)]:
+                    self.at.write_frame(f)
+                self.bft.update()
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (2, "abcd"))
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (3, "012"))
+
+            def test_lost_frame(self):
+                frame = lambda id_, data, stream, seq, **kwargs: Frame(
+                    type=FrameType.data, id=id_, data=data, stream=stream,
+                    seq=seq, **kwargs).serialize()
+
+                # Frame 0 of bulk stream is lost, frames of control stream
+                # after it are delivered in order of stream.
+                for f in [frame(1, "ab", 1, 0, is_last=True, datagram_size=2),
+                        frame(3, "d", 1, 2, is_last=True, datagram_size=1),
+                        frame(2, "c", 1, 1, is_last=True, datagram_size=1)]:
+                    self.at.write_frame(f)
+                self.bft.update()
+                for data in ["ab", "c", "d"]:
+                    self.assertEqual(self.bft.receive_with_stream(False),
+                        (1, data))
+                self.assertEqual(self.bft.receive(False), None)
+
+                for f in [frame(0, "01", 0, 0, is_last=False, datagram_size=4),
+                        frame(4, "23", 0, 1, is_last=True),
+                        frame(5, "e", 1, 3, is_last=True, datagram_size=1)]:
+                    self.at.write_frame(f)
+                self.bft.update()
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (0, "0123"))
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (1, "e"))
+                self.assertEqual(self.bft.receive(False), None)
+
+            def test_chunks(self):
+                self.aft.send_chunks(["abcdef"], stream=4)
+                self.aft.send("x", stream=5)
+                self.exchange()
+                reader = self.bft.receive_chunks(False)
+                self.assertEqual(reader.stream, 4)
+                self.assertEqual("".join(reader), "abcdef")
+                self.assertEqual(self.bft.receive_with_stream(False),
+                    (5, "x"))
+
+        class TestFastRetransmit(unittest.TestCase):
+            def make_transmitters(self, fast_retransmit):
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a)
+                bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                aft = FrameTransmitter(simple_frame_transmitter=at,
+                    worker=w, max_frame_data=1, window_size=5,
+                    ack_timeout=10, adaptive_ack_timeout=False,
+                    fast_retransmit=fast_retransmit)
+                bft = FrameTransmitter(simple_frame_transmitter=bt,
+                    worker=w, max_frame_data=1, window_size=5, ack_delay=0,
+                    fast_retransmit=fast_retransmit)
+                return at, bt, aft, bft
+
+            def transmit(self, fast_retransmit, order):
+                """Sends 5 frames and passes them to receiver in `order'
+                (missing frames are lost). Returns transmitters.
+                """
+                at, bt, aft, bft = self.make_transmitters(fast_retransmit)
+                encoder = SlipEncoder()
+
+                aft.send("abcde")
+                aft.update()
+                frames = bt.read_frames()
+                for i in order:
+                    at.node.write(encoder.encode(frames[i]))
+                for i in xrange(3):
+                    bft.update()
+                    aft.update()
+                return aft, bft
+
+            def transmit_with_lost_frame(self, fast_retransmit):
+                """Sends 5 frames and loses the second one."""
+                return self.transmit(fast_retransmit, [0, 2, 3, 4])
+
+            def test_nak(self):
+                aft, bft = self.transmit_with_lost_frame(True)
+                # Lost frame is retransmitted without waiting for timeout.
+                self.assertEqual(bft.receive(False), "abcde")
+                self.assertEqual(aft.retransmissions_count, 1)
+                self.assertEqual(aft.fast_retransmissions_count, 1)
+                self.assertEqual(aft.outstanding_frames_count, 0)
+
+            def test_disabled(self):
+                aft, bft = self.transmit_with_lost_frame(False)
+                # Lost frame waits for timeout.
+                self.assertEqual(bft.receive(False), None)
+                self.assertEqual(aft.retransmissions_count, 0)
+                self.assertEqual(bft._receive_window.base, 1)
+
+            def test_reordering(self):
+                # Frames reordered by less than threshold aren't reported
+                # missing.
+                aft, bft = self.transmit(True, [1, 2, 0, 4, 3])
+                self.assertEqual(bft.receive(False), "abcde")
+                self.assertEqual(aft.retransmissions_count, 0)
+                self.assertEqual(aft.outstanding_frames_count, 0)
+
+        class TestAdaptiveWindow(unittest.TestCase):
+            def test_aimd(self):
+                a, b = FullDuplexLink()
+                at = SimpleFrameTransmitter(node=a)
+                bt = SimpleFrameTransmitter(node=b)
+                w = ManualWorker()
+                aft = FrameTransmitter(simple_frame_transmitter=at,
+                    worker=w, max_frame_data=1, window_size=20,
+                    adaptive_window=True, ack_timeout=0.2,
+                    min_ack_timeout=0.2)
+                bft = FrameTransmitter(simple_frame_transmitter=bt,
+                    worker=w, max_frame_data=1, window_size=20, ack_delay=0)
+                self.assertEqual(aft.effective_window_size, 1)
+
+                aft.send("x" * 1000)
+                sizes = []
+                for i in xrange(10):
+                    aft.update()
+                    bft.update()
+                    sizes.append(aft.effective_window_size)
+                # Slow start and then limited by configured maximum.
+                self.assertEqual(sizes[:4], [1, 2, 4, 8])
+                self.assertEqual(sizes[-1], 20)
+
+                # Lost frames.
+                aft.update()
+                bft.receive(False)
+                bt.read_frames()
+                time.sleep(0.25)
+                aft.update()
+                self.assertEqual(aft.effective_window_size, 10)
+
+                # Additive increase.
+                for i in xrange(3):
+                    bft.update()
+                    aft.update()
+                self.assertGreater(aft.effective_window_size, 10)
+                self.assertLess(aft.effective_window_size, 20)
+
+            def test_experiment(self):
+                time_, sent = experiment(100, 100, ["x" * 1000],
+                    loss_prob=0.003, seed=1, adaptive_window=True)
+                self.assertGreaterEqual(sent, 11)
+
         class TestFrameTransmitter(unittest.TestCase):
             def setUp(self):
                 self.a, self.b = FullDuplexLink()
@@ -596,29 +2793,49 @@ def _test(level=None):
                 self.assertEqual(self.bft.receive(block=False), None)
 
             def test_enabled(self):
-                self.assertTrue(self.aft.enabled)
+                # Transmitters are updated by test, so that sent data is not
+                # delivered until `exchange()'.
+                a, b = FullDuplexLink()
+                w = ManualWorker()
+                aft = FrameTransmitter(
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=a),
+                    worker=w)
+                bft = FrameTransmitter(
+                    simple_frame_transmitter=SimpleFrameTransmitter(node=b),
+                    worker=w)
+
+                def exchange():
+                    for i in xrange(10):
+                        aft.update()
+                        bft.update()
+
+                self.assertTrue(aft.enabled)
 
                 text = "Test!"
-                self.aft.send(text)
-                self.assertEqual(self.bft.receive(), text)
+                aft.send(text)
+                exchange()
+                self.assertEqual(bft.receive(block=False), text)
 
-                self.aft.enabled = False
-                self.assertFalse(self.aft.enabled)
+                aft.enabled = False
+                self.assertFalse(aft.enabled)
 
-                self.aft.send(text)
-                self.assertEqual(self.bft.receive(block=False), None)
+                aft.send(text)
+                exchange()
+                self.assertEqual(bft.receive(block=False), None)
 
-                self.aft.enabled = True
+                aft.enabled = True
 
-                self.aft.send(text)
-                self.assertEqual(self.bft.receive(block=False), None)
+                aft.send(text)
+                self.assertEqual(bft.receive(block=False), None)
 
-                self.aft.send(text)
-                self.aft.enabled = False
-                self.assertFalse(self.aft.enabled)
+                aft.send(text)
+                aft.enabled = False
+                self.assertFalse(aft.enabled)
 
-                self.aft.enabled = True
-                self.assertEqual(self.bft.receive(block=False), None)
+                # Not sent data is dropped when link goes down.
+                aft.enabled = True
+                exchange()
+                self.assertEqual(bft.receive(block=False), None)
                 
         class TestFrameTransmitterWithLosses(unittest.TestCase):
             def setUp(self):
@@ -668,6 +2885,53 @@ def _test(level=None):
                 self.assertEqual(self.aft.receive(block=False), None)
                 self.assertEqual(self.bft.receive(block=False), None)
 
+        class TestFrameTransmitterBackends(unittest.TestCase):
+            def test_transmit(self):
+                text = "".join(map(chr, xrange(256))) * 10
+
+                for backend in sorted(link_backends.iterkeys()):
+                    a, b = FullDuplexLink(backend=backend)
+                    aft = FrameTransmitter(
+                        simple_frame_transmitter=SimpleFrameTransmitter(node=a))
+                    bft = FrameTransmitter(
+                        simple_frame_transmitter=SimpleFrameTransmitter(node=b))
+
+                    aft.send(text)
+                    self.assertEqual(bft.receive(), text)
+                    bft.send(text)
+                    self.assertEqual(aft.receive(), text)
+
+                    aft.terminate()
+                    bft.terminate()
+
+            def test_processes(self):
+                text = "".join(map(chr, xrange(256))) * 2
+
+                for backend in ['socket', 'shared_memory']:
+                    a, b = FullDuplexLink(backend=backend)
+
+                    def echo():
+                        # Worker thread of parent process is not running in
+                        # child process.
+                        bft = FrameTransmitter(
+                            simple_frame_transmitter=
+                                SimpleFrameTransmitter(node=b),
+                            worker=FrameTransmitterWorker())
+                        bft.send(bft.receive())
+                        # Wait until echoed data will be received.
+                        bft.receive()
+                        bft.terminate()
+                    p = multiprocessing.Process(target=echo)
+                    p.start()
+
+                    aft = FrameTransmitter(
+                        simple_frame_transmitter=SimpleFrameTransmitter(node=a))
+                    aft.send(text)
+                    self.assertEqual(aft.receive(), text)
+                    aft.send("done")
+                    p.join()
+                    aft.terminate()
+
         class TestExperiment(unittest.TestCase):
             def test_main(self):
                 time_, sent = experiment(100, 100, ["data"], loss_prob=None)
@@ -680,73 +2944,94 @@ def _test(level=None):
 
                 # TODO: Assume that computer is not very slow.
                 self.assertLess(time_, 5.0)
-                self.assertEqual(sent, 4)
+                # Acknowledges may be coalesced.
+                self.assertIn(sent, (3, 4))
+
+            def test_ack_coalescing(self):
+                # 10 data frames.
+                time_, sent = experiment(100, 100, ["x" * 1000])
+                self.assertLess(sent, 20)
+
+                time_, sent = experiment(100, 100, ["x" * 1000],
+                    ack_delay=0.1, ack_frames=100)
+                self.assertEqual(sent, 11)
+
+                # Acknowledge isn't delayed when two frames are received.
+                time_, sent = experiment(100, 100, ["x" * 1000],
+                    ack_delay=10)
+                self.assertLess(time_, 1)
+                self.assertLess(sent, 20)
+
+            def test_small_window_ack(self):
+                # Frame filling receive window is acknowledged without
+                # delay.
+                time_, sent = experiment(1, 100, ["x" * 1000],
+                    ack_delay=10)
+                self.assertLess(time_, 1)
+                self.assertEqual(sent, 20)
+
+            def test_loss_func(self):
+                time_, sent = experiment(100, 100, ["x" * 1000],
+                    loss_func=GilbertElliottLossFunc.from_mean(0.001, 10),
+                    seed=1)
+                # Data frames and at least one acknowledge.
+                self.assertGreaterEqual(sent, 11)
+
+            def test_framing(self):
+                for framing in ('length', 'cobs'):
+                    time_, sent = experiment(100, 100, ["x" * 1000],
+                        loss_prob=0.001, seed=1, framing=framing)
+                    self.assertGreaterEqual(sent, 11)
+
+            def test_shaping(self):
+                time_, sent = experiment(100, 100, ["data"], delay=0.1)
+                self.assertGreaterEqual(time_, 0.1)
+                self.assertEqual(sent, 2)
+
+                # 10 frames of 100 bytes of data.
+                time_, sent = experiment(100, 100, ["x" * 1000],
+                    bandwidth=5000)
+                self.assertGreaterEqual(time_, 0.2)
+                self.assertEqual(sent, 20)
 
     do_tests(Tests, level=level)
 
-def _statistics():
-    import time
-    import csv
+def _statistics(processes=None, seed=0, **kwargs):
+    """Runs experiments sweeps in pool of `processes' processes. Points
+    already stored in result files are skipped. Keyword arguments (e.g. link
+    `bandwidth' and `delay') passed to each experiment.
+    """
 
     import config
+    from sweep import run_sweep
 
     config.thread_sleep_time = 1e-3
     config.frame_transmitter_thread_sleep_time = 1e-3
 
-    data = "".join(map(chr, xrange(256))) * 8
-    base_wsize = 100
-    base_max_frame = 100
+    base = dict(kwargs, window_size=100, max_frame_data=100, loss_prob=None,
+        data_size=256 * 8, tries=3)
     base_loss_prob = 0.003
 
-    with open("data_wsize.csv", "w") as f:
-        csv_writer = csv.writer(f, lineterminator='\n')
-        for wsize in range(1, 102, 3):
-            time_, frames_count = \
-                average_experiment(wsize, base_max_frame, [data],
-                    loss_prob=None)
-            print "{0} - time={1}, frames count={2}".format(
-                wsize, time_, frames_count)
-            csv_writer.writerow((wsize, time_, frames_count))
-
-    with open("data_wsize_loss.csv", "w") as f:
-        csv_writer = csv.writer(f, lineterminator='\n')
-        for wsize in range(1, 102, 3):
-            time_, frames_count = \
-                average_experiment(wsize, base_max_frame, [data],
-                    loss_prob=base_loss_prob)
-            print "{0} - time={1}, frames count={2}".format(
-                wsize, time_, frames_count)
-            csv_writer.writerow((wsize, time_, frames_count))
-
-    with open("data_maxframe.csv", "w") as f:
-        csv_writer = csv.writer(f, lineterminator='\n')
-        for maxframe in range(10, 402, 10):
-            time_, frames_count = \
-                average_experiment(base_wsize, maxframe, [data],
-                    loss_prob=None)
-            print "{0} - time={1}, frames count={2}".format(
-                maxframe, time_, frames_count)
-            csv_writer.writerow((maxframe, time_, frames_count))
-            
-    with open("data_maxframe_loss.csv", "w") as f:
-        csv_writer = csv.writer(f, lineterminator='\n')
-        for maxframe in range(10, 402, 10):
-            time_, frames_count = \
-                average_experiment(base_wsize, maxframe, [data],
-                    loss_prob=base_loss_prob)
-            print "{0} - time={1}, frames count={2}".format(
-                maxframe, time_, frames_count)
-            csv_writer.writerow((maxframe, time_, frames_count))
-
-    with open("data_loss.csv", "w") as f:
-        csv_writer = csv.writer(f, lineterminator='\n')
-        for prob in [1e-5, 1e-4, 1e-3, 3e-3, 6e-3, 9e-3, 1e-2]:
-            time_, frames_count = \
-                average_experiment(base_wsize, base_max_frame, [data],
-                    loss_prob=prob)
-            print "{0} - time={1}, frames count={2}".format(
-                prob, time_, frames_count)
-            csv_writer.writerow((prob, time_, frames_count))
+    def sweep(name, parameter, values, **point):
+        run_sweep(name, parameter, values, processes=processes, seed=seed,
+            **dict(base, **point))
+
+    sweep("data_wsize", 'window_size', range(1, 102, 3))
+    sweep("data_wsize_loss", 'window_size', range(1, 102, 3),
+        loss_prob=base_loss_prob)
+    sweep("data_maxframe", 'max_frame_data', range(10, 402, 10))
+    sweep("data_maxframe_loss", 'max_frame_data', range(10, 402, 10),
+        loss_prob=base_loss_prob)
+    sweep("data_loss", 'loss_prob',
+        [1e-5, 1e-4, 1e-3, 3e-3, 6e-3, 9e-3, 1e-2])
+    # Losses with same mean probability grouped in bursts of different
+    # length.
+    sweep("data_burst_loss", 'burst_length', [1, 2, 5, 10, 20, 50, 100],
+        loss_prob=base_loss_prob)
+    # Number of frames decreases with increase of acknowledge delay, since
+    # more acknowledges are coalesced.
+    sweep("data_ack_delay", 'ack_delay', [0, 1e-3, 5e-3, 1e-2, 2e-2, 5e-2],
+        loss_prob=base_loss_prob)
 
 if __name__ == "__main__":
     _test(level=None)
@@ -0,0 +1,211 @@
+#  This file is part of network emulation test model.
+#
+#  Copyright (C) 2010, 2011  Vladimir Rutsky <altsysrq@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__  = "Vladimir Rutsky <altsysrq@gmail.com>"
+__license__ = "GPL"
+
+__all__ = ["run_sweep", "point_key", "point_seed", "read_results"]
+
+"""Parallel resumable runner of `sliding_window.average_experiment()'
+parameter sweeps.
+
+Each sweep point is described by configuration dictionary with
+`average_experiment()' keyword arguments and few special keys:
+`data_size' (size of transmitted datagram) and `burst_length' (if present,
+losses are generated by GilbertElliottLossFunc with mean probability
+`loss_prob'). Results are appended as JSON lines into `<name>.json' file
+as soon as points finish, and `<name>.csv' with columns (parameter value,
+time, frames count, seed) sorted by parameter value is rewritten after each
+point.
+"""
+
+import os
+import csv
+import json
+import binascii
+import multiprocessing
+
+import config
+
+def point_key(point):
+    """Returns string identifying sweep point configuration `point'."""
+    return json.dumps(point, sort_keys=True)
+
+def point_seed(point, seed=0):
+    """Returns seed of sweep point, which depends only on base `seed' and
+    point configuration, so that results of interrupted sweep are
+    reproducible.
+    """
+    return (seed + binascii.crc32(point_key(point))) & 0x7fffffff
+
+def read_results(file_name):
+    """Returns rows stored in JSON lines results file `file_name'."""
+    rows = []
+    if os.path.exists(file_name):
+        with open(file_name) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    rows.append(json.loads(line))
+    return rows
+
+def _init_process(thread_sleep_time, frame_transmitter_thread_sleep_time):
+    config.thread_sleep_time = thread_sleep_time
+    config.frame_transmitter_thread_sleep_time = \
+        frame_transmitter_thread_sleep_time
+
+def _run_point(args):
+    """Runs experiment for sweep point in pool process."""
+    point, seed = args
+
+    from loss_models import GilbertElliottLossFunc
+    from sliding_window import average_experiment
+
+    kwargs = dict(point)
+    data_size = kwargs.pop('data_size')
+    pattern = "".join(map(chr, xrange(256)))
+    data = (pattern * (data_size // len(pattern) + 1))[:data_size]
+    window_size = kwargs.pop('window_size')
+    max_frame_data = kwargs.pop('max_frame_data')
+    burst_length = kwargs.pop('burst_length', None)
+    if burst_length is not None:
+        kwargs['loss_func'] = GilbertElliottLossFunc.from_mean(
+            kwargs.pop('loss_prob'), burst_length)
+
+    time_, frames_count = average_experiment(window_size, max_frame_data,
+        [data], seed=seed, **kwargs)
+    return point, seed, time_, frames_count
+
+def _write_csv(file_name, parameter, rows):
+    rows = sorted(rows, key=lambda row: row['config'][parameter])
+    with open(file_name, "w") as f:
+        csv_writer = csv.writer(f, lineterminator='\n')
+        for row in rows:
+            csv_writer.writerow((row['config'][parameter], row['time'],
+                row['frames_count'], row['seed']))
+
+def run_sweep(name, parameter, values, processes=None, seed=0, **point):
+    """Runs experiments for each value of `parameter' in `values' with rest
+    point configuration `point' in pool of `processes' processes (by default
+    number of CPUs). Points already stored in `<name>.json' are skipped.
+    Returns number of run points.
+    """
+
+    json_name = name + ".json"
+    csv_name = name + ".csv"
+
+    points = [dict(point, **{parameter: value}) for value in values]
+    keys = set(map(point_key, points))
+    rows = [row for row in read_results(json_name)
+        if point_key(row['config']) in keys]
+    done_keys = set(point_key(row['config']) for row in rows)
+    pending = [(p, point_seed(p, seed)) for p in points
+        if point_key(p) not in done_keys]
+
+    if pending:
+        pool = multiprocessing.Pool(processes, _init_process,
+            (config.thread_sleep_time,
+                config.frame_transmitter_thread_sleep_time))
+        try:
+            with open(json_name, "a") as f:
+                for p, point_seed_, time_, frames_count in \
+                        pool.imap_unordered(_run_point, pending):
+                    row = dict(config=p, seed=point_seed_, time=time_,
+                        frames_count=frames_count)
+                    f.write(json.dumps(row, sort_keys=True) + "\n")
+                    f.flush()
+                    rows.append(row)
+                    _write_csv(csv_name, parameter, rows)
+                    print "{0} {1}={2} - time={3}, frames count={4}".format(
+                        name, parameter, p[parameter], time_, frames_count)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    _write_csv(csv_name, parameter, rows)
+    return len(pending)
+# --- cut here in report ---
+
+def _test():
+    # TODO: Use in separate file to test importing functionality.
+
+    import shutil
+    import tempfile
+
+    from testing import unittest, do_tests
+
+    class Tests(object):
+        class TestSweep(unittest.TestCase):
+            def setUp(self):
+                self.dir_name = tempfile.mkdtemp()
+                self.name = os.path.join(self.dir_name, "data_wsize")
+
+            def tearDown(self):
+                shutil.rmtree(self.dir_name)
+
+            def test_point_seed(self):
+                p = dict(window_size=5, loss_prob=0.001)
+                self.assertEqual(point_seed(p), point_seed(dict(p)))
+                self.assertNotEqual(point_seed(p), point_seed(p, seed=1))
+                self.assertNotEqual(point_seed(p),
+                    point_seed(dict(p, window_size=6)))
+
+            def test_resume(self):
+                kwargs = dict(processes=2, max_frame_data=100,
+                    data_size=1000, loss_prob=0.001, tries=1)
+                self.assertEqual(run_sweep(self.name, 'window_size', [10, 1],
+                    **kwargs), 2)
+
+                rows = read_results(self.name + ".json")
+                self.assertEqual(len(rows), 2)
+                for row in rows:
+                    self.assertEqual(row['config']['data_size'], 1000)
+                    self.assertEqual(row['seed'], point_seed(row['config']))
+                    self.assertGreater(row['frames_count'], 0)
+                with open(self.name + ".csv") as f:
+                    csv_rows = list(csv.reader(f))
+                self.assertEqual([int(row[0]) for row in csv_rows], [1, 10])
+
+                # Stored points are skipped.
+                self.assertEqual(run_sweep(self.name, 'window_size',
+                    [1, 10, 4], **kwargs), 1)
+                self.assertEqual(len(read_results(self.name + ".json")), 3)
+                with open(self.name + ".csv") as f:
+                    self.assertEqual([int(row[0]) for row in csv.reader(f)],
+                        [1, 4, 10])
+
+                # Points with other configuration are not reused.
+                kwargs['loss_prob'] = 0
+                self.assertEqual(run_sweep(self.name, 'window_size', [1],
+                    **kwargs), 1)
+                with open(self.name + ".csv") as f:
+                    self.assertEqual(len(list(csv.reader(f))), 1)
+
+            def test_burst_loss(self):
+                self.assertEqual(run_sweep(self.name, 'burst_length', [1, 5],
+                    processes=1, window_size=10, max_frame_data=100,
+                    data_size=500, loss_prob=0.001, tries=1), 2)
+
+    do_tests(Tests)
+
+if __name__ == "__main__":
+    _test()
+
+# vim: set ts=4 sw=4 et: